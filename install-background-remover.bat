@@ -22,7 +22,7 @@ pip install transformers>=4.39.1 huggingface_hub accelerate
 
 echo.
 echo [3/3] Instalando outras dependencias...
-pip install moviepy pillow opencv-python numpy timm kornia scikit-image einops
+pip install moviepy pillow opencv-python numpy timm kornia scikit-image einops rembg onnxruntime
 
 if %errorLevel% neq 0 (
     echo.
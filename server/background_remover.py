@@ -1,218 +1,482 @@
-import torch
-from transformers import AutoModelForImageSegmentation
-from torchvision import transforms
 from PIL import Image
 import numpy as np
-import cv2
 import os
 import sys
 import json
 import tempfile
-from moviepy.editor import VideoFileClip, ImageSequenceClip
 import argparse
 
-# Set device
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"Using device: {device}")
+from compositing import Compositor
+from matte_cache import DEFAULT_CACHE_SIZE, get_matte_cache
+from inference_backends import INFERENCE_BACKENDS, PRECISIONS, set_torch_threads
+from instrumentation import ProgressReporter, StageTimer, profiled
+from matting import refine_alpha
+from model_registry import get_registry, variant_for
+from pipeline import DEFAULT_PIPELINE_DEPTH, Pipeline
+from roi import SubjectTracker
+from temporal import TemporalMaskPropagator
+from video_io import (FFmpegVideoReader, OUTPUT_FORMATS, add_encoder_arguments, encoder_options, open_matte_writer,
+                      open_video_writer, output_format_for, supports_alpha)
 
-# Global variables for models
-birefnet = None
-birefnet_lite = None
+# Square input resolutions BiRefNet can run at (multiples of 32; trained at 1024)
+INFERENCE_SIZES = (512, 768, 1024)
+DEFAULT_INFERENCE_SIZE = 1024
 
-def load_models():
-    """Load BiRefNet models with caching"""
-    global birefnet, birefnet_lite
+# ImageNet normalisation used by BiRefNet
+IMAGE_MEAN = (0.485, 0.456, 0.406)
+IMAGE_STD = (0.229, 0.224, 0.225)
+
+def preprocess_frames(frames, size, device):
+    """Resize and normalise RGB uint8 frames into an Nx3xSxS model input tensor
     
-    if birefnet is None or birefnet_lite is None:
-        try:
-            print("Loading BiRefNet models...")
-            
-            # Create models directory if it doesn't exist
-            models_dir = os.path.join(os.path.dirname(__file__), 'models')
-            os.makedirs(models_dir, exist_ok=True)
-            
-            # Load models with local caching
-            cache_dir = models_dir
-            
-            print("Loading BiRefNet...")
-            birefnet = AutoModelForImageSegmentation.from_pretrained(
-                "ZhengPeng7/BiRefNet", 
-                trust_remote_code=True,
-                cache_dir=cache_dir
-            )
-            birefnet.to(device)
-            birefnet.eval()
-            
-            print("Loading BiRefNet Lite...")
-            birefnet_lite = AutoModelForImageSegmentation.from_pretrained(
-                "ZhengPeng7/BiRefNet_lite", 
-                trust_remote_code=True,
-                cache_dir=cache_dir
-            )
-            birefnet_lite.to(device)
-            birefnet_lite.eval()
-            
-            print("Models loaded successfully")
-            
-        except Exception as e:
-            print(f"Error loading models: {e}")
-            sys.exit(1)
+    frames is either an NxHxWx3 array or a list of HxWx3 arrays that may
+    differ in size.
+    """
+    import torch
+    import torch.nn.functional as F
+    
+    if isinstance(frames, np.ndarray) and frames.ndim == 4:
+        groups = [frames]
+    elif len({frame.shape for frame in frames}) == 1:
+        groups = [np.stack(frames)]
+    else:
+        groups = [frame[np.newaxis] for frame in frames]
+    
+    tensors = []
+    for group in groups:
+        tensor = torch.from_numpy(np.ascontiguousarray(group)).to(device)
+        tensor = tensor.permute(0, 3, 1, 2).float().div_(255)
+        tensors.append(F.interpolate(tensor, size=(size, size), mode="bilinear", align_corners=False, antialias=True))
+    batch = torch.cat(tensors) if len(tensors) > 1 else tensors[0]
     
-    return birefnet, birefnet_lite
+    mean = torch.tensor(IMAGE_MEAN, device=batch.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGE_STD, device=batch.device).view(1, 3, 1, 1)
+    return batch.sub_(mean).div_(std)
 
-# Image transformation
-transform_image = transforms.Compose([
-    transforms.Resize((1024, 1024)),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-])
+def load_model(fast_mode=True):
+    """Load the BiRefNet variant used by the given mode, caching it in the registry"""
+    variant = variant_for(fast_mode)
+    try:
+        return get_registry().get(variant)
+    except Exception as e:
+        print(f"Error loading model {variant}: {e}")
+        raise
 
-def process_frame(image, background, fast_mode=True):
-    """Process a single frame to remove background"""
+def load_runner(fast_mode=True, inference_size=DEFAULT_INFERENCE_SIZE):
+    """Load the model or exported graph the configured inference backend runs for this mode"""
+    variant = variant_for(fast_mode)
     try:
-        # Load models if not already loaded
-        birefnet_model, birefnet_lite_model = load_models()
+        return get_registry().get_runner(variant, inference_size)
+    except Exception as e:
+        print(f"Error loading {get_registry().backend} runner for {variant}: {e}")
+        raise
+
+def load_models():
+    """Load both BiRefNet models with caching"""
+    return load_model(fast_mode=False), load_model(fast_mode=True)
+
+def upsample_masks(preds, size):
+    """Resize Nx1xhxw predictions to size (width, height) as NxHxW uint8 masks"""
+    import torch
+    import torch.nn.functional as F
+    
+    width, height = size
+    masks = F.interpolate(preds, size=(height, width), mode="bilinear", align_corners=False)
+    return masks.squeeze(1).mul_(255).round_().to(torch.uint8).cpu().numpy()
+
+def predict_masks(images, fast_mode=True, batch_size=1, inference_size=DEFAULT_INFERENCE_SIZE, refine_edges=False, timer=None):
+    """Predict HxW uint8 alpha masks for RGB frames, batch_size at a time
+    
+    images may be PIL images, HxWx3 arrays or an NxHxWx3 array. The model runs
+    at inference_size x inference_size; with refine_edges the upsampled mask
+    is snapped to the frame's edges at full resolution. The preprocess,
+    inference, upsample and refine stages are timed into timer if given.
+    """
+    import torch
+    
+    if timer is None:
+        timer = StageTimer()
+    # Load the model (or exported graph) for this mode if not already loaded
+    runner = load_runner(fast_mode, inference_size)
+    device = get_registry().device
+    
+    if not isinstance(images, np.ndarray):
+        images = [np.asarray(image.convert("RGB")) if isinstance(image, Image.Image) else image for image in images]
+    
+    masks = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
         
-        image_size = image.size
-        input_images = transform_image(image).unsqueeze(0).to(device)
-        model = birefnet_lite_model if fast_mode else birefnet_model
+        # Stack the batch into a single NxCxHxW tensor for one forward pass
+        with timer.stage("preprocess", len(batch)):
+            input_images = preprocess_frames(batch, inference_size, device)
         
         with torch.no_grad():
-            preds = model(input_images)[-1].sigmoid().cpu()
-        
-        pred = preds[0].squeeze()
-        pred_pil = transforms.ToPILImage()(pred)
-        mask = pred_pil.resize(image_size)
-        
-        # Handle different background types
-        if isinstance(background, str) and background.startswith("#"):
-            # Color background
-            color_rgb = tuple(int(background[i:i+2], 16) for i in (1, 3, 5))
-            bg_image = Image.new("RGBA", image_size, color_rgb + (255,))
-        elif isinstance(background, Image.Image):
-            # Image background
-            bg_image = background.convert("RGBA").resize(image_size)
-        else:
-            # Default transparent background
-            bg_image = Image.new("RGBA", image_size, (0, 0, 0, 0))
-        
-        # Composite the image
-        image_rgba = image.convert("RGBA")
-        result = Image.composite(image_rgba, bg_image, mask)
+            with timer.stage("inference", len(batch)):
+                preds = runner(input_images)
+            
+            # Upsample on the tensor, in one call when the whole batch shares a size
+            with timer.stage("upsample", len(batch)):
+                sizes = {frame.shape[:2] for frame in batch}
+                if len(sizes) == 1:
+                    height, width = sizes.pop()
+                    batch_masks = list(upsample_masks(preds, (width, height)))
+                else:
+                    batch_masks = []
+                    for frame, pred in zip(batch, preds):
+                        batch_masks.extend(upsample_masks(pred.unsqueeze(0), (frame.shape[1], frame.shape[0])))
         
-        # Convert back to RGB for video processing
-        if background is None or (isinstance(background, str) and background == "transparent"):
-            return result  # Keep RGBA for transparency
-        else:
-            return result.convert("RGB")
+        if refine_edges:
+            with timer.stage("refine", len(batch)):
+                batch_masks = [refine_alpha(frame, mask) for frame, mask in zip(batch, batch_masks)]
+        masks.extend(batch_masks)
     
+    return masks
+
+def process_frames(frames, background, fast_mode=True, batch_size=1, inference_size=DEFAULT_INFERENCE_SIZE, refine_edges=None):
+    """Process several frames, running the model on batches of batch_size"""
+    if refine_edges is None:
+        refine_edges = inference_size < DEFAULT_INFERENCE_SIZE
+    try:
+        masks = predict_masks(frames, fast_mode, batch_size, inference_size, refine_edges)
     except Exception as e:
-        print(f"Error processing frame: {e}")
-        return image.convert("RGB")
+        print(f"Error processing frames: {e}")
+        return [image.convert("RGB") for image in frames]
+    
+    # Handle different background types
+    if isinstance(background, str) and background.startswith("#"):
+        background_type = "color"
+    elif isinstance(background, Image.Image):
+        background_type = "image"
+    else:
+        background_type = "transparent"
+    
+    results = []
+    compositor = None
+    for image, mask in zip(frames, masks):
+        rgb = np.asarray(image.convert("RGB"))
+        if background_type == "transparent":
+            # Keep RGBA for transparency
+            results.append(Image.fromarray(np.dstack([rgb, mask]), "RGBA"))
+            continue
+        
+        # Build the compositor once and reuse it while the frame size is unchanged
+        if compositor is None or (compositor.width, compositor.height) != image.size:
+            compositor = Compositor(image.size[0], image.size[1], background_type, background)
+        results.append(Image.fromarray(compositor.composite(rgb, mask).copy(), "RGB"))
+    
+    return results
+
+def process_frame(image, background, fast_mode=True, inference_size=DEFAULT_INFERENCE_SIZE, refine_edges=None):
+    """Process a single frame to remove background"""
+    return process_frames([image], background, fast_mode, 1, inference_size, refine_edges)[0]
+
+def remove_background_stream(batches, compositor, fast_mode=True, temporal=None,
+                             inference_size=DEFAULT_INFERENCE_SIZE, refine_edges=False, timer=None, out_pool=None,
+                             roi=None):
+    """Lazily remove the background from a stream of RGB frame batches
+    
+    Yields (output_frame, mask) per frame, where output_frame is laid out by
+    the compositor (RGBA when it keeps alpha) and mask is the HxW uint8 matte,
+    or None when segmentation failed and the frame is passed through.
+    With a TemporalMaskPropagator, the model only runs on the keyframes of each
+    batch and the other masks are propagated from the previous frame.
+    With a SubjectTracker (roi), the model only sees a crop around the
+    subject found in the previous mask and everything outside it is
+    transparent; it falls back to the full frame when the subject is lost.
+    Stage times (preprocess, inference, upsample, temporal, composite) are
+    added to timer. With out_pool (a BufferPool), every output frame is
+    composited into its own buffer from the pool instead of the compositor's
+    reused one.
+    """
+    if timer is None:
+        timer = StageTimer()
+    for batch in batches:
+        try:
+            if temporal:
+                with timer.stage("temporal", len(batch)):
+                    plan = temporal.plan(batch)
+                key_frames = [frame for frame, is_key in zip(batch, plan) if is_key]
+            else:
+                key_frames = batch
+            
+            # Process the whole batch with a single forward pass
+            masks = []
+            if len(key_frames):
+                box = roi.box(batch[0].shape, len(key_frames)) if roi else None
+                if box is not None:
+                    x, y, w, h = box
+                    key_frames = [frame[y:y + h, x:x + w] for frame in key_frames]
+                masks = predict_masks(key_frames, fast_mode, len(key_frames), inference_size, refine_edges, timer)
+                if roi:
+                    masks = [roi.paste(box, mask, batch[0].shape) for mask in masks]
+                    roi.update(masks[-1], box)
+            if temporal:
+                with timer.stage("temporal", 0):
+                    masks = temporal.resolve(plan, masks)
+        except Exception as e:
+            print(f"Error processing frames: {e}")
+            masks = None
+            if temporal:
+                temporal.reset()
+            if roi:
+                roi.reset()
+        
+        for i, frame in enumerate(batch):
+            out = out_pool.acquire() if out_pool else None
+            with timer.stage("composite"):
+                if masks is None:
+                    # Use original frame if processing fails
+                    output, mask = compositor.passthrough(frame, out), None
+                else:
+                    output, mask = compositor.apply(frame, masks[i], out), masks[i]
+            yield output, mask
+
+def composite_cached_stream(batches, compositor, mattes, timer=None, out_pool=None):
+    """Composite a stream of RGB frame batches with masks from the matte cache
+    
+    Yields (output_frame, mask) like remove_background_stream, without
+    touching the model.
+    """
+    if timer is None:
+        timer = StageTimer()
+    masks = timer.timed_iter(mattes, "cache_read", frames=None)
+    for batch in batches:
+        for frame in batch:
+            mask = next(masks, None)
+            if mask is None:
+                raise IOError("Cached matte has fewer frames than the video")
+            out = out_pool.acquire() if out_pool else None
+            with timer.stage("composite"):
+                output = compositor.apply(frame, mask, out)
+            yield output, mask
+
+def release_batches(batches, pool):
+    """Yield batches from a BufferPool, returning each buffer once the next batch is requested"""
+    for batch in batches:
+        yield batch
+        pool.release(batch)
 
-def process_video(input_path, output_path, background_type="transparent", background_value=None, fast_mode=True, quality="high"):
-    """Process video to remove background"""
+def process_video(input_path, output_path, background_type="transparent", background_value=None, fast_mode=True, quality="high", batch_size=1, progress_callback=None,
+                  temporal=False, temporal_threshold=0.02, keyframe_interval=15,
+                  inference_size=DEFAULT_INFERENCE_SIZE, refine_edges=None,
+                  output_format=None, matte_output=None, use_cache=True, timer=None, reporter=None,
+                  pipeline_depth=DEFAULT_PIPELINE_DEPTH, roi=False, roi_margin=0.15, encoder=None):
+    """Process video to remove background
+    
+    Decoding, segmentation/compositing and encoding overlap: the decoder
+    and the encoder each run on their own thread (see pipeline.py), joined
+    to the model by queues of pipeline_depth batches and frames, so memory
+    use stays flat regardless of the video length and the wall time tends
+    towards the slowest stage. progress_callback, if given, is called as
+    progress_callback(frame_count, total_frames).
+    
+    With temporal=True BiRefNet only runs on keyframes (see temporal.py).
+    With roi=True it runs on a crop around the subject, grown by roi_margin,
+    instead of the whole frame (see roi.py).
+    inference_size trades accuracy for speed; refine_edges (on by default
+    below 1024) cleans up the upsampled mask at full resolution.
+    
+    output_format (mp4, webm, mov or png; guessed from output_path by
+    default) decides how transparent output is stored: webm (VP9), mov
+    (ProRes 4444) and png sequences keep a real alpha channel, mp4 is
+    flattened onto white. matte_output, if given, also receives the
+    mask-only stream so it can be re-composited without re-segmenting.
+    encoder holds encoder settings for open_video_writer (codec, preset,
+    crf, threads, pix_fmt); without a crf or bitrate the quality tier
+    picks the bitrate. The source audio is kept, stream-copied when the
+    container accepts it.
+    
+    With use_cache, masks are stored in the matte cache (see matte_cache.py)
+    keyed by the input's content and the model settings; a later run with
+    only a different background composites the cached masks and never loads
+    the model.
+    
+    Progress is reported as JSON-lines events by reporter (a
+    ProgressReporter writing to stdout by default) with fps, ETA, memory
+    and per-stage timings (decode, preprocess, inference, upsample,
+    composite, encode, ...) accumulated in timer, which defaults to the
+    reporter's.
+    """
+    if reporter is None:
+        reporter = ProgressReporter(timer)
+    timer = reporter.timer
+    pipeline = None
     try:
         print(f"Processing video: {input_path}")
         print(f"Background type: {background_type}")
         print(f"Fast mode: {fast_mode}")
         print(f"Quality: {quality}")
+        print(f"Batch size: {batch_size}")
+        print(f"Temporal mode: {temporal}")
+        print(f"ROI tracking: {roi}")
+        if refine_edges is None:
+            refine_edges = inference_size < DEFAULT_INFERENCE_SIZE
+        print(f"Inference size: {inference_size}, edge refinement: {refine_edges}")
+        output_format = output_format or output_format_for(output_path)
+        if output_format not in OUTPUT_FORMATS:
+            print(f"Error: Unknown output format: {output_format}")
+            return False
+        print(f"Output format: {output_format}")
+        if background_type == "transparent" and not supports_alpha(output_format):
+            print(f"Warning: {output_format} has no alpha channel, transparent output is flattened onto white "
+                  f"(use .webm, .mov or a PNG sequence to keep transparency)")
         
-        # Load models first
-        load_models()
-        
-        # Load video
-        video = VideoFileClip(input_path)
-        fps = video.fps
-        duration = video.duration
+        # Decode on a background thread into a ring of batch buffers
+        reader = FFmpegVideoReader(input_path)
+        pipeline = Pipeline(pipeline_depth)
+        batch_pool = pipeline.pool((batch_size,) + reader.frame_shape, pipeline_depth + 2)
+        batches = release_batches(
+            pipeline.source(timer.timed_iter(reader.iter_batches(batch_size, pool=batch_pool), "decode"), "decode"),
+            batch_pool
+        )
+        fps = reader.fps
+        duration = reader.duration
+        width, height = reader.width, reader.height
         
         print(f"Video info - FPS: {fps}, Duration: {duration}s")
         
-        # Prepare background
-        background = None
-        if background_type == "color" and background_value:
-            background = background_value
-        elif background_type == "image" and background_value:
-            if os.path.exists(background_value):
-                background = Image.open(background_value)
-            else:
-                print(f"Warning: Background image not found: {background_value}")
-                background = None
+        # Prepare the background once for the whole job
+        compositor = Compositor(width, height, background_type, background_value,
+                                keep_alpha=supports_alpha(output_format))
         
-        # Process frames
-        processed_frames = []
-        frame_count = 0
-        total_frames = int(fps * duration)
+        # Output frames queued for the encoder thread each get their own buffer
+        encode_depth = max(batch_size, pipeline_depth) * 2
+        out_pool = pipeline.pool((height, width, compositor.channels), encode_depth + 2, timer=timer, wait_stage="encode_wait")
         
-        print(f"Processing {total_frames} frames...")
+        # Look for masks computed earlier with the same input and model settings
+        cache = get_matte_cache() if use_cache else None
+        cached = None
+        cache_writer = None
+        if cache:
+            registry = get_registry()
+            cache_key = cache.key_for(
+                input_path, variant_for(fast_mode), inference_size,
+                # A different checkpoint (--weights-path, BIREFNET_*_PATH) makes different masks
+                weights=registry.weights_fingerprint(variant_for(fast_mode)),
+                backend=registry.backend,
+                precision=registry.precision if registry.backend != "eager" else None,
+                refine_edges=refine_edges,
+                temporal=[temporal_threshold, keyframe_interval] if temporal else None,
+                roi=[roi_margin] if roi else None
+            )
+            cached = cache.get(cache_key, width, height)
         
-        # Process video frame by frame
-        for t in np.arange(0, duration, 1.0/fps):
-            frame_count += 1
+        # Keyframe selection and mask propagation for temporal mode, subject crops for ROI mode
+        propagator = None
+        tracker = None
+        if cached is not None:
+            print(f"Matte cache hit ({len(cached)} frames), compositing only")
+            stream = composite_cached_stream(batches, compositor, cached, timer, out_pool)
+        else:
+            if temporal:
+                propagator = TemporalMaskPropagator(temporal_threshold, keyframe_interval)
+            if roi:
+                tracker = SubjectTracker(margin=roi_margin)
             
-            try:
-                # Get frame at time t
-                frame = video.get_frame(t)
-                
-                # Convert frame to PIL Image
-                pil_frame = Image.fromarray(frame.astype('uint8'), 'RGB')
-                
-                # Process frame
-                processed_frame = process_frame(pil_frame, background, fast_mode)
-                
-                # Convert back to numpy array
-                if processed_frame.mode == 'RGBA':
-                    # Handle transparency by converting to RGB with white background
-                    white_bg = Image.new('RGB', processed_frame.size, (255, 255, 255))
-                    processed_frame = Image.alpha_composite(white_bg.convert('RGBA'), processed_frame).convert('RGB')
-                
-                processed_frames.append(np.array(processed_frame))
-                
-                # Progress update
-                if frame_count % 50 == 0 or frame_count == total_frames:
-                    progress = (frame_count / total_frames) * 100
-                    print(f"Progress: {progress:.1f}% ({frame_count}/{total_frames})")
-                    
-            except Exception as e:
-                print(f"Error processing frame {frame_count}: {e}")
-                # Use original frame if processing fails
-                processed_frames.append(frame)
-        
-        print("Creating output video...")
-        
-        # Create output video
-        processed_video = ImageSequenceClip(processed_frames, fps=fps)
-        
-        # Add audio if present
-        if video.audio:
-            processed_video = processed_video.set_audio(video.audio)
-        
-        # Set quality parameters
-        codec = "libx264"
-        if quality == "high":
+            # Load the model (or exported graph) for this mode
+            load_runner(fast_mode, inference_size)
+            stream = remove_background_stream(
+                batches, compositor, fast_mode, propagator, inference_size, refine_edges, timer, out_pool, tracker
+            )
+            if cache:
+                cache_writer = cache.writer(cache_key, width, height)
+        
+        # Set quality parameters (an explicit crf or bitrate wins)
+        encoder_settings = dict(encoder or {})
+        if "crf" in encoder_settings or "bitrate" in encoder_settings:
+            bitrate = encoder_settings.pop("bitrate", None)
+        elif quality == "high":
             bitrate = "8000k"
         elif quality == "medium":
             bitrate = "4000k"
         else:
             bitrate = "2000k"
         
-        # Write video
-        processed_video.write_videofile(
-            output_path,
-            codec=codec,
+        frame_count = 0
+        total_frames = max(1, reader.estimated_frames)
+        
+        print(f"Processing ~{total_frames} frames...")
+        reporter.start(total_frames)
+        
+        # Stream frames straight into the encoder, keeping the source audio
+        writer = open_video_writer(
+            output_path, width, height, fps,
+            output_format=output_format,
+            alpha=compositor.keeps_alpha,
             bitrate=bitrate,
-            audio_codec="aac",
-            temp_audiofile=None,
-            remove_temp=True,
-            verbose=False,
-            logger=None,
-            threads=4
+            audio_source=input_path if reader.has_audio else None,
+            audio_duration=duration,
+            **encoder_settings
         )
+        matte_writer = None
+        opaque = None
         
-        # Cleanup
-        video.close()
-        processed_video.close()
+        def encode_frame(item):
+            """Encoder thread: write one output frame, its matte and its cache entry"""
+            nonlocal cache_writer
+            processed_frame, mask = item
+            with timer.stage("encode"):
+                writer.write(processed_frame)
+            if matte_writer:
+                with timer.stage("matte"):
+                    matte_writer.write(opaque if mask is None else mask)
+            if cache_writer:
+                if mask is None:
+                    # Never cache a pass-through frame
+                    cache_writer.abort()
+                    cache_writer = None
+                else:
+                    with timer.stage("cache_write"):
+                        cache_writer.write(mask)
+            out_pool.release(processed_frame)
+        
+        try:
+            with writer:
+                if matte_output:
+                    matte_writer = open_matte_writer(matte_output, width, height, fps)
+                    opaque = np.full((height, width), 255, dtype=np.uint8)
+                try:
+                    sink = pipeline.sink(encode_frame, "encode", encode_depth)
+                    for item in stream:
+                        frame_count += 1
+                        sink.put(item)
+                        if progress_callback:
+                            progress_callback(frame_count, total_frames)
+                        reporter.update(frame_count)
+                    # Wait for the encoder thread to write the queued frames
+                    pipeline.finish()
+                except BaseException:
+                    pipeline.stop()
+                    if matte_writer:
+                        matte_writer.abort()
+                    raise
+                if matte_writer:
+                    with timer.stage("matte", 0):
+                        matte_writer.close()
+                # Flush the encoder inside the timed region
+                with timer.stage("encode", 0):
+                    writer.close()
+        except BaseException:
+            if cache_writer:
+                cache_writer.abort()
+            raise
         
+        if cache_writer:
+            with timer.stage("cache_write", 0):
+                cache_writer.commit(source=os.path.basename(input_path))
+        
+        # The header frame count is only an estimate; report the exact one
+        reporter.finish(frame_count)
+        print(f"Decoded and encoded {reader.frame_count} frames")
+        if propagator and propagator.frames:
+            print(f"Temporal mode: model ran on {propagator.keyframes}/{propagator.frames} frames "
+                  f"(skip ratio {propagator.skip_ratio:.2f})")
+        if tracker:
+            print(f"ROI tracking: {tracker.crop_frames} cropped / {tracker.full_frames} full-frame passes "
+                  f"(model saw {tracker.mean_crop_fraction:.0%} of the frame area on average)")
+        if matte_output:
+            print(f"Matte written to: {matte_output}")
         print(f"Video processed successfully: {output_path}")
         return True
         
@@ -221,6 +485,9 @@ def process_video(input_path, output_path, background_type="transparent", backgr
         import traceback
         traceback.print_exc()
         return False
+    finally:
+        if pipeline:
+            pipeline.stop()
 
 def main():
     parser = argparse.ArgumentParser(description='Remove background from video')
@@ -230,17 +497,71 @@ def main():
     parser.add_argument('--background-value', help='Background color (hex) or image path')
     parser.add_argument('--fast-mode', action='store_true', help='Use fast mode (BiRefNet_lite)')
     parser.add_argument('--quality', default='high', choices=['low', 'medium', 'high'])
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of frames per model forward pass')
+    parser.add_argument('--inference-size', type=int, default=DEFAULT_INFERENCE_SIZE, choices=INFERENCE_SIZES, help='Model input resolution')
+    parser.add_argument('--refine-edges', action=argparse.BooleanOptionalAction, default=None,
+                        help='Refine the mask at full resolution (default: on below 1024)')
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_FORMATS), help='Output container (default: from the output extension)')
+    parser.add_argument('--matte-output', help='Also write the mask-only matte stream to this path')
+    parser.add_argument('--temporal', action='store_true', help='Only run the model on keyframes and propagate masks in between')
+    parser.add_argument('--temporal-threshold', type=float, default=0.02, help='Frame difference (0-1) that forces a new keyframe')
+    parser.add_argument('--keyframe-interval', type=int, default=15, help='Maximum frames between keyframes in temporal mode')
+    parser.add_argument('--roi', action='store_true', help='Run the model on a crop around the subject tracked from the previous mask')
+    parser.add_argument('--roi-margin', type=float, default=0.15, help='Margin added around the subject box, as a fraction of its size')
+    parser.add_argument('--weights-path', help='Local directory with the BiRefNet weights for the selected mode')
+    parser.add_argument('--models-dir', help='Directory used to cache downloaded models')
+    parser.add_argument('--offline', action='store_true', help='Never download models, only use local files')
+    parser.add_argument('--inference-backend', default='eager', choices=INFERENCE_BACKENDS,
+                        help='Run the eager model or a graph exported with model_export.py')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='Precision of the exported graph to load')
+    parser.add_argument('--threads', type=int, help='Intra-op threads for the inference runtime')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the matte cache')
+    parser.add_argument('--cache-dir', help='Directory of the matte cache (default: $AEBG_MATTE_CACHE_DIR or ~/.cache/aebg/mattes)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // 1024 ** 2, help='Matte cache size limit in MB')
+    add_encoder_arguments(parser)
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='Minimum seconds between JSON progress events')
+    parser.add_argument('--profile', help='Write a profile of the run here: a torch profiler trace for .json, cProfile stats otherwise')
     
     args = parser.parse_args()
     
-    success = process_video(
-        args.input,
-        args.output,
-        args.background_type,
-        args.background_value,
-        args.fast_mode,
-        args.quality
-    )
+    registry = get_registry()
+    if args.models_dir:
+        registry.models_dir = args.models_dir
+    if args.weights_path:
+        registry.set_weights_path(variant_for(args.fast_mode), args.weights_path)
+    registry.offline = args.offline
+    registry.backend = args.inference_backend
+    registry.precision = args.precision
+    registry.threads = args.threads
+    set_torch_threads(args.threads)
+    
+    cache = get_matte_cache()
+    if args.cache_dir:
+        cache.cache_dir = args.cache_dir
+    cache.max_bytes = args.cache_size * 1024 ** 2
+    
+    with profiled(args.profile):
+        success = process_video(
+            args.input,
+            args.output,
+            args.background_type,
+            args.background_value,
+            args.fast_mode,
+            args.quality,
+            max(1, args.batch_size),
+            temporal=args.temporal,
+            temporal_threshold=args.temporal_threshold,
+            roi=args.roi,
+            roi_margin=args.roi_margin,
+            keyframe_interval=max(1, args.keyframe_interval),
+            inference_size=args.inference_size,
+            refine_edges=args.refine_edges,
+            output_format=args.output_format,
+            matte_output=args.matte_output,
+            use_cache=not args.no_cache,
+            reporter=ProgressReporter(interval=args.progress_interval),
+            encoder=encoder_options(args)
+        )
     
     if success:
         print("SUCCESS")
@@ -7,16 +7,244 @@ Fallback option when rembg is not available
 import sys
 import os
 import argparse
+import threading
 import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
-def remove_background_opencv(input_path, output_path, background_type="transparent", background_value=None):
-    """Remove background using OpenCV (basic green screen removal)"""
+from compositing import parse_hex_color
+from instrumentation import ProgressReporter, StageTimer, profiled
+from parallel import ordered_map, read_frame_chunks
+from pipeline import Pipeline
+from video_io import (OUTPUT_FORMATS, add_encoder_arguments, encoder_options, open_matte_writer, open_video_writer,
+                      output_format_for, supports_alpha)
+
+class ChromaKeyer:
+    """Soft chroma keyer for BGR frames with spill suppression
+    
+    The matte is the chroma (Cr/Cb) distance from the key colour mapped
+    through a lookup table: pixels closer than tolerance are fully keyed out,
+    and alpha ramps up to opaque over the next softness (both 0-1). Every step
+    is a single OpenCV kernel writing into buffers allocated once, so a keyer
+    instance must only be used by one thread at a time (see copy()).
+    """
+    
+    def __init__(self, width, height, key_color="#00ff00", tolerance=0.15, softness=0.1, spill=1.0,
+                 background=None, transparent_color=(255, 255, 255)):
+        self.width = width
+        self.height = height
+        self.key_color = key_color
+        self.spill = spill
+        
+        # Key colour in YCrCb; only the chroma channels take part in the distance
+        key_bgr = np.uint8([[parse_hex_color(key_color)[::-1]]])
+        key_ycrcb = cv2.cvtColor(key_bgr, cv2.COLOR_BGR2YCrCb)[0, 0]
+        self._key_scalar = (0.0, float(key_ycrcb[1]), float(key_ycrcb[2]), 0.0)
+        
+        # Distance (|dCr| + |dCb|, saturated to 255) -> alpha lookup table
+        distance = np.arange(256, dtype=np.float32) / 255.0
+        ramp = np.clip((distance - tolerance) / max(softness, 1e-6), 0.0, 1.0)
+        self.alpha_lut = np.round(ramp * 255).astype(np.uint8).reshape(256, 1)
+        
+        # Spill is suppressed on the key's dominant channel, limited by the other two
+        self._spill_channel = int(np.argmax(key_bgr[0, 0]))
+        self._spill_others = [c for c in range(3) if c != self._spill_channel]
+        
+        # Solid background when none is given (flattened transparent output)
+        if background is None:
+            background = np.full((height, width, 3), transparent_color[::-1], dtype=np.uint8)
+        self.background = background
+        self._allocate()
+    
+    def _allocate(self):
+        shape = (self.height, self.width)
+        self._ycrcb = np.empty(shape + (3,), dtype=np.uint8)
+        self._diff = np.empty(shape + (3,), dtype=np.uint8)
+        self._cr = np.empty(shape, dtype=np.uint8)
+        self._cb = np.empty(shape, dtype=np.uint8)
+        self._distance = np.empty(shape, dtype=np.uint8)
+        self._alpha = np.empty(shape, dtype=np.uint8)
+        self._opaque = np.empty(shape, dtype=np.uint8)
+        self._soft = np.empty(shape, dtype=np.uint8)
+        self._channels = [np.empty(shape, dtype=np.uint8) for _ in range(3)]
+        self._limit = np.empty(shape, dtype=np.uint8)
+        self._foreground = np.empty(shape + (3,), dtype=np.uint8)
+        self._bgra = np.empty(shape + (4,), dtype=np.uint8)
+        self._out = np.empty(shape + (3,), dtype=np.uint8)
+    
+    def copy(self):
+        """A keyer with the same settings and tables but its own work buffers"""
+        clone = object.__new__(ChromaKeyer)
+        clone.__dict__.update(self.__dict__)
+        clone._allocate()
+        return clone
+    
+    def _chroma_distance(self, frame):
+        cv2.cvtColor(frame, cv2.COLOR_BGR2YCrCb, dst=self._ycrcb)
+        cv2.absdiff(self._ycrcb, self._key_scalar, dst=self._diff)
+        # |dCr| + |dCb| (saturating add)
+        cv2.extractChannel(self._diff, 1, dst=self._cr)
+        cv2.extractChannel(self._diff, 2, dst=self._cb)
+        return cv2.add(self._cr, self._cb, dst=self._distance)
+    
+    def matte(self, frame):
+        """Soft HxW uint8 alpha (255 = foreground); valid until the next call"""
+        return cv2.LUT(self._chroma_distance(frame), self.alpha_lut, dst=self._alpha)
+    
+    def despill(self, frame, out, roi=(slice(None), slice(None))):
+        """Clamp the key's dominant channel towards the other two to remove colour spill"""
+        frame = frame[roi]
+        out = out[roi]
+        if self.spill <= 0:
+            np.copyto(out, frame)
+            return out
+        
+        channels = [channel[roi] for channel in self._channels]
+        limit = self._limit[roi]
+        for i in range(3):
+            cv2.extractChannel(frame, i, dst=channels[i])
+        c = self._spill_channel
+        a, b = self._spill_others
+        cv2.max(channels[a], channels[b], dst=limit)
+        if self.spill >= 1:
+            cv2.min(channels[c], limit, dst=channels[c])
+        else:
+            cv2.min(channels[c], limit, dst=limit)
+            cv2.addWeighted(channels[c], 1.0 - self.spill, limit, self.spill, 0, dst=channels[c])
+        return cv2.merge(channels, dst=out)
+    
+    def process(self, frame, out=None):
+        """Key one BGR frame over the background"""
+        return self.composite(frame, self.matte(frame), out)
+    
+    def composite(self, frame, alpha, out=None):
+        """Blend a BGR frame over the background with its matte from matte()
+        
+        Only the bounding box of the non-keyed pixels is despilled and
+        blended; the rest of the output is a straight copy of the background.
+        """
+        if out is None:
+            out = self._out
+        np.copyto(out, self.background)
+        
+        x, y, w, h = cv2.boundingRect(alpha)
+        if w == 0 or h == 0:
+            return out
+        roi = (slice(y, y + h), slice(x, x + w))
+        
+        foreground = self.despill(frame, self._foreground, roi)
+        alpha = alpha[roi]
+        target = out[roi]
+        
+        # Opaque pixels are copied; only the soft edge band is blended
+        cv2.compare(alpha, 255, cv2.CMP_EQ, dst=self._opaque[roi])
+        cv2.copyTo(foreground, self._opaque[roi], target)
+        points = cv2.findNonZero(cv2.inRange(alpha, 1, 254, dst=self._soft[roi]))
+        if points is not None:
+            xs, ys = points.reshape(-1, 2).T
+            weight = alpha[ys, xs, None].astype(np.float32) * (1.0 / 255.0)
+            fg = foreground[ys, xs].astype(np.float32)
+            bg = self.background[roi][ys, xs].astype(np.float32)
+            target[ys, xs] = (bg + (fg - bg) * weight + 0.5).astype(np.uint8)
+        return out
+
+    def process_alpha(self, frame, out=None):
+        """Key one BGR frame to BGRA: the despilled frame with the matte as alpha"""
+        return self.attach_alpha(frame, self.matte(frame), out)
+    
+    def attach_alpha(self, frame, alpha, out=None):
+        """Despill a BGR frame and attach its matte from matte() as the alpha channel"""
+        if out is None:
+            out = self._bgra
+        foreground = self.despill(frame, self._foreground)
+        return cv2.merge([foreground, alpha], dst=out)
+
+# One keyer clone per pool thread
+_thread_state = threading.local()
+
+def thread_keyer(keyer):
+    """Return this thread's private copy of keyer"""
+    clones = getattr(_thread_state, "keyers", None)
+    if clones is None:
+        clones = _thread_state.keyers = {}
+    clone = clones.get(id(keyer))
+    if clone is None or clone[0] is not keyer:
+        clone = clones[id(keyer)] = (keyer, keyer.copy())
+    return clone[1]
+
+def key_chunk(frames, keyer, keep_alpha=False, with_mattes=False):
+    """Process a chunk of frames, returning (results, mattes, errors, timings)
+    
+    Results are BGRA when keep_alpha is set, BGR composites otherwise.
+    mattes holds a copy of each frame's alpha when with_mattes is set (None
+    for failed frames). Failed frames are passed through unchanged and
+    reported as (index_in_chunk, message) so the caller can log them in order.
+    timings is a StageTimer with the chunk's matte ("inference") and
+    "composite" times.
+    """
+    results = []
+    mattes = []
+    errors = []
+    timer = StageTimer()
+    local_keyer = thread_keyer(keyer)
+    for i, frame in enumerate(frames):
+        try:
+            with timer.stage("inference"):
+                matte = local_keyer.matte(frame)
+            with timer.stage("composite"):
+                if keep_alpha:
+                    result = local_keyer.attach_alpha(frame, matte, out=np.empty(frame.shape[:2] + (4,), dtype=np.uint8))
+                else:
+                    result = local_keyer.composite(frame, matte, out=np.empty_like(frame))
+            results.append(result)
+            mattes.append(matte.copy() if with_mattes else None)
+        except Exception as e:
+            errors.append((i, str(e)))
+            # Use original frame if processing fails
+            if keep_alpha:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+            results.append(frame)
+            mattes.append(None)
+    return results, mattes, errors, timer
+
+def remove_background_opencv(input_path, output_path, background_type="transparent", background_value=None, progress_callback=None, workers=1, chunk_size=8,
+                             key_color="#00ff00", tolerance=0.15, softness=0.1, spill=1.0,
+                             output_format=None, matte_output=None, timer=None, reporter=None, encoder=None):
+    """Remove background using OpenCV (soft chroma key with spill suppression)
+    
+    With workers > 1, chunks of chunk_size frames are keyed on a thread pool
+    (the OpenCV calls release the GIL) and written back in order. Decoding
+    and encoding run on their own threads (see pipeline.py).
+    Transparent output keeps its alpha in webm, mov and png output formats;
+    matte_output, if given, receives the mask-only stream. encoder holds
+    encoder settings (codec, preset, crf, threads, pix_fmt; see
+    open_video_writer) and the source audio is muxed in. Progress goes
+    out as JSON-lines events from reporter (see process_video in
+    background_remover.py); with workers the matte ("inference") and
+    composite times in its timer are summed across threads.
+    """
+    if reporter is None:
+        reporter = ProgressReporter(timer)
+    timer = reporter.timer
+    cap = None
+    pipeline = None
+    out = None
+    matte_out = None
     try:
         print(f"Processing video with OpenCV: {input_path}")
         print(f"Output: {output_path}")
         print(f"Background type: {background_type}")
+        print(f"Key color: {key_color}, tolerance: {tolerance}, softness: {softness}, spill: {spill}")
+        output_format = output_format or output_format_for(output_path)
+        if output_format not in OUTPUT_FORMATS:
+            print(f"ERROR: Unknown output format: {output_format}")
+            return False
+        keep_alpha = background_type == "transparent" and supports_alpha(output_format)
+        print(f"Output format: {output_format}")
+        if background_type == "transparent" and not keep_alpha:
+            print(f"Warning: {output_format} has no alpha channel, transparent output is flattened onto white")
         
         # Open video
         cap = cv2.VideoCapture(input_path)
@@ -31,79 +259,87 @@ def remove_background_opencv(input_path, output_path, background_type="transpare
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         
         print(f"Video info: {width}x{height}, {fps} FPS, {total_frames} frames")
+        reporter.start(total_frames)
         
-        # Setup video writer
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        
-        if not out.isOpened():
-            print(f"ERROR: Could not create output video: {output_path}")
-            return False
+        # Setup video writer (BGRA frames when the alpha is kept)
+        out = open_video_writer(output_path, width, height, fps, output_format, alpha=keep_alpha, channel_order="bgr",
+                                audio_source=input_path, audio_duration=total_frames / fps if fps > 0 else None,
+                                **(encoder or {}))
+        matte_out = None
+        if matte_output:
+            matte_out = open_matte_writer(matte_output, width, height, fps)
+            opaque = np.full((height, width), 255, dtype=np.uint8)
         
         # Prepare background
         background_img = None
         if background_type == "color" and background_value:
-            # Convert hex to RGB
-            hex_color = background_value.lstrip('#')
-            rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-            background_img = np.full((height, width, 3), rgb[::-1], dtype=np.uint8)  # BGR for OpenCV
+            background_img = np.full((height, width, 3), parse_hex_color(background_value)[::-1], dtype=np.uint8)  # BGR for OpenCV
         elif background_type == "image" and background_value and os.path.exists(background_value):
             bg_img = cv2.imread(background_value)
             if bg_img is not None:
                 background_img = cv2.resize(bg_img, (width, height))
         
+        # Build the keyer (lookup tables and background) once for the whole job
+        keyer = ChromaKeyer(width, height, key_color, tolerance, softness, spill, background=background_img)
+        
         # Process frames
         frame_count = 0
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-                
-            frame_count += 1
-            
-            try:
-                # Simple green screen removal (basic approach)
-                if background_type == "transparent" or background_img is not None:
-                    # Convert to HSV for better color detection
-                    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                    
-                    # Define range for green color (adjust as needed)
-                    lower_green = np.array([40, 40, 40])
-                    upper_green = np.array([80, 255, 255])
-                    
-                    # Create mask for green pixels
-                    mask = cv2.inRange(hsv, lower_green, upper_green)
-                    
-                    # Invert mask to get non-green pixels
-                    mask_inv = cv2.bitwise_not(mask)
-                    
-                    if background_img is not None:
-                        # Replace green pixels with background
-                        result = frame.copy()
-                        result[mask > 0] = background_img[mask > 0]
-                    else:
-                        # For transparent background, just use original frame
-                        # (OpenCV doesn't handle transparency well, so we keep original)
-                        result = frame
-                else:
-                    result = frame
-                
+        pipeline = Pipeline()
+        chunks = pipeline.source(timer.timed_iter(read_frame_chunks(cap, chunk_size), "decode"), "decode")
+        process_chunk = partial(key_chunk, keyer=keyer, keep_alpha=keep_alpha, with_mattes=matte_out is not None)
+        
+        def encode_frame(item):
+            """Encoder thread: write one output frame and its matte"""
+            result, matte = item
+            with timer.stage("encode"):
                 out.write(result)
+            if matte_out:
+                with timer.stage("matte"):
+                    matte_out.write(opaque if matte is None else matte)
+        
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            sink = pipeline.sink(encode_frame, "encode", chunk_size * 2)
+            if executor:
+                print(f"Using {workers} worker threads")
+                results = ordered_map(executor, process_chunk, chunks, max_pending=workers * 2)
+            else:
+                results = (process_chunk(chunk) for chunk in chunks)
+            
+            for processed, mattes, errors, chunk_timer in results:
+                timer.merge(chunk_timer)
+                for i, message in errors:
+                    print(f"Error processing frame {frame_count + i + 1}: {message}")
                 
-                # Progress update
-                if frame_count % 30 == 0 or frame_count == total_frames:
-                    progress = (frame_count / total_frames) * 100
-                    print(f"Progress: {progress:.1f}% ({frame_count}/{total_frames})")
+                for item in zip(processed, mattes):
+                    frame_count += 1
+                    sink.put(item)
                     
-            except Exception as e:
-                print(f"Error processing frame {frame_count}: {e}")
-                # Use original frame if processing fails
-                out.write(frame)
+                    if progress_callback:
+                        progress_callback(frame_count, total_frames)
+                    reporter.update(frame_count)
+            pipeline.finish()
+        except BaseException:
+            pipeline.stop()
+            out.abort()
+            if matte_out:
+                matte_out.abort()
+            raise
+        finally:
+            pipeline.stop()
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            cap.release()
         
         # Cleanup
-        cap.release()
-        out.release()
+        with timer.stage("encode", 0):
+            out.close()
+        if matte_out:
+            with timer.stage("matte", 0):
+                matte_out.close()
+            print(f"Matte written to: {matte_output}")
         
+        reporter.finish(frame_count)
         print(f"SUCCESS: Video processed successfully: {output_path}")
         return True
         
@@ -111,6 +347,14 @@ def remove_background_opencv(input_path, output_path, background_type="transpare
         print(f"ERROR: {e}")
         import traceback
         traceback.print_exc()
+        # Never leave an encoder running or a truncated output behind
+        if pipeline is not None:
+            pipeline.stop()
+        if cap is not None:
+            cap.release()
+        for writer in (out, matte_out):
+            if writer is not None:
+                writer.abort()
         return False
 
 def main():
@@ -119,15 +363,37 @@ def main():
     parser.add_argument('--output', required=True, help='Output video path')
     parser.add_argument('--background-type', default='transparent', choices=['transparent', 'color', 'image'])
     parser.add_argument('--background-value', help='Background color (hex) or image path')
+    parser.add_argument('--key-color', default='#00ff00', help='Screen colour to key out (hex)')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Chroma distance (0-1) keyed out completely')
+    parser.add_argument('--softness', type=float, default=0.1, help='Chroma distance (0-1) over which alpha ramps to opaque')
+    parser.add_argument('--spill', type=float, default=1.0, help='Spill suppression strength (0-1)')
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_FORMATS), help='Output container (default: from the output extension)')
+    parser.add_argument('--matte-output', help='Also write the mask-only matte stream to this path')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker threads for frame processing')
+    parser.add_argument('--chunk-size', type=int, default=8, help='Frames handed to a worker at a time')
+    add_encoder_arguments(parser)
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='Minimum seconds between JSON progress events')
+    parser.add_argument('--profile', help='Write cProfile stats of the run to this path')
     
     args = parser.parse_args()
     
-    success = remove_background_opencv(
-        args.input,
-        args.output,
-        args.background_type,
-        args.background_value
-    )
+    with profiled(args.profile):
+        success = remove_background_opencv(
+            args.input,
+            args.output,
+            args.background_type,
+            args.background_value,
+            workers=max(1, args.workers),
+            chunk_size=max(1, args.chunk_size),
+            key_color=args.key_color,
+            tolerance=args.tolerance,
+            softness=args.softness,
+            spill=args.spill,
+            output_format=args.output_format,
+            matte_output=args.matte_output,
+            reporter=ProgressReporter(interval=args.progress_interval),
+            encoder=encoder_options(args)
+        )
     
     if success:
         print("SUCCESS")
@@ -8,10 +8,29 @@ import sys
 import os
 import argparse
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from compositing import Compositor
+from instrumentation import ProgressReporter, StageTimer, profiled
+from matte_cache import DEFAULT_CACHE_SIZE, get_matte_cache
+from parallel import limit_threads, ordered_map, read_frame_chunks
+from pipeline import Pipeline
+from video_io import (OUTPUT_FORMATS, add_encoder_arguments, encoder_options, open_matte_writer, open_video_writer,
+                      output_format_for, supports_alpha)
+
+# Selectable rembg models ("isnet" is shorthand for isnet-general-use)
+REMBG_MODELS = {
+    "u2net": "u2net",
+    "u2netp": "u2netp",
+    "silueta": "silueta",
+    "isnet": "isnet-general-use",
+}
+DEFAULT_REMBG_MODEL = "u2net"
+
 def install_rembg():
-    """Install rembg if not available"""
+    """Install rembg if not available (run once at setup time with --install-deps)"""
     try:
         import rembg
         return True
@@ -29,23 +48,211 @@ def install_rembg():
             print(f"Failed to install rembg: {e}")
             return False
 
-def process_video_simple(input_path, output_path, background_type="transparent", background_value=None):
-    """Process video with simple background removal"""
+# Per-process state for the frame workers
+_worker_session = None
+_worker_model = None
+_worker_compositor = None
+_worker_temporal = None
+_worker_temporal_per_chunk = False
+_worker_roi = None
+
+def get_session(model_name=DEFAULT_REMBG_MODEL, threads=None):
+    """Return this process's rembg session, creating it only when the model or thread count changes"""
+    global _worker_session, _worker_model
+    from rembg import new_session
+    
+    model_name = REMBG_MODELS.get(model_name, model_name)
+    if _worker_session is None or _worker_model != (model_name, threads):
+        session_options = {}
+        if threads:
+            import onnxruntime
+            sess_opts = onnxruntime.SessionOptions()
+            sess_opts.intra_op_num_threads = threads
+            sess_opts.inter_op_num_threads = 1
+            session_options["sess_opts"] = sess_opts
+        _worker_session = new_session(model_name, **session_options)
+        _worker_model = (model_name, threads)
+    return _worker_session
+
+def init_frame_worker(width, height, background_type="transparent", background_value=None, model_name=DEFAULT_REMBG_MODEL,
+                      temporal=None, temporal_per_chunk=False, keep_alpha=False, roi_margin=None, threads=None):
+    """Create the rembg session and compositor used by this process
+    
+    temporal is an optional (threshold, keyframe_interval) pair enabling
+    keyframe-only segmentation. roi_margin, if set, enables subject ROI
+    tracking (see roi.py). Pool workers see non-consecutive chunks, so they
+    restart the propagation and the tracking at every chunk
+    (temporal_per_chunk). keep_alpha makes transparent output BGRA instead
+    of flattening it. threads caps the process's OpenCV and onnxruntime
+    thread pools.
+    """
+    global _worker_compositor, _worker_temporal, _worker_temporal_per_chunk, _worker_roi
+    
+    limit_threads(threads)
+    get_session(model_name, threads)
+    _worker_compositor = Compositor(width, height, background_type, background_value, channel_order="bgr",
+                                    keep_alpha=keep_alpha)
+    
+    _worker_temporal = None
+    _worker_temporal_per_chunk = temporal_per_chunk
+    if temporal:
+        from temporal import TemporalMaskPropagator
+        threshold, keyframe_interval = temporal
+        _worker_temporal = TemporalMaskPropagator(threshold, keyframe_interval, channel_order="bgr")
+    
+    _worker_roi = None
+    if roi_margin is not None:
+        from roi import SubjectTracker
+        _worker_roi = SubjectTracker(margin=roi_margin)
+
+def remove_background_chunk(frames):
+    """Remove the background from a chunk of BGR frames, returning (results, masks, errors, model_frames, timings)
+    
+    Runs in the process set up by init_frame_worker. Failed frames are passed
+    through unchanged (with a None mask) and reported as (index_in_chunk,
+    message). model_frames is how many frames actually went through rembg.
+    timings is a StageTimer.state() snapshot of the chunk's stages.
+    """
+    import cv2
+    import numpy as np
+    from rembg import remove
+    
+    timer = StageTimer()
+    roi = _worker_roi
+    if roi and _worker_temporal_per_chunk:
+        roi.reset()
+    temporal = _worker_temporal
+    if temporal:
+        if _worker_temporal_per_chunk:
+            temporal.reset()
+        with timer.stage("temporal", len(frames)):
+            plan = temporal.plan(frames)
+    else:
+        plan = [True] * len(frames)
+    
+    # Segment the frames that need a model pass
+    masks = [None] * len(frames)
+    errors = []
+    for i, frame in enumerate(frames):
+        if not plan[i]:
+            continue
+        try:
+            # rembg works on RGB; NumPy in, NumPy mask out
+            box = roi.box(frame.shape) if roi else None
+            with timer.stage("inference"):
+                if box is not None:
+                    x, y, w, h = box
+                    frame = frame[y:y + h, x:x + w]
+                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                mask = remove(frame_rgb, session=_worker_session, only_mask=True)
+            if roi:
+                mask = roi.paste(box, mask, frames[i].shape)
+                roi.update(mask, box)
+            masks[i] = mask
+        except Exception as e:
+            errors.append((i, str(e)))
+            if roi:
+                roi.reset()
+    
+    if temporal:
+        if errors:
+            # Propagating from a failed keyframe would spread the error
+            temporal.reset()
+        else:
+            with timer.stage("temporal", 0):
+                masks = temporal.resolve(plan, [mask for mask, is_key in zip(masks, plan) if is_key])
+    
+    results = []
+    compositor = _worker_compositor
+    for frame, alpha in zip(frames, masks):
+        out = np.empty((compositor.height, compositor.width, compositor.channels), dtype=np.uint8)
+        with timer.stage("composite"):
+            if alpha is None:
+                # Use original frame if processing fails
+                results.append(compositor.passthrough(frame, out=out))
+            else:
+                # Keep rembg's alpha, or blend the original frame over the background with it
+                results.append(compositor.apply(frame, alpha, out=out))
+    return results, masks, errors, sum(plan), timer.state()
+
+def composite_cached_chunks(chunks, compositor, mattes):
+    """Composite chunks of BGR frames with masks from the matte cache
+    
+    Yields the same (results, masks, errors, model_frames, timings) tuples
+    as remove_background_chunk without running rembg.
+    """
+    import numpy as np
+    
+    masks = iter(mattes)
+    for frames in chunks:
+        timer = StageTimer()
+        with timer.stage("cache_read", len(frames)):
+            chunk_masks = [next(masks, None) for _ in frames]
+        if any(mask is None for mask in chunk_masks):
+            raise IOError("Cached matte has fewer frames than the video")
+        with timer.stage("composite", len(frames)):
+            results = [
+                compositor.apply(frame, mask, out=np.empty((compositor.height, compositor.width, compositor.channels), dtype=np.uint8))
+                for frame, mask in zip(frames, chunk_masks)
+            ]
+        yield results, chunk_masks, [], 0, timer.state()
+
+def process_video_simple(input_path, output_path, background_type="transparent", background_value=None, progress_callback=None, workers=1, chunk_size=4, model_name=DEFAULT_REMBG_MODEL,
+                         temporal=False, temporal_threshold=0.02, keyframe_interval=15,
+                         output_format=None, matte_output=None, use_cache=True, timer=None, reporter=None,
+                         roi=False, roi_margin=0.15, encoder=None, threads=None):
+    """Process video with simple background removal
+    
+    With workers > 1, chunks of chunk_size frames are processed on a pool of
+    processes, each with its own rembg session, and written back in order.
+    threads caps the thread pools of each of those processes (or of this
+    one without workers). Decoding and encoding run on their own threads (see pipeline.py).
+    With temporal=True rembg only runs on keyframes (see temporal.py); with
+    roi=True it only sees a crop around the tracked subject (see roi.py).
+    Transparent output keeps its alpha in webm, mov and png output formats
+    (see process_video in background_remover.py); matte_output, if given,
+    receives the mask-only stream, and encoder holds encoder settings
+    (codec, preset, crf, threads, pix_fmt; see open_video_writer). The
+    source audio is muxed in. With use_cache, rembg masks are stored
+    in and reused from the matte cache (see matte_cache.py). Progress goes
+    out as JSON-lines events from reporter (see process_video in
+    background_remover.py); with workers the inference and composite times
+    in its timer are summed across processes.
+    """
+    if reporter is None:
+        reporter = ProgressReporter(timer)
+    timer = reporter.timer
+    cap = None
+    pipeline = None
+    out = None
+    matte_out = None
+    cache_writer = None
     try:
-        # Install rembg if needed
-        if not install_rembg():
-            print("ERROR: Could not install rembg")
+        # Dependencies are installed at setup time, never inside a job
+        try:
+            import rembg
+        except ImportError:
+            print("ERROR: rembg is not installed. Run install-background-remover.bat "
+                  "or: python background_remover_simple.py --install-deps")
             return False
-            
-        import rembg
-        from rembg import remove
+        
         import cv2
         import numpy as np
-        from PIL import Image
         
         print(f"Processing video: {input_path}")
         print(f"Output: {output_path}")
         print(f"Background type: {background_type}")
+        print(f"Model: {model_name}")
+        print(f"Temporal mode: {temporal}")
+        print(f"ROI tracking: {roi}")
+        output_format = output_format or output_format_for(output_path)
+        if output_format not in OUTPUT_FORMATS:
+            print(f"ERROR: Unknown output format: {output_format}")
+            return False
+        keep_alpha = background_type == "transparent" and supports_alpha(output_format)
+        print(f"Output format: {output_format}")
+        if background_type == "transparent" and not keep_alpha:
+            print(f"Warning: {output_format} has no alpha channel, transparent output is flattened onto white")
         
         # Open video
         cap = cv2.VideoCapture(input_path)
@@ -60,82 +267,141 @@ def process_video_simple(input_path, output_path, background_type="transparent",
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         
         print(f"Video info: {width}x{height}, {fps} FPS, {total_frames} frames")
+        reporter.start(total_frames)
         
-        # Setup video writer
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        
-        if not out.isOpened():
-            print(f"ERROR: Could not create output video: {output_path}")
-            return False
+        # Setup video writer (BGRA frames when the alpha is kept)
+        out = open_video_writer(output_path, width, height, fps, output_format, alpha=keep_alpha, channel_order="bgr",
+                                audio_source=input_path, audio_duration=total_frames / fps if fps > 0 else None,
+                                **(encoder or {}))
+        matte_out = None
+        if matte_output:
+            matte_out = open_matte_writer(matte_output, width, height, fps)
+            opaque = np.full((height, width), 255, dtype=np.uint8)
         
-        # Prepare background
-        background_img = None
-        if background_type == "color" and background_value:
-            # Convert hex to RGB
-            hex_color = background_value.lstrip('#')
-            rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-            background_img = np.full((height, width, 3), rgb[::-1], dtype=np.uint8)  # BGR for OpenCV
-        elif background_type == "image" and background_value and os.path.exists(background_value):
-            bg_pil = Image.open(background_value).convert('RGB')
-            bg_pil = bg_pil.resize((width, height))
-            background_img = cv2.cvtColor(np.array(bg_pil), cv2.COLOR_RGB2BGR)
+        # Look for masks computed earlier with the same input and model settings
+        cache = get_matte_cache() if use_cache else None
+        cached = None
+        cache_writer = None
+        if cache:
+            cache_key = cache.key_for(
+                input_path, "rembg-" + REMBG_MODELS.get(model_name, model_name),
+                # Pool workers restart temporal propagation and ROI tracking at every chunk
+                temporal=[temporal_threshold, keyframe_interval, chunk_size if workers > 1 else None] if temporal else None,
+                roi=[roi_margin, chunk_size if workers > 1 else None] if roi else None
+            )
+            cached = cache.get(cache_key, width, height)
         
         # Process frames
         frame_count = 0
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-                
-            frame_count += 1
+        model_frames = 0
+        pipeline = Pipeline()
+        chunks = pipeline.source(timer.timed_iter(read_frame_chunks(cap, chunk_size), "decode"), "decode")
+        frame_worker_args = (
+            width, height, background_type, background_value, model_name,
+            (temporal_threshold, keyframe_interval) if temporal else None,
+            workers > 1,
+            keep_alpha,
+            roi_margin if roi else None,
+            threads
+        )
+        
+        executor = None
+        if cached is not None:
+            print(f"Matte cache hit ({len(cached)} frames), compositing only")
+        elif workers > 1:
+            print(f"Using {workers} worker processes")
+            # Spawn (the only option on Windows) so workers never inherit
+            # onnxruntime/OpenCV thread state from a forked parent
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_frame_worker,
+                initargs=frame_worker_args,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        
+        def encode_frame(item):
+            """Encoder thread: write one output frame, its matte and its cache entry"""
+            nonlocal cache_writer
+            result, mask = item
+            with timer.stage("encode"):
+                out.write(result)
+            if matte_out:
+                with timer.stage("matte"):
+                    matte_out.write(opaque if mask is None else mask)
+            if cache_writer:
+                if mask is None:
+                    # Never cache a pass-through frame
+                    cache_writer.abort()
+                    cache_writer = None
+                else:
+                    with timer.stage("cache_write"):
+                        cache_writer.write(mask)
+        
+        try:
+            sink = pipeline.sink(encode_frame, "encode", chunk_size * 2)
+            if cached is not None:
+                compositor = Compositor(width, height, background_type, background_value, channel_order="bgr",
+                                        keep_alpha=keep_alpha)
+                results = composite_cached_chunks(chunks, compositor, cached)
+            elif executor:
+                results = ordered_map(executor, remove_background_chunk, chunks, max_pending=workers * 2)
+            else:
+                init_frame_worker(*frame_worker_args)
+                results = (remove_background_chunk(chunk) for chunk in chunks)
+            if cache and cached is None:
+                cache_writer = cache.writer(cache_key, width, height)
             
-            try:
-                # Convert frame to PIL Image
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(frame_rgb)
-                
-                # Remove background
-                result = remove(pil_image)
-                
-                # Handle different background types
-                if background_type == "transparent":
-                    # Convert RGBA to RGB with white background
-                    if result.mode == 'RGBA':
-                        white_bg = Image.new('RGB', result.size, (255, 255, 255))
-                        result = Image.alpha_composite(white_bg.convert('RGBA'), result).convert('RGB')
-                elif background_img is not None:
-                    # Composite with custom background
-                    if result.mode == 'RGBA':
-                        # Extract alpha channel
-                        alpha = np.array(result)[:, :, 3] / 255.0
-                        result_rgb = np.array(result.convert('RGB'))
-                        
-                        # Blend with background
-                        for c in range(3):
-                            result_rgb[:, :, c] = (alpha * result_rgb[:, :, c] + 
-                                                 (1 - alpha) * background_img[:, :, c])
-                        
-                        result = Image.fromarray(result_rgb.astype(np.uint8))
+            for processed, masks, errors, chunk_model_frames, chunk_timings in results:
+                timer.merge(chunk_timings)
+                model_frames += chunk_model_frames
+                for i, message in errors:
+                    print(f"Error processing frame {frame_count + i + 1}: {message}")
                 
-                # Convert back to OpenCV format
-                result_cv = cv2.cvtColor(np.array(result), cv2.COLOR_RGB2BGR)
-                out.write(result_cv)
-                
-                # Progress update
-                if frame_count % 30 == 0 or frame_count == total_frames:
-                    progress = (frame_count / total_frames) * 100
-                    print(f"Progress: {progress:.1f}% ({frame_count}/{total_frames})")
+                for item in zip(processed, masks):
+                    frame_count += 1
+                    sink.put(item)
                     
-            except Exception as e:
-                print(f"Error processing frame {frame_count}: {e}")
-                # Use original frame if processing fails
-                out.write(frame)
+                    if progress_callback:
+                        progress_callback(frame_count, total_frames)
+                    reporter.update(frame_count)
+            pipeline.finish()
+        except BaseException:
+            pipeline.stop()
+            out.abort()
+            if matte_out:
+                matte_out.abort()
+            if cache_writer:
+                cache_writer.abort()
+            raise
+        finally:
+            pipeline.stop()
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            cap.release()
         
         # Cleanup
-        cap.release()
-        out.release()
+        try:
+            with timer.stage("encode", 0):
+                out.close()
+        except BaseException:
+            if cache_writer:
+                cache_writer.abort()
+            raise
+        if cache_writer:
+            with timer.stage("cache_write", 0):
+                cache_writer.commit(source=os.path.basename(input_path))
+        if matte_out:
+            with timer.stage("matte", 0):
+                matte_out.close()
+            print(f"Matte written to: {matte_output}")
         
+        reporter.finish(frame_count)
+        if temporal and frame_count:
+            print(f"Temporal mode: model ran on {model_frames}/{frame_count} frames "
+                  f"(skip ratio {1 - model_frames / frame_count:.2f})")
+        if _worker_roi and executor is None and cached is None:
+            print(f"ROI tracking: {_worker_roi.crop_frames} cropped / {_worker_roi.full_frames} full-frame passes "
+                  f"(model saw {_worker_roi.mean_crop_fraction:.0%} of the frame area on average)")
         print(f"SUCCESS: Video processed successfully: {output_path}")
         return True
         
@@ -143,23 +409,74 @@ def process_video_simple(input_path, output_path, background_type="transparent",
         print(f"ERROR: {e}")
         import traceback
         traceback.print_exc()
+        # Never leave an encoder running or a truncated output behind
+        if pipeline is not None:
+            pipeline.stop()
+        if cap is not None:
+            cap.release()
+        for writer in (out, matte_out):
+            if writer is not None:
+                writer.abort()
+        if cache_writer:
+            cache_writer.abort()
         return False
 
 def main():
     parser = argparse.ArgumentParser(description='Remove background from video (simple version)')
-    parser.add_argument('--input', required=True, help='Input video path')
-    parser.add_argument('--output', required=True, help='Output video path')
+    parser.add_argument('--input', help='Input video path')
+    parser.add_argument('--output', help='Output video path')
     parser.add_argument('--background-type', default='transparent', choices=['transparent', 'color', 'image'])
     parser.add_argument('--background-value', help='Background color (hex) or image path')
+    parser.add_argument('--model', default=DEFAULT_REMBG_MODEL, choices=sorted(REMBG_MODELS), help='rembg segmentation model')
+    parser.add_argument('--temporal', action='store_true', help='Only run rembg on keyframes and propagate masks in between')
+    parser.add_argument('--temporal-threshold', type=float, default=0.02, help='Frame difference (0-1) that forces a new keyframe')
+    parser.add_argument('--keyframe-interval', type=int, default=15, help='Maximum frames between keyframes in temporal mode')
+    parser.add_argument('--roi', action='store_true', help='Run rembg on a crop around the subject tracked from the previous mask')
+    parser.add_argument('--roi-margin', type=float, default=0.15, help='Margin added around the subject box, as a fraction of its size')
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_FORMATS), help='Output container (default: from the output extension)')
+    parser.add_argument('--matte-output', help='Also write the mask-only matte stream to this path')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the matte cache')
+    parser.add_argument('--cache-dir', help='Directory of the matte cache (default: $AEBG_MATTE_CACHE_DIR or ~/.cache/aebg/mattes)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // 1024 ** 2, help='Matte cache size limit in MB')
+    parser.add_argument('--install-deps', action='store_true', help='Install rembg and onnxruntime, then exit')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes, each with its own rembg session')
+    parser.add_argument('--chunk-size', type=int, default=4, help='Frames handed to a worker at a time')
+    add_encoder_arguments(parser)
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='Minimum seconds between JSON progress events')
+    parser.add_argument('--profile', help='Write cProfile stats of the run to this path')
     
     args = parser.parse_args()
     
-    success = process_video_simple(
-        args.input,
-        args.output,
-        args.background_type,
-        args.background_value
-    )
+    if args.install_deps:
+        sys.exit(0 if install_rembg() else 1)
+    if not args.input or not args.output:
+        parser.error("--input and --output are required")
+    
+    cache = get_matte_cache()
+    if args.cache_dir:
+        cache.cache_dir = args.cache_dir
+    cache.max_bytes = args.cache_size * 1024 ** 2
+    
+    with profiled(args.profile):
+        success = process_video_simple(
+            args.input,
+            args.output,
+            args.background_type,
+            args.background_value,
+            workers=max(1, args.workers),
+            chunk_size=max(1, args.chunk_size),
+            model_name=args.model,
+            temporal=args.temporal,
+            temporal_threshold=args.temporal_threshold,
+            roi=args.roi,
+            roi_margin=args.roi_margin,
+            keyframe_interval=max(1, args.keyframe_interval),
+            output_format=args.output_format,
+            matte_output=args.matte_output,
+            use_cache=not args.no_cache,
+            reporter=ProgressReporter(interval=args.progress_interval),
+            encoder=encoder_options(args)
+        )
     
     if success:
         print("SUCCESS")
@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+"""
+Persistent background removal worker
+Schedules jobs sent as JSON lines on stdin onto warm job processes within CPU and memory budgets
+
+Every request is one JSON object per line:
+    {"id": "job-1", "backend": "birefnet", "input": "in.mp4", "output": "out.mp4",
+     "background_type": "color", "background_value": "#00ff00", "fast_mode": true, "roi": true}
+    {"id": "job-2", "backend": "simple", "input": "in.mp4", "output": "out.webm",
+     "background_type": "transparent", "matte_output": "matte.mp4", "profile": "job-2.prof",
+     "encoder": {"preset": "veryfast", "crf": 30}}
+    {"id": "job-3", "backend": "opencv", "input": "long.mp4", "output": "out.mp4",
+     "key_color": "#0000ff", "tolerance": 0.2, "spill": 0.5,
+     "segment_seconds": 30, "segment_processes": 4, "work_dir": "job-3.segments"}
+    {"command": "preload", "fast_mode": true}
+    {"command": "cancel", "id": "job-1"}
+    {"command": "metrics", "id": "m-1"}
+    {"command": "ping"}
+    {"command": "shutdown"}
+
+Every event is written back as one JSON object per line on stdout, e.g.
+    {"event": "accepted", "id": "job-1", "queued": 2, "start_s": 14.2, "eta_s": 20.5, "threads": 4, "memory_mb": 1270}
+    {"event": "queued", "id": "job-1", "position": 1, "start_s": 6.0, "eta_s": 12.3}
+    {"event": "started", "id": "job-1", "threads": 4, "memory_mb": 1270, "waited_s": 8.1}
+    {"event": "progress", "id": "job-1", "frame": 50, "total": 300, "progress": 16.7,
+     "fps": 9.8, "eta_s": 25.5, "elapsed_s": 5.1, "rss_mb": 1480.2, "stages": {"decode": 1.2, "inference": 88.4}}
+    {"event": "stages", "id": "job-1", "frames": 300, "fps": 9.9, "stages": {"inference": {"ms_per_frame": 88.1, ...}}}
+    {"event": "result", "id": "job-1", "success": true, "output": "out.mp4", "elapsed": 12.3, "waited_s": 8.1}
+    {"event": "metrics", "id": "m-1", "queued": 3, "running": 2, "threads_used": 8, "throughput_fps": 21.4, ...}
+Log output from the backends is sent to stderr so stdout only carries events.
+Lines a job logs are prefixed with its id on stderr and also sent as events:
+    {"event": "log", "id": "job-1", "text": "Processing ~300 frames..."}
+A job sent without an "id" is given one ("job-<pid>-<n>"), reported in its
+"accepted" event, which comes before any other event of the job.
+
+Jobs run in job processes ("slots") that keep their models loaded between
+jobs, up to --max-jobs at once. A job starts when the CPU threads and memory
+it reserves for all of its processes (segment_processes, rembg workers; see
+scheduler.py; "threads" and "memory_mb" in a job override the estimates)
+fit into what the running jobs leave of --cpu-threads and --memory-mb,
+shortest clip first. Its slot (and every rembg or segment process the job
+starts) pins its torch, OpenCV and rembg thread pools to the
+per-process share of the reservation, as well as the encoder unless the job's
+"encoder" settings (codec, preset, crf, threads, pix_fmt) name a thread
+count, so concurrent jobs do not oversubscribe the cores. "queued" events
+report the position and expected start/finish (seconds from now) of
+waiting jobs whenever the queue changes.
+
+Jobs with segment_seconds run in keyframe-aligned segments checkpointed in
+work_dir (see chunked_job.py): sending the same job again after a crash or
+cancel resumes after the last finished segment, and segment_processes spreads
+the segments over that many processes.
+"""
+
+import sys
+import os
+import argparse
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from contextlib import redirect_stdout
+
+from inference_backends import INFERENCE_BACKENDS, PRECISIONS
+from instrumentation import ProgressReporter, profiled
+from parallel import limit_threads
+from scheduler import JobScheduler, job_kind
+
+BACKENDS = ("birefnet", "simple", "opencv")
+
+class JobCancelled(Exception):
+    """Raised from the progress callback to stop a cancelled job"""
+
+class EventStream:
+    """Thread-safe writer of protocol events, one JSON object per line"""
+
+    def __init__(self, events=sys.stdout):
+        self._events = events
+        self._events_lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        """Write one event line to the protocol stream"""
+        line = json.dumps(dict(event=event, **fields))
+        with self._events_lock:
+            self._events.write(line + "\n")
+            self._events.flush()
+
+class BackgroundWorker(EventStream):
+    """Run background removal jobs one after another in a warm process (a job slot)"""
+
+    def __init__(self, events=sys.stdout, progress_interval=0.5):
+        super().__init__(events)
+        self.progress_interval = progress_interval
+        self.cancelled = set()
+
+    def preload(self, fast_mode=True, inference_size=1024):
+        """Load a BiRefNet variant (with the configured inference backend) ahead of the first job"""
+        from background_remover import load_runner
+        load_runner(fast_mode, inference_size)
+
+    def run_job(self, job, threads=None):
+        """Execute one job and emit its progress, stage timing and result events
+
+        threads is the job's share of its reserved threads for each process it
+        runs in, passed on to the process pools of the rembg and chunked runs.
+        """
+        job_id = job.get("id")
+        backend = job.get("backend", "birefnet")
+        start = time.perf_counter()
+
+        def progress_callback(frame_count, total_frames):
+            if job_id in self.cancelled:
+                raise JobCancelled(f"Job {job_id} cancelled")
+
+        def emit_event(fields):
+            fields = dict(fields)
+            self.emit(fields.pop("event"), id=job_id, **fields)
+
+        output_options = {
+            "output_format": job.get("output_format"),
+            "encoder": job.get("encoder"),
+            "matte_output": job.get("matte_output"),
+            "reporter": ProgressReporter(interval=self.progress_interval, emit=emit_event),
+        }
+
+        temporal_options = {
+            "temporal": bool(job.get("temporal", False)),
+            "temporal_threshold": float(job.get("temporal_threshold", 0.02)),
+            "keyframe_interval": max(1, int(job.get("keyframe_interval", 15))),
+            "roi": bool(job.get("roi", False)),
+            "roi_margin": float(job.get("roi_margin", 0.15)),
+        }
+
+        args = (
+            job["input"],
+            job["output"],
+            job.get("background_type", "transparent"),
+            job.get("background_value"),
+        )
+
+        if backend == "birefnet":
+            from background_remover import process_video as process
+            options = dict(
+                fast_mode=job.get("fast_mode", True),
+                quality=job.get("quality", "high"),
+                batch_size=max(1, int(job.get("batch_size", 1))),
+                inference_size=int(job.get("inference_size", 1024)),
+                refine_edges=job.get("refine_edges"),
+                use_cache=bool(job.get("cache", True)),
+                **temporal_options
+            )
+        elif backend == "simple":
+            from background_remover_simple import process_video_simple as process
+            options = dict(
+                workers=max(1, int(job.get("workers", 1))),
+                chunk_size=max(1, int(job.get("chunk_size", 4))),
+                model_name=job.get("model", "u2net"),
+                use_cache=bool(job.get("cache", True)),
+                threads=threads,
+                **temporal_options
+            )
+        elif backend == "opencv":
+            from background_remover_opencv import remove_background_opencv as process
+            options = dict(
+                workers=max(1, int(job.get("workers", 1))),
+                chunk_size=max(1, int(job.get("chunk_size", 8))),
+                key_color=job.get("key_color", "#00ff00"),
+                tolerance=float(job.get("tolerance", 0.15)),
+                softness=float(job.get("softness", 0.1)),
+                spill=float(job.get("spill", 1.0)),
+            )
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+
+        # Optional per-job cProfile stats or torch profiler trace (.json)
+        with profiled(job.get("profile")):
+            if job.get("segment_seconds"):
+                # Resumable: resubmitting the same job picks up after the last finished segment
+                from chunked_job import process_video_chunked
+                success = process_video_chunked(
+                    *args,
+                    backend=backend,
+                    segment_seconds=float(job["segment_seconds"]),
+                    processes=max(1, int(job.get("segment_processes", 1))),
+                    process_threads=threads,
+                    work_dir=job.get("work_dir"),
+                    progress_callback=progress_callback,
+                    **output_options,
+                    **options
+                )
+            else:
+                success = process(*args, progress_callback=progress_callback, **output_options, **options)
+
+        cancelled = job_id in self.cancelled
+        self.cancelled.discard(job_id)
+        self.emit(
+            "result", id=job_id, success=bool(success) and not cancelled, cancelled=cancelled,
+            output=job["output"], elapsed=round(time.perf_counter() - start, 3)
+        )
+
+    def execute(self, job, threads=None):
+        """Run one job, reporting a failure as an error event"""
+        job_id = job.get("id")
+        try:
+            if job_id in self.cancelled:
+                self.cancelled.discard(job_id)
+                self.emit("result", id=job_id, success=False, cancelled=True, output=job.get("output"))
+                return
+            self.run_job(job, threads)
+        except Exception as e:
+            traceback.print_exc()
+            self.emit("error", id=job_id, error=str(e))
+
+class SlotEvents:
+    """Event stream of a job slot: every line is sent to the daemon over the pipe"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        for line in text.splitlines():
+            if line:
+                self.conn.send(line)
+
+    def flush(self):
+        pass
+
+def pin_threads(threads, backend):
+    """Size the OpenCV (and for BiRefNet, torch) thread pools of this process for the next job
+
+    The rembg and segment pool processes a job starts are pinned to the same
+    count by their initializers (see run_job).
+    """
+    limit_threads(threads)
+    if backend == "birefnet":
+        from inference_backends import set_torch_threads
+        set_torch_threads(threads)
+
+class JobLog:
+    """stdout/stderr of a job slot, so log output can be told apart between concurrent jobs
+
+    Lines written while a job runs go to stderr prefixed with the job's id
+    and are also sent as "log" events for that job; anything else passes
+    through to stderr unchanged.
+    """
+
+    def __init__(self, worker, stream):
+        self.worker = worker
+        self.stream = stream
+        self.job_id = None
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            if self.job_id is None:
+                return self.stream.write(text)
+            lines = (self._partial + text).split("\n")
+            self._partial = lines.pop()
+            for line in lines:
+                self.stream.write(f"[{self.job_id}] {line}\n")
+                self.worker.emit("log", id=self.job_id, text=line)
+            return len(text)
+
+    def start(self, job_id):
+        self.flush()
+        self.job_id = job_id
+
+    def stop(self):
+        self.write("\n" if self._partial else "")
+        self.job_id = None
+        self.flush()
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def slot_main(conn, settings):
+    """Entry point of a job slot process: run the jobs the daemon sends, one at a time"""
+
+    from model_registry import get_registry
+    registry = get_registry()
+    registry.backend = settings["inference_backend"]
+    registry.precision = settings["precision"]
+    registry.threads = settings["threads"]
+
+    worker = BackgroundWorker(events=SlotEvents(conn), progress_interval=settings["progress_interval"])
+    requests = queue.Queue()
+
+    # Only the daemon writes protocol events to stdout; job logs are tagged with the job id
+    log = JobLog(worker, sys.stderr)
+    sys.stdout = sys.stderr = log
+
+    def listen():
+        # Cancels must get through while a job is running
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None
+            if message is None:
+                requests.put(None)
+                return
+            if message.get("command") == "cancel":
+                worker.cancelled.add(message.get("id"))
+            else:
+                requests.put(message)
+
+    threading.Thread(target=listen, daemon=True).start()
+    for message in iter(requests.get, None):
+        if message.get("command") == "preload":
+            try:
+                worker.preload(message.get("fast_mode", True), int(message.get("inference_size", 1024)))
+                worker.emit("preloaded", fast_mode=message.get("fast_mode", True))
+            except Exception as e:
+                traceback.print_exc()
+                worker.emit("error", error=f"Preload failed: {e}")
+        else:
+            job = message["job"]
+            pin_threads(message["threads"], job.get("backend", "birefnet"))
+            job["encoder"] = dict({"threads": message["threads"]}, **(job.get("encoder") or {}))
+            log.start(job.get("id"))
+            try:
+                worker.execute(job, message["threads"])
+            finally:
+                log.stop()
+
+class JobSlot:
+    """Daemon side of a job slot process, which keeps its models loaded between jobs"""
+
+    def __init__(self, name, settings, on_event):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        # Not a daemon: the simple and chunked backends start process pools of their own.
+        # A slot exits by itself when the daemon's end of the pipe closes.
+        self.process = context.Process(target=slot_main, args=(child_conn, settings), name=name)
+        self.process.start()
+        child_conn.close()
+        self.name = name
+        self.on_event = on_event
+        self.kind = None
+        self.busy = False
+        self.job_id = None
+        self.running = False
+        self.outcome = None
+        self.done = threading.Event()
+        self._send_lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read, name=f"{name}-events", daemon=True)
+        self.reader.start()
+
+    @property
+    def alive(self):
+        return self.reader.is_alive()
+
+    def send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def _read(self):
+        while True:
+            try:
+                event = json.loads(self.conn.recv())
+            except (EOFError, OSError):
+                break
+            # The final event of the running job is returned by run() instead
+            if self.running and event.get("id") == self.job_id and event.get("event") in ("result", "error"):
+                self.outcome = event
+                self.done.set()
+            else:
+                self.on_event(event)
+
+    def run(self, job, threads):
+        """Run a job in the slot; returns its result or error event"""
+        self.kind = job_kind(job)
+        self.outcome = None
+        self.done.clear()
+        self.job_id = job.get("id")
+        self.running = True
+        try:
+            self.send({"job": job, "threads": threads})
+            while not self.done.wait(1.0):
+                if not self.alive:
+                    self.process.join(1.0)
+                    return {"event": "error", "id": self.job_id,
+                            "error": f"Job process exited (code {self.process.exitcode})"}
+            return self.outcome
+        finally:
+            self.running = False
+            self.job_id = None
+
+    def cancel(self, job_id):
+        self.send({"command": "cancel", "id": job_id})
+
+    def close(self):
+        try:
+            self.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class WorkerDaemon(EventStream):
+    """Accept jobs and run them on job slots within the scheduler's CPU and memory budgets"""
+
+    def __init__(self, events=sys.stdout, settings=None, cpu_threads=None, memory_mb=None, max_jobs=None):
+        super().__init__(events)
+        self.settings = settings
+        self.slots = []
+        self.preloads = []
+        self._job_count = 0
+        self._slots_lock = threading.Lock()
+        # Jobs cancelled after the scheduler started them but before they reached a slot
+        self._cancels = set()
+        self.scheduler = JobScheduler(self.run_scheduled, cpu_threads, memory_mb, max_jobs, on_change=self.publish_queue)
+
+    def forward(self, event):
+        """Pass an event from a slot on to the protocol stream"""
+        event = dict(event)
+        if event.get("event") == "progress":
+            self.scheduler.progress(event.get("id"), event.get("frame", 0), event.get("total"))
+        self.emit(event.pop("event"), **event)
+
+    def _new_slot(self):
+        slot = JobSlot(f"job-slot-{len(self.slots) + 1}", self.settings, self.forward)
+        for message in self.preloads:
+            slot.send(message)
+        self.slots.append(slot)
+        return slot
+
+    def acquire_slot(self, kind):
+        """An idle slot, preferring one that last ran the same kind of job (its model is warm)"""
+        with self._slots_lock:
+            for slot in [slot for slot in self.slots if not slot.alive]:
+                slot.close()
+                self.slots.remove(slot)
+            idle = [slot for slot in self.slots if not slot.busy]
+            warm = [slot for slot in idle if slot.kind == kind]
+            slot = (warm or idle or [None])[0] or self._new_slot()
+            slot.busy = True
+            return slot
+
+    def run_scheduled(self, entry):
+        """Scheduler callback: run a job on a slot with its share of the reserved threads"""
+        waited_s = round(entry.started - entry.submitted, 3)
+        slot = self.acquire_slot(entry.kind)
+        with self._slots_lock:
+            cancelled = entry.id in self._cancels
+            self._cancels.discard(entry.id)
+            if not cancelled:
+                # From here on a cancel reaches the job through its slot
+                slot.job_id = entry.id
+        if cancelled:
+            slot.busy = False
+            self.emit("result", id=entry.id, success=False, cancelled=True, output=entry.job.get("output"),
+                      waited_s=waited_s)
+            return False
+        self.emit("started", id=entry.id, threads=entry.threads, memory_mb=round(entry.memory_mb), waited_s=waited_s)
+        try:
+            outcome = dict(slot.run(entry.job, entry.process_threads))
+        finally:
+            slot.busy = False
+        self.emit(outcome.pop("event"), **outcome, waited_s=waited_s)
+        return bool(outcome.get("success"))
+
+    def accepted(self, entry, position):
+        """Scheduler callback: confirm a job before any of its queued/started events"""
+        # A job that starts right away is not waiting behind anything
+        queued = position["position"] if position["start_s"] > 0 else 0
+        self.emit("accepted", id=entry.id, queued=queued, start_s=position["start_s"],
+                  eta_s=position["eta_s"], threads=entry.threads, memory_mb=round(entry.memory_mb))
+
+    def publish_queue(self):
+        for position in self.scheduler.queue():
+            self.emit("queued", **position)
+
+    def handle(self, message):
+        """Dispatch one request line. Returns False when the worker should stop."""
+        command = message.get("command", "process")
+
+        if command == "process":
+            if not message.get("input") or not message.get("output"):
+                self.emit("error", id=message.get("id"), error="Job needs 'input' and 'output'")
+            elif message.get("backend", "birefnet") not in BACKENDS:
+                self.emit("error", id=message.get("id"), error=f"Unknown backend: {message.get('backend')}")
+            else:
+                if not message.get("id"):
+                    # Events, results and cancels are matched by id
+                    self._job_count += 1
+                    message["id"] = f"job-{os.getpid()}-{self._job_count}"
+                with self._slots_lock:
+                    # A cancel of an earlier job with this id must not hit the new one
+                    self._cancels.discard(message["id"])
+                self.scheduler.submit(message, on_accept=self.accepted)
+        elif command == "preload":
+            # Replayed on slots started later, so every slot gets warm
+            preload = {"command": "preload", "fast_mode": message.get("fast_mode", True),
+                       "inference_size": int(message.get("inference_size", 1024))}
+            with self._slots_lock:
+                self.preloads.append(preload)
+                if not self.slots:
+                    self._new_slot()
+                else:
+                    for slot in self.slots:
+                        slot.send(preload)
+        elif command == "cancel":
+            job_id = message.get("id")
+            entry = self.scheduler.cancel(job_id)
+            self.emit("cancelling", id=job_id)
+            if entry is not None:
+                self.emit("result", id=job_id, success=False, cancelled=True, output=entry.job.get("output"))
+            else:
+                with self._slots_lock:
+                    slots = [slot for slot in self.slots if slot.job_id == job_id]
+                    for slot in slots:
+                        slot.cancel(job_id)
+                    if not slots and job_id in self.scheduler.running():
+                        # Started by the scheduler but not on a slot yet; run_scheduled checks this
+                        self._cancels.add(job_id)
+        elif command == "metrics":
+            self.emit("metrics", id=message.get("id"), **self.scheduler.metrics())
+        elif command == "ping":
+            running = self.scheduler.running()
+            self.emit("pong", busy=bool(running), current=running[0] if running else None, running=running,
+                      queued=len(self.scheduler.queue()))
+        elif command == "shutdown":
+            return False
+        else:
+            self.emit("error", id=message.get("id"), error=f"Unknown command: {command}")
+        return True
+
+    def serve(self, requests=sys.stdin):
+        """Read JSON-lines requests until EOF or a shutdown command"""
+        self.emit("ready", pid=os.getpid())
+
+        for line in requests:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError as e:
+                self.emit("error", error=f"Invalid JSON request: {e}")
+                continue
+            try:
+                if not self.handle(message):
+                    break
+            except Exception as e:
+                traceback.print_exc()
+                self.emit("error", id=message.get("id"), error=str(e))
+
+        # Let queued jobs finish before exiting
+        self.scheduler.close()
+        with self._slots_lock:
+            for slot in self.slots:
+                slot.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Persistent background removal worker (JSON lines on stdin/stdout)')
+    parser.add_argument('--preload', choices=['lite', 'full', 'both'], help='Load BiRefNet models before accepting jobs')
+    parser.add_argument('--progress-interval', type=float, default=0.5, help='Minimum seconds between progress events')
+    parser.add_argument('--inference-backend', default='eager', choices=INFERENCE_BACKENDS,
+                        help='How BiRefNet runs (exported graphs come from model_export.py)')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='Precision of the exported graph to load')
+    parser.add_argument('--threads', type=int,
+                        help='Fixed intra-op threads for exported (ONNX/TorchScript) runtimes; eager jobs use their reservation')
+    parser.add_argument('--cpu-threads', type=int, help='CPU threads shared by running jobs (default: all cores)')
+    parser.add_argument('--memory-mb', type=float, help='Memory shared by running jobs (default: 80%% of available memory)')
+    parser.add_argument('--max-jobs', type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                        help='Most jobs running at once, each in its own warm process')
+
+    args = parser.parse_args()
+
+    settings = {
+        "inference_backend": args.inference_backend,
+        "precision": args.precision,
+        "threads": args.threads,
+        "progress_interval": args.progress_interval,
+    }
+
+    # Keep stdout for protocol events only; backend logging goes to stderr
+    worker = WorkerDaemon(events=sys.stdout, settings=settings, cpu_threads=args.cpu_threads,
+                          memory_mb=args.memory_mb, max_jobs=args.max_jobs)
+    with redirect_stdout(sys.stderr):
+        if args.preload in ('lite', 'both'):
+            worker.handle({"command": "preload", "fast_mode": True})
+        if args.preload in ('full', 'both'):
+            worker.handle({"command": "preload", "fast_mode": False})
+        worker.serve(sys.stdin)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the background removal backends
+Renders synthetic green-screen clips with known masks and reports fps, per-stage latency, peak RSS and mask IoU as JSON
+"""
+
+import sys
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+BACKENDS = ("birefnet", "simple", "opencv")
+
+# Pure green field the synthetic shape moves over (RGB)
+FIELD_COLOR = (0, 255, 0)
+
+# Composited background used by every run; solid colour keeps every backend on the same path
+BENCHMARK_BACKGROUND = "#3050a0"
+
+def shape_at(index, frame_count, width, height):
+    """Centre and radii of the moving ellipse in frame index"""
+    t = index / max(frame_count - 1, 1)
+    rx = max(width // 8, 4)
+    ry = max(height // 4, 4)
+    # One left-right sweep with a vertical bob so consecutive frames differ
+    cx = int(rx + t * (width - 2 * rx))
+    cy = int(height / 2 + np.sin(t * 2 * np.pi) * (height / 2 - ry - 1))
+    return (cx, cy), (rx, ry)
+
+def ground_truth_mask(index, frame_count, width, height):
+    """HxW bool mask of the foreground shape in frame index"""
+    import cv2
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    center, axes = shape_at(index, frame_count, width, height)
+    cv2.ellipse(mask, center, axes, 0, 0, 360, 255, -1)
+    return mask > 0
+
+def make_synthetic_video(path, width, height, frame_count, fps=24):
+    """Write a clip of a textured ellipse moving over a flat green field"""
+    import cv2
+    from video_io import FFmpegVideoWriter
+
+    # Colourful, non-green texture so the segmentation models see an object
+    yy, xx = np.mgrid[0:height, 0:width]
+    texture = np.empty((height, width, 3), dtype=np.uint8)
+    texture[..., 0] = 180 + (xx * 7 % 64)
+    texture[..., 1] = 40 + ((xx + yy) * 3 % 48)
+    texture[..., 2] = 60 + (yy * 5 % 128)
+
+    writer = FFmpegVideoWriter(path, width, height, fps, extra_args=["-crf", "12", "-preset", "veryfast"])
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    try:
+        for i in range(frame_count):
+            frame[:] = FIELD_COLOR
+            mask = ground_truth_mask(i, frame_count, width, height)
+            frame[mask] = texture[mask]
+            center, axes = shape_at(i, frame_count, width, height)
+            cv2.ellipse(frame, center, (axes[0] // 2, axes[1] // 3), 0, 0, 360, (250, 230, 60), -1)
+            writer.write(frame)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+def mask_iou(matte_path, frame_count, width, height, threshold=128):
+    """Mean and minimum IoU of a matte stream against the synthetic ground truth"""
+    from video_io import FFmpegVideoReader
+
+    ious = []
+    for i, matte in enumerate(FFmpegVideoReader(matte_path, pix_fmt="gray").iter_frames()):
+        predicted = matte >= threshold
+        truth = ground_truth_mask(i, frame_count, width, height)
+        union = np.count_nonzero(predicted | truth)
+        ious.append(np.count_nonzero(predicted & truth) / union if union else 1.0)
+    if not ious:
+        return None
+    return {"mean": round(float(np.mean(ious)), 4), "min": round(float(np.min(ious)), 4), "frames": len(ious)}
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where it cannot be read)
+
+    Linux carries ru_maxrss over fork and exec, so the peak is read from
+    VmHWM when /proc is available. Child processes (ffmpeg, pool workers)
+    are not included: RUSAGE_CHILDREN only reports the largest single one.
+    """
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    own = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return round(own, 1)
+
+def scenario_name(scenario):
+    params = ",".join(f"{key}={value}" for key, value in sorted(scenario["params"].items()))
+    return f"{scenario['backend']}[{scenario['resolution']}{',' + params if params else ''}]"
+
+def build_scenarios(backends, resolutions, modes, batch_sizes, inference_sizes, inference_backends, workers, roi_modes=(False,)):
+    """Cross product of the requested settings for each backend"""
+    scenarios = []
+    for resolution in resolutions:
+        if "birefnet" in backends:
+            for mode in modes:
+                for batch_size in batch_sizes:
+                    for inference_size in inference_sizes:
+                        for inference_backend in inference_backends:
+                            for roi in roi_modes:
+                                scenarios.append({"backend": "birefnet", "resolution": resolution, "params": {
+                                    "mode": mode, "batch_size": batch_size,
+                                    "inference_size": inference_size, "inference_backend": inference_backend,
+                                    "roi": roi,
+                                }})
+        if "simple" in backends:
+            for count in workers:
+                for roi in roi_modes:
+                    scenarios.append({"backend": "simple", "resolution": resolution, "params": {"workers": count, "roi": roi}})
+        if "opencv" in backends:
+            for count in workers:
+                scenarios.append({"backend": "opencv", "resolution": resolution, "params": {"workers": count}})
+    return scenarios
+
+def run_backend(scenario, input_path, output_path, matte_path, timer):
+    """Run one backend on input_path, returning its success flag"""
+    params = scenario["params"]
+    common = dict(background_type="color", background_value=BENCHMARK_BACKGROUND, matte_output=matte_path)
+
+    if scenario["backend"] == "birefnet":
+        from background_remover import process_video
+        return process_video(
+            input_path, output_path,
+            fast_mode=params["mode"] == "fast",
+            batch_size=params["batch_size"],
+            inference_size=params["inference_size"],
+            roi=params["roi"],
+            use_cache=False, timer=timer, **common
+        )
+    if scenario["backend"] == "simple":
+        from background_remover_simple import process_video_simple
+        return process_video_simple(input_path, output_path, workers=params["workers"], roi=params["roi"],
+                                    use_cache=False, timer=timer, **common)
+    from background_remover_opencv import remove_background_opencv
+    return remove_background_opencv(input_path, output_path, workers=params["workers"], timer=timer, **common)
+
+def warm_up(scenario):
+    """Load the model outside the timed run so fps reflects steady-state throughput"""
+    params = scenario["params"]
+    if scenario["backend"] == "birefnet":
+        from background_remover import load_runner
+        from model_registry import get_registry
+        get_registry().backend = params["inference_backend"]
+        load_runner(params["mode"] == "fast", params["inference_size"])
+    elif scenario["backend"] == "simple" and params["workers"] == 1:
+        # Pool workers load their own session, which is part of what the run measures
+        from background_remover_simple import get_session
+        get_session()
+
+def run_scenario(scenario, input_path, frame_count):
+    """Run one scenario in this process and return its result dict"""
+    from instrumentation import StageTimer
+
+    width, height = (int(v) for v in scenario["resolution"].split("x"))
+    work_dir = tempfile.mkdtemp(prefix="aebg-bench-")
+    result = {"name": scenario_name(scenario), "backend": scenario["backend"], "resolution": scenario["resolution"],
+              "params": scenario["params"], "frames": frame_count}
+    try:
+        output_path = os.path.join(work_dir, "output.mp4")
+        matte_path = os.path.join(work_dir, "matte.mp4")
+
+        start = time.perf_counter()
+        warm_up(scenario)
+        result["load_s"] = round(time.perf_counter() - start, 3)
+
+        timer = StageTimer()
+        start = time.perf_counter()
+        success = run_backend(scenario, input_path, output_path, matte_path, timer)
+        elapsed = time.perf_counter() - start
+
+        result["success"] = bool(success)
+        result["wall_s"] = round(elapsed, 3)
+        result["fps"] = round(frame_count / elapsed, 2) if elapsed else None
+        # Writing the matte is benchmark overhead, not part of a normal job
+        matte_s = timer.totals.get("matte", 0.0)
+        result["fps_without_matte"] = round(frame_count / (elapsed - matte_s), 2) if elapsed > matte_s else None
+        result["stages"] = timer.summary()
+        if success:
+            result["iou"] = mask_iou(matte_path, frame_count, width, height)
+    except Exception as e:
+        result["success"] = False
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def run_isolated(scenario, input_path, frame_count, timeout=None):
+    """Run a scenario in a fresh interpreter so peak RSS and model caches are per scenario"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-scenario", json.dumps(scenario),
+           "--input", input_path, "--frames", str(frame_count)]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {"name": scenario_name(scenario), "backend": scenario["backend"], "resolution": scenario["resolution"],
+                "params": scenario["params"], "success": False, "error": f"Timed out after {timeout}s"}
+
+    lines = proc.stdout.decode(errors="replace").strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        log = proc.stderr.decode(errors="replace").strip().splitlines()
+        return {"name": scenario_name(scenario), "backend": scenario["backend"], "resolution": scenario["resolution"],
+                "params": scenario["params"], "success": False,
+                "error": f"Scenario exited with code {proc.returncode}: {' | '.join(log[-5:])}"}
+
+def environment_info():
+    """Versions and CPU count; never imports torch so the scenarios inherit a small parent"""
+    from importlib import metadata
+
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    for package in ("torch", "onnxruntime", "opencv-python", "rembg"):
+        try:
+            info[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            pass
+    return info
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(",") if item]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the background removal backends on synthetic clips')
+    parser.add_argument('--backends', default=",".join(BACKENDS), help='Comma-separated backends to run (birefnet, simple, opencv)')
+    parser.add_argument('--resolutions', default='640x360,1280x720', help='Comma-separated WIDTHxHEIGHT clip sizes')
+    parser.add_argument('--frames', type=int, default=48, help='Frames per synthetic clip')
+    parser.add_argument('--fps', type=int, default=24, help='Frame rate of the synthetic clips')
+    parser.add_argument('--modes', default='fast,full', help='BiRefNet modes: fast (lite) and/or full')
+    parser.add_argument('--batch-sizes', default='1,4', help='BiRefNet batch sizes')
+    parser.add_argument('--inference-sizes', default='1024', help='BiRefNet inference resolutions')
+    parser.add_argument('--inference-backends', default='eager', help='BiRefNet inference backends (eager, torchscript, onnx)')
+    parser.add_argument('--workers', default='1,4', help='Worker counts for the rembg and OpenCV backends')
+    parser.add_argument('--roi', default='off', choices=['off', 'on', 'both'], help='Run BiRefNet and rembg with subject ROI tracking')
+    parser.add_argument('--timeout', type=int, default=3600, help='Seconds before a scenario is abandoned')
+    parser.add_argument('--output', help='Write the JSON report here (default: stdout)')
+    parser.add_argument('--keep-videos', help='Keep the synthetic clips in this directory')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--input', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        # Child mode: backend logging goes to stderr, the result is the last stdout line
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run_scenario(json.loads(args.run_scenario), args.input, args.frames)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    backends = parse_list(args.backends)
+    unknown = set(backends) - set(BACKENDS)
+    if unknown:
+        parser.error(f"Unknown backends: {', '.join(sorted(unknown))}")
+
+    scenarios = build_scenarios(
+        backends, parse_list(args.resolutions), parse_list(args.modes),
+        parse_list(args.batch_sizes, int), parse_list(args.inference_sizes, int),
+        parse_list(args.inference_backends), parse_list(args.workers, int),
+        {'off': (False,), 'on': (True,), 'both': (False, True)}[args.roi]
+    )
+
+    video_dir = args.keep_videos or tempfile.mkdtemp(prefix="aebg-bench-videos-")
+    os.makedirs(video_dir, exist_ok=True)
+    report = {"environment": environment_info(), "frames": args.frames, "fps": args.fps, "results": []}
+    try:
+        videos = {}
+        for resolution in parse_list(args.resolutions):
+            width, height = (int(v) for v in resolution.split("x"))
+            videos[resolution] = os.path.join(video_dir, f"synthetic_{resolution}.mp4")
+            print(f"Rendering synthetic clip {resolution} ({args.frames} frames)...", file=sys.stderr)
+            make_synthetic_video(videos[resolution], width, height, args.frames, args.fps)
+
+        for i, scenario in enumerate(scenarios, 1):
+            print(f"[{i}/{len(scenarios)}] {scenario_name(scenario)}", file=sys.stderr)
+            result = run_isolated(scenario, videos[scenario["resolution"]], args.frames, args.timeout)
+            if result.get("success"):
+                iou = result.get("iou") or {}
+                print(f"    {result['fps']} fps, IoU {iou.get('mean')}", file=sys.stderr)
+            else:
+                print(f"    FAILED: {result.get('error', 'backend reported failure')}", file=sys.stderr)
+            report["results"].append(result)
+    finally:
+        if not args.keep_videos:
+            shutil.rmtree(video_dir, ignore_errors=True)
+
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    else:
+        print(encoded)
+
+    sys.exit(0 if all(result.get("success") for result in report["results"]) else 1)
+
+if __name__ == "__main__":
+    main()
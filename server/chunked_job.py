@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Chunked, resumable background removal jobs
+The input is split at keyframes into segments that are processed (optionally in parallel), checkpointed in a manifest and concatenated losslessly
+"""
+
+import sys
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from instrumentation import ProgressReporter, StageTimer
+from matte_cache import file_digest
+from model_registry import configure_registry, get_registry
+from parallel import limit_threads
+from video_io import (OUTPUT_FORMATS, add_encoder_arguments, audio_codec_for, encoder_options, get_ffmpeg_exe,
+                      output_format_for, popen_flags, probe_video)
+
+BACKENDS = ("birefnet", "simple", "opencv")
+
+# Bump when the manifest layout changes; older work directories are started over
+MANIFEST_VERSION = 1
+DEFAULT_SEGMENT_SECONDS = 10
+
+def backend_function(backend):
+    """The process function of a backend; all of them share the input/output/background arguments"""
+    if backend == "birefnet":
+        from background_remover import process_video
+        return process_video
+    if backend == "simple":
+        from background_remover_simple import process_video_simple
+        return process_video_simple
+    if backend == "opencv":
+        from background_remover_opencv import remove_background_opencv
+        return remove_background_opencv
+    raise ValueError(f"Unknown backend: {backend}")
+
+def default_work_dir(output_path):
+    """Hidden work directory next to the output, so rerunning the same job finds it"""
+    directory, name = os.path.split(os.path.abspath(output_path))
+    return os.path.join(directory, f".{name}.segments")
+
+def run_ffmpeg(args):
+    """Run ffmpeg with the given arguments, raising IOError with its log on failure"""
+    cmd = [get_ffmpeg_exe(), "-y", "-loglevel", "error", "-nostdin"] + args
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, creationflags=popen_flags())
+    if result.returncode != 0:
+        raise IOError(f"ffmpeg exited with code {result.returncode}: {result.stderr.decode(errors='replace').strip()}")
+
+def split_input(input_path, segments_dir, segment_seconds):
+    """Split the video stream at keyframes into segments of about segment_seconds
+
+    Stream copy (no re-encoding) means every cut lands on a keyframe, so
+    segments are GOP aligned and decode independently. Returns
+    [(path, start, end)] in order.
+    """
+    os.makedirs(segments_dir, exist_ok=True)
+    segment_list = os.path.join(segments_dir, "segments.csv")
+    run_ffmpeg([
+        "-i", input_path,
+        "-map", "0:v:0",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_time", str(segment_seconds),
+        "-reset_timestamps", "1",
+        "-segment_list", segment_list,
+        "-segment_list_type", "csv",
+        os.path.join(segments_dir, "source_%05d.mkv"),
+    ])
+
+    segments = []
+    with open(segment_list) as f:
+        for line in f:
+            name, start, end = line.strip().rsplit(",", 2)
+            segments.append((os.path.join(segments_dir, name.strip('"')), float(start), float(end)))
+    return segments
+
+def concat_segments(paths, output_path, list_path, audio_source=None, audio_codec=None, audio_duration=None):
+    """Join segments encoded with identical settings without re-encoding them
+
+    With audio_source, its first audio track is muxed back in (encoded with
+    audio_codec, or stream-copied for "copy"), since the segments only
+    carry video. Every video frame is kept; audio_duration bounds only the
+    audio, as in FFmpegVideoWriter.
+    """
+    with open(list_path, "w") as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    args = ["-f", "concat", "-safe", "0", "-i", list_path]
+    if audio_source and audio_codec:
+        if audio_duration:
+            args += ["-t", f"{audio_duration}"]
+        args += ["-i", audio_source, "-map", "0:v:0", "-map", "1:a:0?", "-c:a", audio_codec]
+    args += ["-c:v", "copy", output_path]
+    run_ffmpeg(args)
+
+def init_segment_process(log_to_stderr, registry_config, threads=None):
+    """Pool initializer of the segment processes
+
+    The model registry is set up like the parent's (inference backend,
+    precision, threads, weights), and stdout follows the parent when it is
+    kept free of logging (e.g. in the worker daemon). threads caps the
+    process's thread pools and, unless the registry pins a fixed count,
+    those of its inference runtime.
+    """
+    if log_to_stderr:
+        sys.stdout = sys.stderr
+    registry = configure_registry(registry_config)
+    if threads and not registry.threads:
+        registry.threads = threads
+    limit_threads(threads)
+
+def run_segment(backend, source, output, matte, options):
+    """Process one segment; returns (success, frames, timings)
+
+    Module level so it can run in a pool process. Progress events of the
+    segment are swallowed; the job reports progress over all segments.
+    """
+    frames = [0]
+
+    def count_frames(frame_count, total_frames):
+        frames[0] = frame_count
+
+    timer = StageTimer()
+    reporter = ProgressReporter(timer, emit=lambda event: None)
+    success = backend_function(backend)(
+        source, output,
+        progress_callback=count_frames,
+        matte_output=matte,
+        reporter=reporter,
+        **options
+    )
+    return bool(success), frames[0], timer.state()
+
+class SegmentManifest:
+    """JSON checkpoint of a chunked job: its settings and the state of every segment"""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = None
+        return self.data
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def segments(self):
+        return self.data["segments"]
+
+    def pending(self):
+        """Segments not finished yet (or whose output went missing)"""
+        return [
+            segment for segment in self.segments
+            if segment["status"] != "done" or not os.path.exists(segment["output"])
+            or (segment["matte"] and not os.path.exists(segment["matte"]))
+        ]
+
+    def mark_done(self, segment, frames):
+        segment["status"] = "done"
+        segment["frames"] = frames
+        self.save()
+
+def process_video_chunked(input_path, output_path, background_type="transparent", background_value=None, backend="birefnet",
+                          segment_seconds=DEFAULT_SEGMENT_SECONDS, processes=1, process_threads=None, work_dir=None,
+                          keep_work_dir=False, output_format=None, matte_output=None, progress_callback=None,
+                          reporter=None, **options):
+    """Run a background removal job in resumable, keyframe-aligned segments
+
+    The input video is cut (without re-encoding) into segments of about
+    segment_seconds, each processed by the chosen backend into its own
+    output (and matte) file in work_dir, next to a manifest.json that
+    records which segments are done. Rerunning the same job with the same
+    settings skips the finished segments; a changed input or setting starts
+    over. With processes > 1 segments are processed in that many processes at
+    once, each with its thread pools capped at process_threads. The finished segments are concatenated losslessly (stream copy)
+    and the input's audio is muxed back in. options are passed to the
+    backend (fast_mode, batch_size, model_name, key_color, ...).
+    """
+    if reporter is None:
+        reporter = ProgressReporter()
+    try:
+        if backend not in BACKENDS:
+            print(f"ERROR: Unknown backend: {backend}")
+            return False
+        output_format = output_format or output_format_for(output_path)
+        if output_format not in OUTPUT_FORMATS or output_format == "png":
+            print(f"ERROR: Chunked jobs need a video output format (mp4, webm or mov), not {output_format}")
+            return False
+        if matte_output and output_format_for(matte_output) == "png":
+            print("ERROR: Chunked jobs need a video matte output (.mp4, .mkv or .mov)")
+            return False
+
+        work_dir = work_dir or default_work_dir(output_path)
+        os.makedirs(work_dir, exist_ok=True)
+        manifest = SegmentManifest(os.path.join(work_dir, "manifest.json"))
+        info = probe_video(input_path)
+
+        settings = {
+            "backend": backend,
+            "background_type": background_type,
+            "background_value": background_value,
+            "output_format": output_format,
+            "matte": bool(matte_output),
+            "segment_seconds": segment_seconds,
+            # Encoder threads do not change what is encoded, so a resumed job may use others
+            "options": dict(options, encoder={key: value for key, value in (options.get("encoder") or {}).items()
+                                              if key != "threads"}),
+        }
+        digest = file_digest(input_path)
+        data = manifest.load()
+        if data and data.get("version") == MANIFEST_VERSION and data.get("input_digest") == digest \
+                and data.get("settings") == settings:
+            done = len(manifest.segments) - len(manifest.pending())
+            print(f"Resuming chunked job: {done}/{len(manifest.segments)} segments already done")
+        else:
+            if data:
+                print("Work directory belongs to another input or settings, starting over")
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+            print(f"Splitting {input_path} into ~{segment_seconds}s segments...")
+            segments = []
+            for index, (source, start, end) in enumerate(split_input(input_path, os.path.join(work_dir, "source"), segment_seconds)):
+                segments.append({
+                    "index": index,
+                    "source": source,
+                    "start": start,
+                    "end": end,
+                    "output": os.path.join(work_dir, f"segment_{index:05d}.{output_format}"),
+                    "matte": os.path.join(work_dir, f"segment_{index:05d}_matte.mp4") if matte_output else None,
+                    "status": "pending",
+                    "frames": None,
+                })
+            manifest.data = {
+                "version": MANIFEST_VERSION,
+                "input": os.path.abspath(input_path),
+                "input_digest": digest,
+                "settings": settings,
+                "created": time.time(),
+                "segments": segments,
+            }
+            manifest.save()
+            print(f"Split into {len(segments)} segments")
+
+        # Progress over the whole job, counting the frames of finished segments
+        total_frames = max(1, info["estimated_frames"])
+        pending = manifest.pending()
+        done_frames = sum(segment["frames"] or 0 for segment in manifest.segments if segment not in pending)
+        reporter.start(total_frames)
+        segment_options = dict(options, background_type=background_type, background_value=background_value,
+                               output_format=output_format)
+        if backend != "opencv":
+            # Segments are cut fresh for each job, so their masks would never be looked up again
+            segment_options["use_cache"] = False
+
+        def segment_progress(frame_count, segment_total):
+            if progress_callback:
+                progress_callback(done_frames + frame_count, total_frames)
+            reporter.update(done_frames + frame_count)
+
+        def finish_segment(segment, frames, timings):
+            nonlocal done_frames
+            reporter.timer.merge(timings)
+            manifest.mark_done(segment, frames)
+            done_frames += frames
+            print(f"Segment {segment['index'] + 1}/{len(manifest.segments)} done ({frames} frames)")
+            if progress_callback:
+                progress_callback(done_frames, total_frames)
+            reporter.update(done_frames)
+
+        if processes > 1 and len(pending) > 1:
+            print(f"Processing {len(pending)} segments on {processes} processes")
+            with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=init_segment_process,
+                                     initargs=(sys.stdout is not sys.__stdout__,
+                                               get_registry().config(), process_threads)) as executor:
+                futures = {
+                    executor.submit(run_segment, backend, segment["source"], segment["output"], segment["matte"],
+                                    segment_options): segment
+                    for segment in pending
+                }
+                try:
+                    for future in as_completed(futures):
+                        segment = futures[future]
+                        success, frames, timings = future.result()
+                        if not success:
+                            raise RuntimeError(f"Segment {segment['index'] + 1} failed")
+                        finish_segment(segment, frames, timings)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        else:
+            for segment in pending:
+                print(f"Processing segment {segment['index'] + 1}/{len(manifest.segments)}")
+                timer = StageTimer()
+                frames = [0]
+
+                def count_frames(frame_count, segment_total):
+                    frames[0] = frame_count
+                    segment_progress(frame_count, segment_total)
+
+                success = backend_function(backend)(
+                    segment["source"], segment["output"],
+                    progress_callback=count_frames,
+                    matte_output=segment["matte"],
+                    reporter=ProgressReporter(timer, emit=lambda event: None),
+                    **segment_options
+                )
+                if not success:
+                    raise RuntimeError(f"Segment {segment['index'] + 1} failed")
+                finish_segment(segment, frames[0], timer.state())
+
+        # Join the segments; video is stream-copied, audio comes from the input
+        print("Concatenating segments...")
+        concat_segments(
+            [segment["output"] for segment in manifest.segments], output_path,
+            os.path.join(work_dir, "concat.txt"),
+            audio_source=input_path if info["has_audio"] else None,
+            audio_codec=audio_codec_for(input_path, output_format) if info["has_audio"] else None,
+            audio_duration=info["duration"]
+        )
+        if matte_output:
+            concat_segments([segment["matte"] for segment in manifest.segments], matte_output,
+                            os.path.join(work_dir, "concat_matte.txt"))
+            print(f"Matte written to: {matte_output}")
+
+        reporter.finish(done_frames)
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"SUCCESS: Video processed successfully: {output_path}")
+        return True
+
+    except Exception as e:
+        print(f"ERROR: {e}")
+        print(f"Finished segments are kept in {work_dir}; rerun the same job to resume")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove the background of a video in resumable segments')
+    parser.add_argument('--input', required=True, help='Input video path')
+    parser.add_argument('--output', required=True, help='Output video path (.mp4, .webm or .mov)')
+    parser.add_argument('--backend', default='birefnet', choices=BACKENDS)
+    parser.add_argument('--background-type', default='transparent', choices=['transparent', 'color', 'image'])
+    parser.add_argument('--background-value', help='Background color (hex) or image path')
+    parser.add_argument('--segment-seconds', type=float, default=DEFAULT_SEGMENT_SECONDS,
+                        help='Target segment length; cuts land on the next keyframe')
+    parser.add_argument('--processes', type=int, default=1, help='Segments processed at once, each in its own process')
+    parser.add_argument('--work-dir', help='Directory for segments and the manifest (default: next to the output)')
+    parser.add_argument('--keep-work-dir', action='store_true', help='Keep the segments after concatenating them')
+    parser.add_argument('--output-format', choices=sorted(fmt for fmt in OUTPUT_FORMATS if fmt != 'png'),
+                        help='Output container (default: from the output extension)')
+    parser.add_argument('--matte-output', help='Also write the mask-only matte stream to this path')
+    parser.add_argument('--options', default='{}',
+                        help='JSON object of extra backend arguments, e.g. {"fast_mode": true, "batch_size": 4}')
+    add_encoder_arguments(parser)
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='Minimum seconds between JSON progress events')
+
+    args = parser.parse_args()
+
+    try:
+        options = json.loads(args.options)
+    except ValueError as e:
+        parser.error(f"--options is not valid JSON: {e}")
+    if encoder_options(args):
+        options["encoder"] = encoder_options(args)
+
+    success = process_video_chunked(
+        args.input,
+        args.output,
+        backend=args.backend,
+        background_type=args.background_type,
+        background_value=args.background_value,
+        segment_seconds=args.segment_seconds,
+        processes=max(1, args.processes),
+        work_dir=args.work_dir,
+        keep_work_dir=args.keep_work_dir,
+        output_format=args.output_format,
+        matte_output=args.matte_output,
+        reporter=ProgressReporter(interval=args.progress_interval),
+        **options
+    )
+
+    if success:
+        print("SUCCESS")
+        sys.exit(0)
+    else:
+        print("FAILED")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
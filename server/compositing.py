@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Vectorized alpha compositing shared by the background removers
+The background is prepared once per job and every frame is blended in place
+"""
+
+import os
+
+import numpy as np
+
+def parse_hex_color(value):
+    """Convert '#rrggbb' into an (r, g, b) tuple"""
+    hex_color = value.lstrip('#')
+    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+
+def load_background_image(background, width, height):
+    """Load a background image (path or PIL Image) resized to the frame size as RGB"""
+    from PIL import Image
+
+    if not isinstance(background, Image.Image):
+        background = Image.open(background)
+    return np.asarray(background.convert('RGB').resize((width, height)))
+
+class Compositor:
+    """Alpha-blend frames over a background precomputed at the target resolution
+
+    Frames and backgrounds use the same channel order ("rgb" or "bgr"). Work
+    and output buffers are reused between calls, so the returned frame is
+    only valid until the next call to composite().
+    """
+
+    def __init__(self, width, height, background_type="transparent", background_value=None,
+                 channel_order="rgb", transparent_color=(255, 255, 255), keep_alpha=False):
+        self.width = width
+        self.height = height
+        self.channel_order = channel_order
+
+        # Prepare background
+        rgb = None
+        if background_type == "color" and background_value:
+            rgb = np.full((height, width, 3), parse_hex_color(background_value), dtype=np.uint8)
+        elif background_type == "image" and background_value is not None:
+            if isinstance(background_value, str) and not os.path.exists(background_value):
+                print(f"Warning: Background image not found: {background_value}")
+            else:
+                rgb = load_background_image(background_value, width, height)
+
+        # Transparent output keeps its alpha when the sink supports it (keep_alpha),
+        # otherwise it is flattened onto a solid colour
+        self.is_transparent = rgb is None
+        self.keeps_alpha = self.is_transparent and keep_alpha
+        self.channels = 4 if self.keeps_alpha else 3
+        if rgb is None:
+            rgb = np.full((height, width, 3), transparent_color, dtype=np.uint8)
+
+        if channel_order == "bgr":
+            rgb = rgb[:, :, ::-1]
+        self.background = np.ascontiguousarray(rgb, dtype=np.float32)
+
+        # Reused work buffers
+        self._alpha = np.empty((height, width, 1), dtype=np.float32)
+        self._work = np.empty((height, width, 3), dtype=np.float32)
+        self._out = np.empty((height, width, self.channels), dtype=np.uint8)
+
+    def apply(self, frame, alpha, out=None):
+        """Produce the output frame: frame plus alpha channel, or frame blended over the background"""
+        if self.keeps_alpha:
+            return self.attach_alpha(frame, alpha, out)
+        return self.composite(frame, alpha, out)
+
+    def passthrough(self, frame, out=None):
+        """Output an unprocessed frame (fully opaque) in the output layout
+        
+        Without an alpha channel the frame itself is returned, or copied
+        into out when one is given.
+        """
+        if not self.keeps_alpha:
+            if out is None:
+                return frame
+            np.copyto(out, frame)
+            return out
+        if out is None:
+            out = self._out
+        out[:, :, :3] = frame
+        out[:, :, 3] = 255
+        return out
+
+    def attach_alpha(self, frame, alpha, out=None):
+        """Return an HxWx4 frame with alpha (uint8 or float in [0, 1]) as the last channel
+
+        No blending is done; the matte is kept for downstream compositing.
+        """
+        if out is None:
+            out = self._out
+        out[:, :, :3] = frame
+        if alpha.dtype == np.uint8:
+            out[:, :, 3] = alpha
+        else:
+            np.multiply(alpha, 255.0, out=self._alpha[:, :, 0], casting='unsafe')
+            self._alpha += 0.5
+            np.copyto(out[:, :, 3], self._alpha[:, :, 0], casting='unsafe')
+        return out
+
+    def composite(self, frame, alpha, out=None):
+        """Blend an HxWx3 uint8 frame over the background
+
+        alpha is an HxW mask, either uint8 (0-255) or float in [0, 1].
+        """
+        if out is None:
+            out = self._out
+
+        alpha_f = self._alpha[:, :, 0]
+        if alpha.dtype == np.uint8:
+            np.multiply(alpha, np.float32(1.0 / 255.0), out=alpha_f)
+        else:
+            np.copyto(alpha_f, alpha, casting='same_kind')
+
+        # out = background + alpha * (frame - background)
+        work = self._work
+        np.subtract(frame, self.background, out=work)
+        work *= self._alpha
+        work += self.background
+        work += 0.5
+        np.copyto(out, work, casting='unsafe')
+        return out
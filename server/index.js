@@ -244,6 +244,168 @@ app.post('/api/process-video', upload.single('video'), async (req, res) => {
   }
 });
 
+// Persistent background removal worker (keeps Python, imports and models warm)
+let backgroundWorker = null;
+const backgroundJobs = new Map();
+
+function getBackgroundWorker() {
+  if (backgroundWorker) {
+    return backgroundWorker;
+  }
+
+  const worker = spawn('python', [path.join(__dirname, 'background_worker.py')],
+    { stdio: ['pipe', 'pipe', 'pipe'] }
+  );
+  let buffer = '';
+
+  // Events arrive as one JSON object per line
+  worker.stdout.on('data', (data) => {
+    buffer += data.toString();
+    let newline;
+    while ((newline = buffer.indexOf('\n')) >= 0) {
+      const line = buffer.slice(0, newline).trim();
+      buffer = buffer.slice(newline + 1);
+      if (!line) continue;
+
+      let message;
+      try {
+        message = JSON.parse(line);
+      } catch (parseError) {
+        console.log('Background worker stdout:', line);
+        continue;
+      }
+
+      const job = message.id && backgroundJobs.get(message.id);
+      if (job) {
+        job.onEvent(message);
+      } else if (message.event === 'ready') {
+        console.log(`Background worker pronto (pid ${message.pid})`);
+      }
+    }
+  });
+
+  // Job log lines also arrive as 'log' events tagged with their job id (see runBackgroundJob),
+  // so stderr is only echoed here and never attributed to whichever jobs happen to be pending
+  worker.stderr.on('data', (data) => {
+    console.log('Background worker stderr:', data.toString());
+  });
+
+  const failPendingJobs = (reason) => {
+    backgroundWorker = null;
+    for (const job of backgroundJobs.values()) {
+      job.onEvent({ event: 'error', id: job.id, error: reason });
+    }
+    backgroundJobs.clear();
+  };
+
+  worker.on('close', (code) => {
+    console.log(`Background worker process exited with code ${code}`);
+    failPendingJobs(`Worker de remoção de background finalizado (código ${code})`);
+  });
+
+  worker.on('error', (error) => {
+    console.error('Erro ao iniciar worker de remoção de background:', error);
+    failPendingJobs('Erro ao executar remoção de background: ' + error.message);
+  });
+
+  backgroundWorker = worker;
+  return worker;
+}
+
+function sendToBackgroundWorker(message) {
+  getBackgroundWorker().stdin.write(JSON.stringify(message) + '\n');
+}
+
+// Submit a job to the worker; resolves with the final result event
+// (plus the per-stage timing summary from the 'stages' event)
+function runBackgroundJob(job, onProgress) {
+  return new Promise((resolve, reject) => {
+    const entry = {
+      id: job.id,
+      logs: '',
+      stats: null,
+      onEvent: (message) => {
+        if (message.event === 'progress') {
+          if (onProgress) onProgress(message);
+        } else if (message.event === 'log') {
+          entry.logs += message.text + '\n';
+        } else if (message.event === 'accepted' || message.event === 'queued') {
+          const position = message.event === 'accepted' ? message.queued : message.position;
+          if (position > 0) {
+            console.log(`Background removal ${job.id}: posição ${position} na fila, ` +
+              `início em ~${message.start_s}s, conclusão em ~${message.eta_s}s`);
+          }
+        } else if (message.event === 'stages') {
+          entry.stats = message;
+        } else if (message.event === 'result') {
+          backgroundJobs.delete(job.id);
+          resolve({ ...message, logs: entry.logs, stats: entry.stats });
+        } else if (message.event === 'error') {
+          backgroundJobs.delete(job.id);
+          reject(new Error(message.error));
+        }
+      }
+    };
+    backgroundJobs.set(job.id, entry);
+
+    try {
+      sendToBackgroundWorker(job);
+    } catch (error) {
+      backgroundJobs.delete(job.id);
+      reject(error);
+    }
+  });
+}
+
+// Ask the worker for its scheduler metrics (queue length, reserved threads/memory, throughput)
+function getBackgroundMetrics() {
+  return new Promise((resolve, reject) => {
+    const id = `metrics-${Date.now()}-${Math.round(Math.random() * 1E9)}`;
+    backgroundJobs.set(id, {
+      id: id,
+      logs: '',
+      onEvent: (message) => {
+        backgroundJobs.delete(id);
+        if (message.event === 'metrics') {
+          const { event, id: _id, ...metrics } = message;
+          resolve(metrics);
+        } else {
+          reject(new Error(message.error || 'Resposta inesperada do worker'));
+        }
+      }
+    });
+
+    try {
+      sendToBackgroundWorker({ command: 'metrics', id: id });
+    } catch (error) {
+      backgroundJobs.delete(id);
+      reject(error);
+    }
+  });
+}
+
+app.get('/api/background-queue', async (req, res) => {
+  try {
+    res.json(await getBackgroundMetrics());
+  } catch (error) {
+    res.status(500).json({ error: 'Erro ao consultar fila de remoção de background: ' + error.message });
+  }
+});
+
+// Check once whether rembg is available to choose the worker backend
+let rembgAvailable = null;
+function checkRembg() {
+  if (rembgAvailable !== null) {
+    return Promise.resolve(rembgAvailable);
+  }
+  return new Promise((resolve) => {
+    exec('python -c "import rembg; print(\'OK\')"', (error, stdout, stderr) => {
+      rembgAvailable = !error;
+      resolve(rembgAvailable);
+    });
+  });
+}
+
 // Background removal endpoint
 app.post('/api/remove-background', uploadMultiple.fields([
   { name: 'video', maxCount: 1 },
@@ -258,69 +420,86 @@ app.post('/api/remove-background', uploadMultiple.fields([
     const options = JSON.parse(req.body.options || '{}');
     
     const outputDir = path.join(__dirname, 'uploads', 'processed');
-    const outputPath = path.join(outputDir, `background-removed-${Date.now()}.mp4`);
+    // Transparent output keeps its alpha channel in WebM (VP9); MP4 has no alpha
+    const backgroundType = options.backgroundType || 'transparent';
+    const outputExtension = backgroundType === 'transparent' ? '.webm' : '.mp4';
+    const outputPath = path.join(outputDir, `background-removed-${Date.now()}${outputExtension}`);
     
     // Create output directory if it doesn't exist
     if (!fs.existsSync(outputDir)) {
       fs.mkdirSync(outputDir, { recursive: true });
     }
 
-    // Prepare Python script arguments
-    let pythonScript = path.join(__dirname, 'background_remover_simple.py');
-    
-    // Check if rembg is available, otherwise use OpenCV fallback
-    const rembgCheck = await new Promise((resolve) => {
-      exec('python -c "import rembg; print(\'OK\')"', (error, stdout, stderr) => {
-        resolve(!error);
-      });
-    });
-    
-    if (!rembgCheck) {
+    // Use rembg if available, otherwise the OpenCV fallback
+    let backend = 'simple';
+    if (!(await checkRembg())) {
       console.log('rembg not available, using OpenCV fallback');
-      pythonScript = path.join(__dirname, 'background_remover_opencv.py');
+      backend = 'opencv';
     }
     
-    const pythonArgs = [
-      pythonScript,
-      '--input', inputPath,
-      '--output', outputPath,
-      '--background-type', options.backgroundType || 'transparent',
-    ];
+    const job = {
+      id: `bg-${Date.now()}-${Math.round(Math.random() * 1E9)}`,
+      backend: backend,
+      input: inputPath,
+      output: outputPath,
+      background_type: backgroundType
+    };
 
     // Add background value if specified
     if (options.backgroundType === 'color' && options.backgroundColor) {
-      pythonArgs.push('--background-value', options.backgroundColor);
+      job.background_value = options.backgroundColor;
     } else if (options.backgroundType === 'image' && req.files.backgroundImage) {
-      pythonArgs.push('--background-value', req.files.backgroundImage[0].path);
+      job.background_value = req.files.backgroundImage[0].path;
     }
 
-    console.log('Executando remoção de background (versão simples):', 'python', pythonArgs.join(' '));
-    
-    // Execute Python script
-    const pythonProcess = spawn('python', pythonArgs, 
-      { stdio: ['pipe', 'pipe', 'pipe'] }
-    );
+    // Long videos: process in segments, optionally spread over several processes
+    if (options.segmentSeconds) {
+      job.segment_seconds = Number(options.segmentSeconds);
+      job.segment_processes = Number(options.segmentProcesses || 1);
+    }
 
-    let stdout = '';
-    let stderr = '';
+    console.log('Enviando job de remoção de background ao worker:', JSON.stringify(job));
 
-    pythonProcess.stdout.on('data', (data) => {
-      stdout += data.toString();
-      console.log('Background remover stdout:', data.toString());
-    });
+    const cleanup = () => {
+      // Clean up input file after a delay
+      setTimeout(() => {
+        fs.unlink(inputPath, (unlinkError) => {
+          if (unlinkError) console.error('Erro ao remover arquivo temporário:', unlinkError);
+        });
+        
+        // Clean up background image if uploaded
+        if (req.files.backgroundImage) {
+          fs.unlink(req.files.backgroundImage[0].path, (unlinkError) => {
+            if (unlinkError) console.error('Erro ao remover imagem de background temporária:', unlinkError);
+          });
+        }
+      }, 5000);
+    };
 
-    pythonProcess.stderr.on('data', (data) => {
-      stderr += data.toString();
-      console.log('Background remover stderr:', data.toString());
-    });
+    // Set timeout for long-running processes
+    const timeout = setTimeout(() => {
+      sendToBackgroundWorker({ command: 'cancel', id: job.id });
+      if (!res.headersSent) {
+        res.status(500).json({ 
+          error: 'Timeout: Processamento demorou mais que 5 minutos' 
+        });
+      }
+    }, 5 * 60 * 1000); // 5 minutes
 
-    pythonProcess.on('close', (code) => {
-      console.log(`Background remover process exited with code ${code}`);
-      
-      if (code !== 0) {
-        console.error('Background remover error:', stderr);
+    runBackgroundJob(job, (progress) => {
+      const eta = progress.eta_s !== null && progress.eta_s !== undefined ? `, ETA ${progress.eta_s}s` : '';
+      console.log(`Background removal ${job.id}: ${progress.progress}% (${progress.frame}/${progress.total}) ` +
+        `${progress.fps} fps${eta}, ${progress.rss_mb} MB`);
+    }).then((result) => {
+      clearTimeout(timeout);
+      cleanup();
+      if (res.headersSent) return;
+
+      if (!result.success) {
         return res.status(500).json({ 
-          error: `Erro na remoção de background (código ${code}): ${stderr}` 
+          error: result.cancelled ?
+            'Remoção de background cancelada' :
+            `Erro na remoção de background: ${result.logs}` 
         });
       }
       
@@ -338,43 +517,18 @@ app.post('/api/remove-background', uploadMultiple.fields([
         success: true,
         videoUrl: videoUrl,
         message: 'Background removido com sucesso!',
-        logs: stdout
+        stats: result.stats,
+        logs: result.logs
       });
-      
-      // Clean up input file after a delay
-      setTimeout(() => {
-        fs.unlink(inputPath, (unlinkError) => {
-          if (unlinkError) console.error('Erro ao remover arquivo temporário:', unlinkError);
-        });
-        
-        // Clean up background image if uploaded
-        if (req.files.backgroundImage) {
-          fs.unlink(req.files.backgroundImage[0].path, (unlinkError) => {
-            if (unlinkError) console.error('Erro ao remover imagem de background temporária:', unlinkError);
-          });
-        }
-      }, 5000);
-    });
-
-    pythonProcess.on('error', (error) => {
-      console.error('Erro ao executar script de remoção de background:', error);
-      res.status(500).json({ 
-        error: 'Erro ao executar remoção de background: ' + error.message 
-      });
-    });
-
-    // Set timeout for long-running processes
-    const timeout = setTimeout(() => {
-      pythonProcess.kill();
+    }).catch((error) => {
+      clearTimeout(timeout);
+      cleanup();
+      console.error('Erro ao executar remoção de background:', error);
       if (!res.headersSent) {
         res.status(500).json({ 
-          error: 'Timeout: Processamento demorou mais que 5 minutos' 
+          error: 'Erro ao executar remoção de background: ' + error.message 
         });
       }
-    }, 5 * 60 * 1000); // 5 minutes
-
-    pythonProcess.on('close', () => {
-      clearTimeout(timeout);
     });
     
   } catch (error) {
@@ -550,6 +704,9 @@ const server = app.listen(PORT, '127.0.0.1', () => {
 // Graceful shutdown
 process.on('SIGINT', () => {
   console.log('\nFinalizando servidor...');
+  if (backgroundWorker) {
+    sendToBackgroundWorker({ command: 'shutdown' });
+  }
   server.close(() => {
     console.log('Servidor finalizado.');
     process.exit(0);
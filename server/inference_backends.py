@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Inference backends for BiRefNet
+Runs the eager PyTorch model or a graph exported by model_export.py (TorchScript or ONNX Runtime)
+"""
+
+import json
+import os
+
+INFERENCE_BACKENDS = ("eager", "torchscript", "onnx")
+PRECISIONS = ("fp32", "int8", "bf16")
+
+# File extension of the exported graph for each backend
+EXPORT_EXTENSIONS = {"torchscript": ".pt", "onnx": ".onnx"}
+
+def exported_path(models_dir, variant, backend, inference_size, precision="fp32"):
+    """Where model_export.py stores (and the registry looks for) an exported graph"""
+    name = f"birefnet-{variant}-{inference_size}-{precision}{EXPORT_EXTENSIONS[backend]}"
+    return os.path.join(models_dir, "exported", name)
+
+def read_export_info(path):
+    """Metadata written next to an exported graph (empty if missing)"""
+    try:
+        with open(path + ".json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def set_torch_threads(threads):
+    """Pin torch's intra-op thread pool (no-op when threads is None)"""
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+class EagerRunner:
+    """Run the PyTorch model as loaded by the registry
+
+    Uses torch's intra-op pool as the caller pinned it (e.g. per job in the
+    worker), so creating the runner never changes the thread count.
+    """
+
+    backend = "eager"
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, batch):
+        """Nx3xSxS normalised input -> Nx1xSxS foreground probabilities"""
+        return self.model(batch)[-1].sigmoid()
+
+class TorchScriptRunner:
+    """Run a TorchScript graph exported by model_export.py
+
+    The exported module already ends in a sigmoid. bf16 graphs get their
+    input cast to bfloat16 and their output cast back to float32.
+    """
+
+    backend = "torchscript"
+
+    def __init__(self, path, device="cpu", threads=None):
+        import torch
+
+        set_torch_threads(threads)
+        self.path = path
+        self.info = read_export_info(path)
+        self.dtype = torch.bfloat16 if self.info.get("precision") == "bf16" else torch.float32
+        # Dynamically quantized graphs only run on the CPU
+        self.device = "cpu" if self.info.get("precision") == "int8" else device
+        self.module = torch.jit.load(path, map_location=self.device)
+        self.module.eval()
+
+    def __call__(self, batch):
+        import torch
+
+        with torch.no_grad():
+            preds = self.module(batch.to(self.device, self.dtype))
+        return preds.float()
+
+class OnnxRunner:
+    """Run an ONNX graph exported by model_export.py with ONNX Runtime"""
+
+    backend = "onnx"
+
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.path = path
+        self.info = read_export_info(path)
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        import torch
+
+        inputs = batch.detach().float().cpu().numpy()
+        preds = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(preds)
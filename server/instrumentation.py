@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Pipeline instrumentation shared by the background removers
+Per-stage timing histograms, JSON-lines progress events (fps, ETA, memory) and optional profiling
+"""
+
+import sys
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (ms per frame) of the stage latency histogram buckets; one overflow bucket follows
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class StageTimer:
+    """Accumulate wall-clock seconds, frame counts and latency histograms per pipeline stage
+
+    Stages are free-form names. Every timed call also lands in a histogram
+    of its per-frame latency (see HISTOGRAM_BUCKETS_MS); calls that cover no
+    frames (flushes, commits) only add to the totals. Timers from pool
+    workers can be folded in with merge(), so stage totals may exceed the
+    wall time of a parallel run. Safe to share between pipeline threads.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.frames = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, frames=1):
+        """Record one timed call of a stage that covered frames frames"""
+        with self._lock:
+            self._add(stage, seconds, frames)
+
+    def _add(self, stage, seconds, frames):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+        self.frames[stage] = self.frames.get(stage, 0) + frames
+        histogram = self.histograms.setdefault(stage, [0] * (len(HISTOGRAM_BUCKETS_MS) + 1))
+        if frames:
+            histogram[bisect.bisect_left(HISTOGRAM_BUCKETS_MS, seconds / frames * 1000)] += frames
+
+    @contextmanager
+    def stage(self, stage, frames=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, frames)
+
+    def timed_iter(self, iterable, stage, frames=len):
+        """Yield from iterable, charging the time spent producing each item to stage
+
+        frames maps an item to the number of frames it holds (1 if None).
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, time.perf_counter() - start, frames(item) if frames else 1)
+            yield item
+
+    def state(self):
+        """Plain-dict snapshot that can be pickled back from a worker process"""
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        return {
+            "totals": dict(self.totals),
+            "counts": dict(self.counts),
+            "frames": dict(self.frames),
+            "histograms": {stage: list(histogram) for stage, histogram in self.histograms.items()},
+        }
+
+    def merge(self, state):
+        """Add the stages of another timer (or a state() snapshot of one)"""
+        if isinstance(state, StageTimer):
+            state = state.state()
+        with self._lock:
+            self._merge(state)
+
+    def _merge(self, state):
+        for stage, seconds in state["totals"].items():
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + state["counts"][stage]
+            self.frames[stage] = self.frames.get(stage, 0) + state["frames"][stage]
+            histogram = self.histograms.setdefault(stage, [0] * (len(HISTOGRAM_BUCKETS_MS) + 1))
+            for i, count in enumerate(state["histograms"][stage]):
+                histogram[i] += count
+
+    def ms_per_frame(self):
+        """{stage: mean milliseconds per frame}"""
+        with self._lock:
+            return {
+                stage: round(total / max(self.frames[stage], 1) * 1000, 3)
+                for stage, total in self.totals.items()
+            }
+
+    def summary(self):
+        """{stage: {"total_s", "calls", "frames", "ms_per_frame", "histogram"}}
+
+        histogram maps bucket labels ("<=20ms", ..., ">5000ms") to frame
+        counts, leaving out empty buckets.
+        """
+        labels = [f"<={bound}ms" for bound in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}ms"]
+        per_frame = self.ms_per_frame()
+        state = self.state()
+        return {
+            stage: {
+                "total_s": round(total, 4),
+                "calls": state["counts"][stage],
+                "frames": state["frames"][stage],
+                "ms_per_frame": per_frame[stage],
+                "histogram": {label: count for label, count in zip(labels, state["histograms"][stage]) if count},
+            }
+            for stage, total in state["totals"].items()
+        }
+
+def memory_mb():
+    """Current resident set size of this process in MB (None if unknown)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # No /proc (macOS): fall back to the peak, in bytes there
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2, 1)
+
+def write_event(fields, stream=None):
+    """Write one JSON-lines event (to stdout by default)"""
+    stream = stream or sys.stdout
+    stream.write(json.dumps(fields) + "\n")
+    stream.flush()
+
+class ProgressReporter:
+    """Turn frame counts and a StageTimer into throttled JSON-lines progress events
+
+    Each progress event carries the frame position, fps since start(), an
+    ETA, the current RSS and the mean ms per frame of every stage. finish()
+    emits one "stages" event with the full StageTimer summary. emit is
+    called with the event dict; by default it is written to stdout.
+    """
+
+    def __init__(self, timer=None, interval=1.0, emit=None):
+        self.timer = timer if timer is not None else StageTimer()
+        self.interval = interval
+        self.emit = emit or write_event
+        self.total_frames = 0
+        self._start = time.perf_counter()
+        self._last_emit = None
+        self._last_frame = None
+
+    def start(self, total_frames):
+        """Begin timing a run of (an estimated) total_frames frames"""
+        self.total_frames = total_frames
+        self._start = time.perf_counter()
+        self._last_emit = None
+        self._last_frame = None
+
+    def snapshot(self, frame_count):
+        """Progress fields for frame_count frames done"""
+        elapsed = time.perf_counter() - self._start
+        total = max(self.total_frames, frame_count)
+        fps = frame_count / elapsed if elapsed > 0 else 0.0
+        return {
+            "frame": frame_count,
+            "total": total,
+            "progress": round(min(frame_count / max(total, 1), 1.0) * 100, 1),
+            "fps": round(fps, 2),
+            "eta_s": round((total - frame_count) / fps, 1) if fps else None,
+            "elapsed_s": round(elapsed, 3),
+            "rss_mb": memory_mb(),
+            "stages": self.timer.ms_per_frame(),
+        }
+
+    def update(self, frame_count):
+        """Emit a progress event if interval seconds have passed (always on the last frame)"""
+        now = time.perf_counter()
+        if (self._last_emit is not None and now - self._last_emit < self.interval
+                and frame_count < self.total_frames):
+            return
+        self._last_emit = now
+        self._last_frame = frame_count
+        self.emit(dict(event="progress", **self.snapshot(frame_count)))
+
+    def finish(self, frame_count):
+        """Emit the final progress event (unless update() just did) and the per-stage summary"""
+        if frame_count != self._last_frame or frame_count != self.total_frames:
+            self.total_frames = frame_count
+            self.emit(dict(event="progress", **self.snapshot(frame_count)))
+        fields = self.snapshot(frame_count)
+        self.emit({
+            "event": "stages",
+            "frames": frame_count,
+            "elapsed_s": fields["elapsed_s"],
+            "fps": fields["fps"],
+            "rss_mb": fields["rss_mb"],
+            "stages": self.timer.summary(),
+        })
+
+@contextmanager
+def profiled(path):
+    """Profile the enclosed block and write the result to path (no-op without a path)
+
+    A .json path gets a torch profiler Chrome trace (chrome://tracing,
+    Perfetto) when torch is installed; anything else gets cProfile stats
+    readable with pstats or snakeviz.
+    """
+    if not path:
+        yield
+        return
+
+    if path.endswith(".json"):
+        try:
+            from torch.profiler import ProfilerActivity, profile
+        except ImportError:
+            print("torch is not installed, writing cProfile stats instead of a trace")
+        else:
+            activities = [ProfilerActivity.CPU]
+            import torch
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            with profile(activities=activities) as profiler:
+                yield
+            profiler.export_chrome_trace(path)
+            print(f"Profiler trace written to: {path}")
+            return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"cProfile stats written to: {path}")
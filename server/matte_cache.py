@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Content-addressed on-disk cache for segmentation mattes
+Rerendering the same upload with another background only composites the cached masks
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+
+def default_cache_dir():
+    """AEBG_MATTE_CACHE_DIR, else a per-user cache directory (never inside the source tree)"""
+    if os.environ.get("AEBG_MATTE_CACHE_DIR"):
+        return os.environ["AEBG_MATTE_CACHE_DIR"]
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "aebg", "mattes")
+
+DEFAULT_CACHE_DIR = default_cache_dir()
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+
+# Bump when the stored layout or the mask computation changes
+CACHE_VERSION = 1
+
+# Digests of files already hashed in this process, keyed by (path, size, mtime)
+_digests = {}
+_digests_lock = threading.Lock()
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's contents, memoised per (path, size, mtime)"""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        if memo_key in _digests:
+            return _digests[memo_key]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+
+    with _digests_lock:
+        _digests[memo_key] = digest.hexdigest()
+    return _digests[memo_key]
+
+class CachedMattes:
+    """Read side of one cache entry: iterate the HxW uint8 masks in frame order"""
+
+    def __init__(self, data_path, index):
+        self.data_path = data_path
+        self.width = index["width"]
+        self.height = index["height"]
+        self.frame_count = index["frames"]
+        self._offsets = index["offsets"]
+
+    def __len__(self):
+        return self.frame_count
+
+    def __iter__(self):
+        shape = (self.height, self.width)
+        with open(self.data_path, 'rb') as f:
+            for start, end in zip(self._offsets, self._offsets[1:]):
+                blob = f.read(end - start)
+                yield np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(shape)
+
+class MatteCacheWriter:
+    """Append masks to a new cache entry; it only becomes visible after commit()"""
+
+    def __init__(self, cache, key, width, height, level=1):
+        self.cache = cache
+        self.key = key
+        self.width = width
+        self.height = height
+        self.level = level
+        self.offsets = [0]
+
+        self._data_path, self._index_path = cache.paths(key)
+        self._tmp_path = f"{self._data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._file = open(self._tmp_path, 'wb')
+
+    def write(self, mask):
+        """Compress and append one HxW uint8 mask"""
+        blob = zlib.compress(np.ascontiguousarray(mask, dtype=np.uint8), self.level)
+        self._file.write(blob)
+        self.offsets.append(self.offsets[-1] + len(blob))
+
+    def commit(self, **metadata):
+        """Publish the entry, then trim the cache back under its size limit"""
+        self._file.close()
+        index = {
+            "version": CACHE_VERSION,
+            "width": self.width,
+            "height": self.height,
+            "frames": len(self.offsets) - 1,
+            "offsets": self.offsets,
+            "created": time.time(),
+            "metadata": metadata,
+        }
+        os.replace(self._tmp_path, self._data_path)
+        # The index is written last: an entry without one is never read
+        tmp_index = self._tmp_path + ".index"
+        with open(tmp_index, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_index, self._index_path)
+        self.cache.evict()
+
+    def abort(self):
+        """Drop the partially written entry"""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+class MatteCache:
+    """Size-bounded LRU cache of compressed mattes
+
+    Each entry is a data file of zlib-compressed masks plus a JSON index of
+    blob offsets. Entries are keyed by the SHA-256 of the input file and the
+    parameters that affect the masks (model variant, inference size, ...),
+    so the same upload under a different name still hits. Reading an entry
+    refreshes its modification time; the least recently used entries are
+    deleted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def key_for(self, input_path, variant, inference_size=None, **params):
+        """Cache key for the masks of input_path under the given model settings"""
+        description = {
+            "version": CACHE_VERSION,
+            "input": file_digest(input_path),
+            "variant": variant,
+            "inference_size": inference_size,
+            "params": params,
+        }
+        encoded = json.dumps(description, sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def paths(self, key):
+        return (os.path.join(self.cache_dir, f"{key}.mattes"),
+                os.path.join(self.cache_dir, f"{key}.json"))
+
+    def get(self, key, width, height):
+        """Return CachedMattes for key, or None on a miss or a size mismatch"""
+        data_path, index_path = self.paths(key)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (index.get("version") != CACHE_VERSION or index["width"] != width or index["height"] != height
+                or not os.path.exists(data_path)):
+            return None
+
+        # Mark as recently used
+        now = time.time()
+        for path in (data_path, index_path):
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+        return CachedMattes(data_path, index)
+
+    def writer(self, key, width, height):
+        """Start a new entry for key"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return MatteCacheWriter(self, key, width, height)
+
+    def remove(self, key):
+        for path in self.paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def entries(self):
+        """(last_used, size, key) for every complete entry"""
+        result = []
+        if not os.path.isdir(self.cache_dir):
+            return result
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            data_path, index_path = self.paths(key)
+            try:
+                size = os.path.getsize(data_path) + os.path.getsize(index_path)
+                last_used = os.path.getmtime(index_path)
+            except OSError:
+                continue
+            result.append((last_used, size, key))
+        return result
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    self.remove(key)
+                except OSError:
+                    continue
+                total -= size
+                print(f"Matte cache: evicted {key[:12]} ({size / 1024 ** 2:.1f} MB)")
+
+# Process-wide cache shared by every job
+_cache = None
+
+def get_matte_cache():
+    global _cache
+    if _cache is None:
+        _cache = MatteCache()
+    return _cache
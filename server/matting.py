@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Alpha matte refinement at full resolution
+A fast guided filter snaps a low-resolution mask back onto the edges of the frame
+"""
+
+import cv2
+import numpy as np
+
+def _box(image, radius):
+    return cv2.boxFilter(image, -1, (2 * radius + 1, 2 * radius + 1), borderType=cv2.BORDER_REFLECT)
+
+def refine_alpha(frame, alpha, channel_order="rgb", radius=None, eps=1e-3, subsample=4):
+    """Refine an HxW uint8 alpha against its HxWx3 uint8 frame with a fast guided filter
+
+    The filter coefficients are computed at 1/subsample resolution and
+    applied at full resolution, so the cost is a handful of small box filters
+    plus two resizes. radius is in full-resolution pixels and defaults to
+    roughly 1/128 of the longest side.
+    """
+    h, w = alpha.shape
+    if radius is None:
+        radius = max(4, round(max(h, w) / 128))
+
+    gray_code = cv2.COLOR_RGB2GRAY if channel_order == "rgb" else cv2.COLOR_BGR2GRAY
+    guide = cv2.cvtColor(frame, gray_code).astype(np.float32) * (1.0 / 255.0)
+    src = alpha.astype(np.float32) * (1.0 / 255.0)
+
+    # Work on a subsampled copy
+    small_size = (max(1, w // subsample), max(1, h // subsample))
+    guide_s = cv2.resize(guide, small_size, interpolation=cv2.INTER_AREA)
+    src_s = cv2.resize(src, small_size, interpolation=cv2.INTER_AREA)
+    r = max(1, radius // subsample)
+
+    mean_i = _box(guide_s, r)
+    mean_p = _box(src_s, r)
+    cov_ip = _box(guide_s * src_s, r) - mean_i * mean_p
+    var_i = _box(guide_s * guide_s, r) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    mean_a = cv2.resize(_box(a, r), (w, h), interpolation=cv2.INTER_LINEAR)
+    mean_b = cv2.resize(_box(b, r), (w, h), interpolation=cv2.INTER_LINEAR)
+
+    # q = mean_a * I + mean_b, computed in place
+    mean_a *= guide
+    mean_a += mean_b
+    np.clip(mean_a, 0.0, 1.0, out=mean_a)
+    mean_a *= 255.0
+    mean_a += 0.5
+    return mean_a.astype(np.uint8)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Export BiRefNet to TorchScript or ONNX for the CPU inference backends
+Optionally quantizes (dynamic int8) or casts (bf16) the graph and checks its masks against eager PyTorch
+"""
+
+import sys
+import argparse
+import copy
+import json
+import os
+import time
+
+import numpy as np
+
+from background_remover import DEFAULT_INFERENCE_SIZE, INFERENCE_SIZES, preprocess_frames
+from inference_backends import EXPORT_EXTENSIONS, OnnxRunner, TorchScriptRunner, exported_path, set_torch_threads
+from model_registry import MODEL_VARIANTS, get_registry
+
+# Default parity tolerance per precision: mean absolute mask difference in 0-255 units
+PARITY_TOLERANCES = {"fp32": 0.5, "bf16": 3.0, "int8": 6.0}
+
+def mask_head(model):
+    """Wrap a BiRefNet model so it returns only the final mask probabilities"""
+    import torch
+
+    class MaskHead(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, x):
+            return self.model(x)[-1].sigmoid()
+
+    return MaskHead(model).eval()
+
+def export_torchscript(model, path, inference_size, precision="fp32"):
+    """Trace the model at a fixed input size and save it as TorchScript"""
+    import torch
+
+    model = mask_head(model).cpu()
+    dtype = torch.float32
+    if precision == "int8":
+        # Dynamic quantization covers the Linear layers of the Swin backbone
+        from torch.ao.quantization import quantize_dynamic
+        model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif precision == "bf16":
+        # Cast a copy: Module.to() would also convert the registry's eager model
+        dtype = torch.bfloat16
+        model = copy.deepcopy(model).to(dtype)
+
+    example = torch.rand(1, 3, inference_size, inference_size, dtype=dtype)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, check_trace=False)
+        traced = torch.jit.freeze(traced)
+    traced.save(path)
+
+def export_onnx(model, path, inference_size, precision="fp32", opset=17):
+    """Export the model to ONNX with a dynamic batch axis"""
+    import torch
+
+    if precision == "bf16":
+        raise ValueError("bf16 is only supported for TorchScript exports")
+
+    model = mask_head(model).cpu().float()
+    example = torch.rand(1, 3, inference_size, inference_size)
+    target = path + ".fp32.onnx" if precision == "int8" else path
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example, target,
+            input_names=["input"],
+            output_names=["mask"],
+            dynamic_axes={"input": {0: "batch"}, "mask": {0: "batch"}},
+            opset_version=opset,
+            dynamo=False
+        )
+
+    if precision == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        try:
+            quantize_dynamic(target, path, weight_type=QuantType.QInt8)
+        finally:
+            os.remove(target)
+
+def export_model(variant, export_format="onnx", inference_size=DEFAULT_INFERENCE_SIZE, precision="fp32", output=None, opset=17):
+    """Export one BiRefNet variant and return the path of the exported graph"""
+    registry = get_registry()
+    path = output or exported_path(registry.models_dir, variant, export_format, inference_size, precision)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    model = registry.get(variant)
+    print(f"Exporting BiRefNet ({variant}) to {export_format} at {inference_size}x{inference_size} ({precision})...")
+    start = time.perf_counter()
+    if export_format == "torchscript":
+        export_torchscript(model, path, inference_size, precision)
+    else:
+        export_onnx(model, path, inference_size, precision, opset)
+
+    # Metadata read back by the runners
+    info = {
+        "variant": variant,
+        "source": registry.weights_source(variant),
+        "format": export_format,
+        "inference_size": inference_size,
+        "precision": precision,
+    }
+    with open(path + ".json", "w") as f:
+        json.dump(info, f, indent=2)
+
+    print(f"Exported in {time.perf_counter() - start:.1f}s: {path} ({os.path.getsize(path) / 1024 ** 2:.1f} MB)")
+    return path
+
+def parity_frames(inference_size, parity_input=None, count=4):
+    """RGB uint8 frames for the parity check: the first frames of a video, or synthetic ones"""
+    if parity_input:
+        from video_io import FFmpegVideoReader
+        frames = []
+        for frame in FFmpegVideoReader(parity_input).iter_frames():
+            frames.append(frame.copy())
+            if len(frames) == count:
+                break
+        return frames
+
+    # Smooth random shapes on a flat background
+    import cv2
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(count):
+        frame = np.full((inference_size, inference_size, 3), rng.integers(0, 256, 3), dtype=np.uint8)
+        for _ in range(3):
+            center = tuple(int(v) for v in rng.integers(0, inference_size, 2))
+            radius = int(rng.integers(inference_size // 10, inference_size // 4))
+            cv2.circle(frame, center, radius, tuple(int(v) for v in rng.integers(0, 256, 3)), -1)
+        frames.append(cv2.GaussianBlur(frame, (0, 0), 3))
+    return frames
+
+def check_parity(variant, path, export_format, inference_size, parity_input=None, count=4, threads=None):
+    """Compare the exported graph's masks with eager PyTorch on the same inputs
+
+    Returns a dict with the mean/max absolute difference (0-255), the IoU of
+    the masks thresholded at 0.5 and the per-frame latency of both.
+    """
+    import torch
+
+    set_torch_threads(threads)
+    model = get_registry().get(variant)
+    device = get_registry().device
+    frames = parity_frames(inference_size, parity_input, count)
+
+    if export_format == "onnx":
+        runner = OnnxRunner(path, threads)
+    else:
+        runner = TorchScriptRunner(path, device, threads)
+
+    diffs = []
+    ious = []
+    eager_time = exported_time = 0.0
+    for frame in frames:
+        batch = preprocess_frames(frame[np.newaxis], inference_size, device)
+        with torch.no_grad():
+            start = time.perf_counter()
+            eager = model(batch)[-1].sigmoid().float().cpu()
+            eager_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            exported = runner(batch).float().cpu()
+            exported_time += time.perf_counter() - start
+
+        diffs.append((eager - exported).abs() * 255)
+        eager_fg = eager > 0.5
+        exported_fg = exported > 0.5
+        union = (eager_fg | exported_fg).sum().item()
+        ious.append((eager_fg & exported_fg).sum().item() / union if union else 1.0)
+
+    diffs = torch.cat([d.flatten() for d in diffs])
+    return {
+        "frames": len(frames),
+        "mean_abs_diff": round(diffs.mean().item(), 4),
+        "max_abs_diff": round(diffs.max().item(), 4),
+        "iou": round(float(np.mean(ious)), 5),
+        "eager_ms": round(eager_time / len(frames) * 1000, 2),
+        "exported_ms": round(exported_time / len(frames) * 1000, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Export BiRefNet to TorchScript or ONNX')
+    parser.add_argument('--variant', default='lite', choices=sorted(MODEL_VARIANTS) + ['both'], help='Model variant to export')
+    parser.add_argument('--format', default='onnx', choices=sorted(EXPORT_EXTENSIONS), help='Export format')
+    parser.add_argument('--inference-size', type=int, default=DEFAULT_INFERENCE_SIZE, choices=INFERENCE_SIZES,
+                        help='Fixed input resolution of the exported graph')
+    parser.add_argument('--precision', default='fp32', choices=sorted(PARITY_TOLERANCES),
+                        help='fp32, dynamic int8 quantization, or bf16 (TorchScript only)')
+    parser.add_argument('--output', help='Output path (default: models/exported/, where the inference backends look)')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--no-parity', action='store_true', help='Skip the parity check against eager PyTorch')
+    parser.add_argument('--parity-input', help='Video whose first frames are used for the parity check (default: synthetic frames)')
+    parser.add_argument('--parity-frames', type=int, default=4, help='Number of frames in the parity check')
+    parser.add_argument('--tolerance', type=float, help='Maximum mean absolute mask difference (0-255) for the parity check')
+    parser.add_argument('--threads', type=int, help='Intra-op threads used for the parity check')
+    parser.add_argument('--weights-path', help='Local directory with the BiRefNet weights')
+    parser.add_argument('--models-dir', help='Directory used to cache downloaded models')
+    parser.add_argument('--offline', action='store_true', help='Never download models, only use local files')
+
+    args = parser.parse_args()
+
+    if args.output and args.variant == 'both':
+        parser.error("--output needs a single --variant")
+    if args.format == 'onnx' and args.precision == 'bf16':
+        parser.error("bf16 is only supported with --format torchscript")
+
+    registry = get_registry()
+    if args.models_dir:
+        registry.models_dir = args.models_dir
+    registry.offline = args.offline
+    # Exports are meant for the CPU backends
+    registry.device = "cpu"
+
+    variants = ['lite', 'full'] if args.variant == 'both' else [args.variant]
+    tolerance = args.tolerance if args.tolerance is not None else PARITY_TOLERANCES[args.precision]
+    success = True
+    for variant in variants:
+        if args.weights_path:
+            registry.set_weights_path(variant, args.weights_path)
+        try:
+            path = export_model(variant, args.format, args.inference_size, args.precision, args.output, args.opset)
+        except Exception as e:
+            print(f"Export of {variant} failed: {e}")
+            import traceback
+            traceback.print_exc()
+            success = False
+            continue
+
+        if not args.no_parity:
+            report = check_parity(variant, path, args.format, args.inference_size,
+                                  args.parity_input, args.parity_frames, args.threads)
+            passed = report["mean_abs_diff"] <= tolerance
+            print(f"Parity ({variant}, {args.precision}): {json.dumps(report)} -> {'OK' if passed else 'FAILED'} "
+                  f"(tolerance {tolerance})")
+            success = success and passed
+        registry.unload(variant)
+
+    if success:
+        print("SUCCESS")
+        sys.exit(0)
+    else:
+        print("FAILED")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Lazy, per-variant registry for the BiRefNet models
+A variant is only loaded the first time it is requested and then stays warm in the process
+"""
+
+import os
+import threading
+import time
+
+# Hugging Face repositories for each model variant
+MODEL_VARIANTS = {
+    "full": "ZhengPeng7/BiRefNet",
+    "lite": "ZhengPeng7/BiRefNet_lite",
+}
+
+DEFAULT_MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+
+def variant_for(fast_mode):
+    """Model variant used by the fast/full modes"""
+    return "lite" if fast_mode else "full"
+
+class ModelRegistry:
+    """Load BiRefNet variants on first use and keep them in memory
+
+    Weights come from the Hugging Face hub (cached in models_dir) unless a
+    local path is configured for the variant, either through
+    set_weights_path() or the BIREFNET_<VARIANT>_PATH environment variable.
+
+    backend selects how the model runs (see inference_backends.py): "eager"
+    PyTorch, or a "torchscript"/"onnx" graph exported by model_export.py at
+    the requested inference size and precision. threads pins the intra-op
+    thread count of an exported graph's runtime; the eager model runs on
+    torch's pool as pinned by the caller (set_torch_threads).
+    """
+
+    def __init__(self, models_dir=DEFAULT_MODELS_DIR, weights_paths=None, device=None, offline=False,
+                 backend="eager", precision="fp32", threads=None):
+        self.models_dir = models_dir
+        self.weights_paths = dict(weights_paths or {})
+        self.offline = offline
+        self.backend = backend
+        self.precision = precision
+        self.threads = threads
+        self.load_times = {}
+        self._device = device
+        self._models = {}
+        self._runners = {}
+        self._lock = threading.Lock()
+
+    @property
+    def device(self):
+        """Torch device, resolved the first time it is needed"""
+        if self._device is None:
+            import torch
+            self._device = "cuda" if torch.cuda.is_available() else "cpu"
+            print(f"Using device: {self._device}")
+        return self._device
+
+    @device.setter
+    def device(self, device):
+        self._device = device
+
+    def config(self):
+        """Settings of the registry (not its loaded models), to set up another process the same way"""
+        return {
+            "models_dir": self.models_dir,
+            "weights_paths": dict(self.weights_paths),
+            "device": self._device,
+            "offline": self.offline,
+            "backend": self.backend,
+            "precision": self.precision,
+            "threads": self.threads,
+        }
+
+    def set_weights_path(self, variant, path):
+        """Load a variant from a local directory instead of the hub"""
+        self.weights_paths[variant] = path
+
+    def weights_source(self, variant):
+        if variant not in MODEL_VARIANTS:
+            raise ValueError(f"Unknown model variant: {variant}")
+        return (self.weights_paths.get(variant)
+                or os.environ.get(f"BIREFNET_{variant.upper()}_PATH")
+                or MODEL_VARIANTS[variant])
+
+    def weights_fingerprint(self, variant):
+        """Identifies the weights a variant loads (e.g. for the matte cache)
+
+        The hub repository, or a local directory with the latest modification
+        time of its files, so a checkpoint replaced in place is told apart too.
+        """
+        source = self.weights_source(variant)
+        if not os.path.isdir(source):
+            return source
+        mtimes = [os.path.getmtime(os.path.join(root, name))
+                  for root, _, names in os.walk(source) for name in names]
+        return f"{os.path.abspath(source)}@{max(mtimes, default=0):.0f}"
+
+    def is_loaded(self, variant):
+        return variant in self._models
+
+    def get(self, variant):
+        """Return the model for a variant, loading it on first use"""
+        model = self._models.get(variant)
+        if model is not None:
+            return model
+
+        with self._lock:
+            if variant not in self._models:
+                self._models[variant] = self._load(variant)
+            return self._models[variant]
+
+    def _load(self, variant):
+        from transformers import AutoModelForImageSegmentation
+
+        source = self.weights_source(variant)
+        local = os.path.isdir(source)
+        os.makedirs(self.models_dir, exist_ok=True)
+
+        print(f"Loading BiRefNet ({variant}) from {source}...")
+        start = time.perf_counter()
+        model = AutoModelForImageSegmentation.from_pretrained(
+            source,
+            trust_remote_code=True,
+            cache_dir=self.models_dir,
+            local_files_only=local or self.offline
+        )
+        model.to(self.device)
+        model.eval()
+
+        self.load_times[variant] = time.perf_counter() - start
+        print(f"Loaded BiRefNet ({variant}) in {self.load_times[variant]:.2f}s")
+        return model
+
+    def get_runner(self, variant, inference_size):
+        """Return a callable mapping a normalised input batch to mask probabilities
+
+        Uses the configured backend; when no exported graph exists for this
+        variant, size and precision, falls back to the eager model.
+        """
+        key = (variant, self.backend, inference_size, self.precision, self.threads)
+        runner = self._runners.get(key)
+        if runner is not None:
+            return runner
+
+        from inference_backends import EagerRunner, OnnxRunner, TorchScriptRunner, exported_path
+
+        runner = None
+        if self.backend != "eager":
+            path = exported_path(self.models_dir, variant, self.backend, inference_size, self.precision)
+            if os.path.exists(path):
+                print(f"Using {self.backend} ({self.precision}) graph: {path}")
+                if self.backend == "onnx":
+                    runner = OnnxRunner(path, self.threads)
+                else:
+                    runner = TorchScriptRunner(path, self.device, self.threads)
+            else:
+                print(f"Warning: no {self.backend} export at {path}, using the eager model "
+                      f"(create it with: python model_export.py --variant {variant} --format {self.backend} "
+                      f"--inference-size {inference_size} --precision {self.precision})")
+        if runner is None:
+            runner = EagerRunner(self.get(variant))
+
+        with self._lock:
+            self._runners[key] = runner
+        return runner
+
+    def unload(self, variant=None):
+        """Drop one variant (or all of them) from memory"""
+        with self._lock:
+            if variant is None:
+                self._models.clear()
+                self._runners.clear()
+            else:
+                self._models.pop(variant, None)
+                for key in [key for key in self._runners if key[0] == variant]:
+                    del self._runners[key]
+
+# Process-wide registry shared by every job
+_registry = None
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry()
+    return _registry
+
+def configure_registry(config):
+    """Apply settings from ModelRegistry.config() to this process's registry"""
+    registry = get_registry()
+    registry.models_dir = config["models_dir"]
+    registry.weights_paths = dict(config["weights_paths"])
+    registry.device = config["device"]
+    registry.offline = config["offline"]
+    registry.backend = config["backend"]
+    registry.precision = config["precision"]
+    registry.threads = config["threads"]
+    return registry
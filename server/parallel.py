@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Frame-parallel helpers for the OpenCV and rembg backends
+Frames are read in chunks, processed on a pool and handed back in their original order
+"""
+
+import os
+from collections import deque
+
+def limit_threads(threads):
+    """Cap the thread pools of this process at threads (no-op when threads is None)
+
+    OpenCV is pinned right away; OMP_NUM_THREADS covers the runtimes that
+    size their pools from it when they start (torch, onnxruntime sessions
+    made by rembg), here and in the processes spawned from here.
+    """
+    if not threads:
+        return
+    import cv2
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    cv2.setNumThreads(threads)
+
+def read_frame_chunks(cap, chunk_size):
+    """Yield lists of up to chunk_size frames from a cv2.VideoCapture"""
+    chunk = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        chunk.append(frame)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def ordered_map(executor, fn, chunks, max_pending):
+    """Run fn on every chunk in the executor and yield the results in order
+
+    At most max_pending chunks are in flight at once, so memory stays bounded
+    no matter how long the video is.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(fn, chunk))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Threaded decode / inference / encode pipeline for the background removers
+Stages run on their own threads, joined by bounded queues with backpressure and error propagation
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+# Items each queue holds before the producing stage blocks
+DEFAULT_PIPELINE_DEPTH = 2
+
+# How often blocked stages check whether the pipeline was stopped
+_POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+class PipelineStopped(Exception):
+    """Raised in a stage when the pipeline was stopped by another stage or by the caller"""
+
+class BufferPool:
+    """Fixed set of preallocated arrays handed between pipeline stages
+
+    acquire() blocks until a buffer is free, which bounds memory and slows a
+    fast producer down to its consumer. A buffer (or any view of it) is
+    handed back with release() once the consumer is done with it. Time spent
+    waiting in acquire() is recorded as wait_stage in timer, if given.
+    """
+
+    def __init__(self, shape, count, dtype=np.uint8, timer=None, wait_stage=None, pipeline=None):
+        self.shape = tuple(shape)
+        self.count = count
+        self.timer = timer
+        self.wait_stage = wait_stage
+        self.pipeline = pipeline
+        self._buffers = [np.empty(shape, dtype=dtype) for _ in range(count)]
+        self._owned = {id(buffer) for buffer in self._buffers}
+        self._free = queue.Queue()
+        for buffer in self._buffers:
+            self._free.put(buffer)
+
+    def acquire(self):
+        """Take a free buffer, waiting for one to be released if necessary"""
+        start = time.perf_counter()
+        while True:
+            try:
+                buffer = self._free.get(timeout=_POLL_INTERVAL)
+                break
+            except queue.Empty:
+                # A stopped pipeline will never release the buffers
+                if self.pipeline is not None:
+                    self.pipeline._raise_if_stopped()
+        if self.timer is not None and self.wait_stage:
+            self.timer.add(self.wait_stage, time.perf_counter() - start, 0)
+        return buffer
+
+    def release(self, array):
+        """Return a buffer acquired from this pool (or a view of one)"""
+        buffer = array
+        while buffer is not None and id(buffer) not in self._owned:
+            buffer = buffer.base
+        if buffer is None:
+            raise ValueError("Array does not belong to this buffer pool")
+        self._free.put(buffer)
+
+class Pipeline:
+    """Run the stages of a video job on separate threads
+
+    source() moves an iterable (typically the decoder) onto a thread and
+    returns an iterator over its items; sink() starts a thread that feeds
+    every item put into it to a function (typically the encoder). The
+    calling thread runs whatever sits between them. Queues hold at most
+    depth items so a fast stage waits for a slow one instead of buffering
+    the whole video.
+
+    The first exception raised in any stage stops every other stage and is
+    re-raised in the calling thread (from the source iterator, put() or
+    finish()). Leaving the with block stops and joins all threads.
+    """
+
+    def __init__(self, depth=DEFAULT_PIPELINE_DEPTH):
+        self.depth = max(1, depth)
+        self._stop = threading.Event()
+        self._error = None
+        self._error_lock = threading.Lock()
+        self._threads = []
+        self._sinks = []
+
+    def pool(self, shape, count, dtype=np.uint8, timer=None, wait_stage=None):
+        """BufferPool whose blocked acquire() calls raise once the pipeline stops"""
+        return BufferPool(shape, count, dtype, timer, wait_stage, pipeline=self)
+
+    def _fail(self, error):
+        with self._error_lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _raise_if_stopped(self):
+        if self._stop.is_set():
+            if self._error is not None:
+                raise self._error
+            raise PipelineStopped("Pipeline stopped")
+
+    def _put(self, q, item):
+        """Put with backpressure; False if the pipeline stopped meanwhile"""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def source(self, iterable, name="decode"):
+        """Iterate iterable on its own thread, yielding its items here"""
+        items = queue.Queue(self.depth)
+
+        def run():
+            iterator = iter(iterable)
+            try:
+                for item in iterator:
+                    if not self._put(items, item):
+                        return
+                self._put(items, _DONE)
+            except PipelineStopped:
+                pass
+            except BaseException as e:
+                self._fail(e)
+            finally:
+                # Let generators clean up (e.g. stop the ffmpeg decoder) on their own thread
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+
+        self._start(run, f"pipeline-{name}")
+        return self._drain(items)
+
+    def _drain(self, items):
+        while True:
+            try:
+                item = items.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                self._raise_if_stopped()
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def sink(self, fn, name="encode", depth=None):
+        """Start a thread calling fn(item) for every item passed to put()
+
+        depth overrides the pipeline's queue depth, e.g. to queue a whole
+        batch of frames for the encoder.
+        """
+        sink = PipelineSink(self, fn, name, depth or self.depth)
+        self._sinks.append(sink)
+        self._start(sink.run, f"pipeline-{name}")
+        return sink
+
+    def finish(self):
+        """Wait for every sink to drain and re-raise the first stage error"""
+        for sink in self._sinks:
+            if not self._put(sink.items, _DONE):
+                break
+        for sink in self._sinks:
+            while not sink.done.wait(_POLL_INTERVAL):
+                if self._stop.is_set():
+                    break
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        """Stop every stage and wait for the threads to exit"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+class PipelineSink:
+    """Consumer end of a Pipeline; created by Pipeline.sink()"""
+
+    def __init__(self, pipeline, fn, name, depth):
+        self.pipeline = pipeline
+        self.fn = fn
+        self.name = name
+        self.items = queue.Queue(depth)
+        self.done = threading.Event()
+
+    def put(self, item):
+        """Queue an item, blocking while the sink is depth items behind"""
+        if not self.pipeline._put(self.items, item):
+            self.pipeline._raise_if_stopped()
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.items.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    if self.pipeline._stop.is_set():
+                        return
+                    continue
+                if item is _DONE:
+                    return
+                self.fn(item)
+        except BaseException as e:
+            self.pipeline._fail(e)
+        finally:
+            self.done.set()
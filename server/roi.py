@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Subject region-of-interest tracking for the segmentation backends
+The model runs on a crop around the subject found in the previous mask instead of the whole frame
+"""
+
+import cv2
+import numpy as np
+
+class SubjectTracker:
+    """Follow the subject's bounding box from mask to mask
+
+    Usage for each batch of consecutive frames:
+        box = tracker.box(frame.shape)              # (x, y, w, h), or None for a full-frame pass
+        crops = [f[y:y + h, x:x + w] for f in frames] if box else frames
+        masks = [tracker.paste(box, m, frame.shape) for m in model(crops)]
+        tracker.update(masks[-1], box)
+
+    The box is the bounding rectangle of the mask above threshold, grown by
+    margin (a fraction of its size) on every side, padded towards a square
+    (the models squash their input to one) and smoothed over time: it grows
+    immediately but only shrinks by smoothing per frame. The tracker falls
+    back to a full-frame pass when there is no previous mask, when the
+    subject vanished or touched the edge of the crop (it may extend past
+    it), when the crop would cover most of the frame anyway, and every
+    refresh_interval frames so new subjects entering the shot are picked up.
+    """
+
+    def __init__(self, margin=0.15, smoothing=0.6, threshold=32, min_area=0.002, max_fraction=0.7,
+                 min_size=0.25, refresh_interval=30):
+        self.margin = margin
+        self.smoothing = smoothing
+        self.threshold = threshold
+        self.min_area = min_area
+        self.max_fraction = max_fraction
+        self.min_size = min_size
+        self.refresh_interval = refresh_interval
+        self.crop_frames = 0
+        self.full_frames = 0
+        self._crop_area = 0.0
+        self.reset()
+
+    def reset(self):
+        """Forget the subject so the next frame gets a full-frame pass"""
+        self._box = None
+        self._since_full = 0
+
+    @property
+    def mean_crop_fraction(self):
+        """Average share of the frame area the model saw, over cropped and full passes"""
+        frames = self.crop_frames + self.full_frames
+        if not frames:
+            return 1.0
+        return (self._crop_area + self.full_frames) / frames
+
+    def box(self, frame_shape, frames=1):
+        """Integer crop (x, y, w, h) for the next frames frames, or None for a full-frame pass"""
+        height, width = frame_shape[:2]
+        if self._box is None or self._since_full >= self.refresh_interval:
+            self.full_frames += frames
+            self._since_full = 0
+            return None
+
+        x0, y0, x1, y1 = self._box
+        x0, y0 = max(0, int(np.floor(x0))), max(0, int(np.floor(y0)))
+        x1, y1 = min(width, int(np.ceil(x1))), min(height, int(np.ceil(y1)))
+        if x1 - x0 < 2 or y1 - y0 < 2 or (x1 - x0) * (y1 - y0) > self.max_fraction * width * height:
+            self.full_frames += frames
+            self._since_full = 0
+            return None
+
+        self.crop_frames += frames
+        self._crop_area += (x1 - x0) * (y1 - y0) / (width * height) * frames
+        self._since_full += frames
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def paste(self, box, mask, frame_shape):
+        """Full-frame HxW uint8 mask: mask inside box, zero alpha everywhere else"""
+        if box is None:
+            return mask
+        x, y, w, h = box
+        full = np.zeros(frame_shape[:2], dtype=np.uint8)
+        full[y:y + h, x:x + w] = mask
+        return full
+
+    def _target(self, mask):
+        """Grown, square-padded box (x0, y0, x1, y1) around the subject in a full-frame mask"""
+        height, width = mask.shape
+        x, y, w, h = cv2.boundingRect((mask > self.threshold).view(np.uint8))
+        if w * h < self.min_area * width * height:
+            return None
+
+        pad_x = w * self.margin
+        pad_y = h * self.margin
+        x0, y0, x1, y1 = x - pad_x, y - pad_y, x + w + pad_x, y + h + pad_y
+
+        # Towards a square, but never below min_size of the short side
+        side = max(x1 - x0, y1 - y0, self.min_size * min(width, height))
+        cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+        x0, x1 = cx - side / 2, cx + side / 2
+        y0, y1 = cy - side / 2, cy + side / 2
+
+        # Shift back inside the frame before clipping
+        shift_x = max(0.0, -x0) - max(0.0, x1 - width)
+        shift_y = max(0.0, -y0) - max(0.0, y1 - height)
+        return (max(0.0, x0 + shift_x), max(0.0, y0 + shift_y),
+                min(float(width), x1 + shift_x), min(float(height), y1 + shift_y))
+
+    def _touches_crop_edge(self, box, mask):
+        """True if the subject reaches a side of the crop that is not a side of the frame"""
+        x, y, w, h = box
+        height, width = mask.shape
+        crop = mask[y:y + h, x:x + w] > self.threshold
+        return ((x > 0 and crop[:, 0].any()) or (y > 0 and crop[0].any())
+                or (x + w < width and crop[:, -1].any()) or (y + h < height and crop[-1].any()))
+
+    def update(self, mask, box=None):
+        """Track the subject in the latest full-frame mask; box is the crop it was predicted on"""
+        if mask is None:
+            self.reset()
+            return
+        target = self._target(mask)
+        if target is None or (box is not None and self._touches_crop_edge(box, mask)):
+            # Lost the subject, or it may extend past the crop: look at the whole frame again
+            self.reset()
+            return
+        if self._box is None:
+            self._box = target
+            return
+
+        # Grow at once so the subject is never clipped, shrink smoothly
+        s = self.smoothing
+        x0, y0, x1, y1 = self._box
+        tx0, ty0, tx1, ty1 = target
+        self._box = (
+            tx0 if tx0 < x0 else s * x0 + (1 - s) * tx0,
+            ty0 if ty0 < y0 else s * y0 + (1 - s) * ty0,
+            tx1 if tx1 > x1 else s * x1 + (1 - s) * tx1,
+            ty1 if ty1 > y1 else s * y1 + (1 - s) * ty1,
+        )
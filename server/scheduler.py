@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Resource-aware job scheduler for the background removal worker
+Jobs are admitted within CPU thread and memory budgets, shortest clip first, with queue positions, ETAs and metrics
+"""
+
+import os
+import threading
+import time
+
+from video_io import probe_video
+
+# Seconds per frame of each kind of job until one of that kind has finished; the models
+# run at a fixed input size, so inference time hardly depends on the clip's resolution
+DEFAULT_COST = {"birefnet": 3.0, "birefnet-lite": 1.0, "simple": 0.4, "opencv": 0.03}
+
+# Resident memory (MB) of a job besides its frame buffers: runtime, model and activations
+BASE_MEMORY_MB = {"birefnet": 2500, "birefnet-lite": 1200, "simple": 700, "opencv": 150}
+
+# Frame-sized RGBA buffers a job holds at once (decode, pipeline pools, compositing, encoder)
+FRAME_BUFFERS = 48
+
+# Every second spent waiting counts as this many seconds less work when ordering the queue,
+# so long clips are not starved by a steady stream of short ones
+AGING = 0.5
+
+# Weight of the latest finished job in the learned cost per frame
+COST_SMOOTHING = 0.3
+
+def available_memory_mb():
+    """MemAvailable from /proc/meminfo (Linux), or None when unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def job_kind(job):
+    """Cost class of a job: the backend, split by BiRefNet variant"""
+    backend = job.get("backend", "birefnet")
+    if backend == "birefnet" and job.get("fast_mode", True):
+        return "birefnet-lite"
+    return backend
+
+def job_processes(job):
+    """Processes a job works in, each loading its own model and running its own thread pools
+
+    Chunked jobs process segment_processes segments at once, and the rembg
+    backend runs its frames on a pool of workers processes (in every
+    segment process).
+    """
+    processes = 1
+    if job.get("segment_seconds"):
+        processes *= max(1, int(job.get("segment_processes", 1)))
+    if job.get("backend", "birefnet") == "simple":
+        processes *= max(1, int(job.get("workers", 1)))
+    return processes
+
+def default_threads(job, cpu_threads):
+    """Threads each process of a job gets when the job does not ask for a number"""
+    backend = job.get("backend", "birefnet")
+    if backend == "birefnet":
+        # Inference scales to a few cores; beyond that two jobs side by side do more work
+        return max(1, min(4, cpu_threads // 2))
+    if backend == "opencv":
+        # The keyer's workers are threads of the job's process
+        return max(1, int(job.get("workers", 1)))
+    return 1
+
+class ScheduledJob:
+    """A job in the scheduler with its resource reservation and cost estimate"""
+
+    def __init__(self, job, seq, threads, memory_mb, frames, megapixels, kind, processes=1):
+        self.job = job
+        self.id = job.get("id")
+        self.seq = seq
+        self.threads = threads
+        self.processes = processes
+        self.memory_mb = memory_mb
+        self.frames = frames
+        self.megapixels = megapixels
+        self.kind = kind
+        self.est_seconds = 0.0
+        self.submitted = time.monotonic()
+        self.started = None
+        self.progress = 0.0
+
+    @property
+    def process_threads(self):
+        """Share of the reserved threads for each of the job's processes"""
+        return max(1, self.threads // self.processes)
+
+    def remaining_seconds(self, now):
+        """Expected seconds until a running job finishes, from its progress so far when known"""
+        elapsed = now - self.started
+        if self.progress > 0.02:
+            return elapsed * (1 - self.progress) / self.progress
+        return max(0.0, self.est_seconds - elapsed)
+
+class JobScheduler:
+    """Run jobs concurrently without oversubscribing the machine
+
+    A job reserves CPU threads and memory while it runs; the job at the head
+    of the queue is started once its reservation fits into what is left of
+    the budgets (and fewer than max_jobs are running). A job larger than a
+    budget runs alone. The queue is ordered by expected run time (frames x
+    the learned cost per frame of its kind), shortest first, with aging.
+    run(entry) executes a job and returns its success; it is called on a
+    thread of its own with entry.process_threads as the thread count to pin
+    in each of the job's entry.processes processes.
+    on_change() is called whenever the queue changes, e.g. to publish
+    positions and ETAs from queue().
+    """
+
+    def __init__(self, run, cpu_threads=None, memory_mb=None, max_jobs=None, aging=AGING, on_change=None):
+        self.run = run
+        self.cpu_threads = max(1, cpu_threads or os.cpu_count() or 1)
+        self.memory_mb = memory_mb or (available_memory_mb() or 8192) * 0.8
+        self.max_jobs = max(1, max_jobs or self.cpu_threads)
+        self.aging = aging
+        self.on_change = on_change
+        self.cost = dict(DEFAULT_COST)
+        self._pending = []
+        self._running = {}
+        self._seq = 0
+        self._closing = False
+        self._cond = threading.Condition()
+        self._stats = {"completed": 0, "failed": 0, "cancelled": 0, "frames": 0,
+                       "wait_s": 0.0, "run_s": 0.0, "busy_s": 0.0}
+        self._busy_since = None
+        self._dispatcher = threading.Thread(target=self._dispatch, name="scheduler", daemon=True)
+        self._dispatcher.start()
+
+    def estimate(self, job):
+        """Reservation and expected run time of a job, from its settings and the input header"""
+        try:
+            info = probe_video(job["input"])
+            frames = info["estimated_frames"] or int(info["duration"] * info["fps"])
+            megapixels = info["width"] * info["height"] / 1e6
+        except Exception:
+            # Unreadable inputs fail fast once started; schedule them as short clips
+            frames, megapixels = 0, 0.0
+
+        kind = job_kind(job)
+        # Every process of the job holds a model, frame buffers and thread pools of its own
+        processes = job_processes(job)
+        threads = int(job.get("threads") or default_threads(job, self.cpu_threads) * processes)
+        threads = min(max(1, threads), self.cpu_threads)
+        buffers_mb = FRAME_BUFFERS * max(1, int(job.get("batch_size", 1))) * megapixels * 4
+        memory_mb = float(job.get("memory_mb") or (BASE_MEMORY_MB.get(kind, 500) + buffers_mb) * processes)
+
+        with self._cond:
+            self._seq += 1
+            entry = ScheduledJob(job, self._seq, threads, memory_mb, frames, megapixels, kind, processes)
+            entry.est_seconds = frames * self.cost.get(kind, 0.5)
+        return entry
+
+    def submit(self, job, on_accept=None):
+        """Queue a job; returns its ScheduledJob
+
+        on_accept(entry, position) is called before the job can start or show
+        up in queue(), with the place it is expected to take there (a dict as
+        in queue()).
+        """
+        if self._closing:
+            raise RuntimeError("Scheduler is shutting down")
+        entry = self.estimate(job)
+        if on_accept:
+            on_accept(entry, next(p for p in self.queue(entry) if p["id"] == entry.id))
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("Scheduler is shutting down")
+            self._pending.append(entry)
+            self._cond.notify_all()
+        self._changed()
+        return entry
+
+    def cancel(self, job_id):
+        """Drop a job that has not started yet; returns its ScheduledJob, or None if it is running or unknown"""
+        with self._cond:
+            for entry in self._pending:
+                if entry.id == job_id:
+                    self._pending.remove(entry)
+                    self._stats["cancelled"] += 1
+                    break
+            else:
+                return None
+        self._changed()
+        return entry
+
+    def progress(self, job_id, frame, total):
+        """Record the progress of a running job to sharpen the ETAs behind it"""
+        with self._cond:
+            for entry in self._running.values():
+                if entry.id == job_id and total:
+                    entry.progress = min(1.0, frame / total)
+
+    def running(self):
+        """Ids of the running jobs"""
+        with self._cond:
+            return [entry.id for entry in self._running.values()]
+
+    def _ordered(self, now, extra=None):
+        pending = self._pending + [extra] if extra else self._pending
+        return sorted(pending, key=lambda e: (e.est_seconds - self.aging * (now - e.submitted), e.seq))
+
+    def _fits(self, entry, threads_used, memory_used, running):
+        if running == 0:
+            return True
+        return (running < self.max_jobs and threads_used + entry.threads <= self.cpu_threads
+                and memory_used + entry.memory_mb <= self.memory_mb)
+
+    def queue(self, extra=None):
+        """Queued jobs in the order they will start: [{id, position, start_s, eta_s}]
+
+        Start and finish times are simulated from the reservations and
+        expected run times of the running and queued jobs (plus the
+        ScheduledJob extra, as if it had been queued).
+        """
+        now = time.monotonic()
+        with self._cond:
+            ends = [(now + e.remaining_seconds(now), e.threads, e.memory_mb) for e in self._running.values()]
+            ordered = self._ordered(now, extra)
+
+        threads_used = sum(end[1] for end in ends)
+        memory_used = sum(end[2] for end in ends)
+        clock = now
+        positions = []
+        for position, entry in enumerate(ordered, 1):
+            ends.sort()
+            while ends and not self._fits(entry, threads_used, memory_used, len(ends)):
+                end, threads, memory = ends.pop(0)
+                clock = max(clock, end)
+                threads_used -= threads
+                memory_used -= memory
+            ends.append((clock + entry.est_seconds, entry.threads, entry.memory_mb))
+            threads_used += entry.threads
+            memory_used += entry.memory_mb
+            positions.append({
+                "id": entry.id,
+                "position": position,
+                "start_s": round(clock - now, 1),
+                "eta_s": round(clock - now + entry.est_seconds, 1),
+            })
+        return positions
+
+    def metrics(self):
+        """Queue and resource counters plus the learned cost model"""
+        now = time.monotonic()
+        with self._cond:
+            stats = dict(self._stats)
+            busy_s = stats["busy_s"] + (now - self._busy_since if self._busy_since is not None else 0.0)
+            finished = stats["completed"] + stats["failed"]
+            return {
+                "queued": len(self._pending),
+                "running": len(self._running),
+                "completed": stats["completed"],
+                "failed": stats["failed"],
+                "cancelled": stats["cancelled"],
+                "threads_used": sum(e.threads for e in self._running.values()),
+                "threads_budget": self.cpu_threads,
+                "memory_reserved_mb": round(sum(e.memory_mb for e in self._running.values()), 1),
+                "memory_budget_mb": round(self.memory_mb, 1),
+                "max_jobs": self.max_jobs,
+                "mean_wait_s": round(stats["wait_s"] / finished, 2) if finished else None,
+                "mean_run_s": round(stats["run_s"] / finished, 2) if finished else None,
+                "throughput_fps": round(stats["frames"] / busy_s, 2) if busy_s > 0 else None,
+                "cost_s_per_frame": {kind: round(cost, 4) for kind, cost in self.cost.items()},
+            }
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                if self._closing and not self._pending and not self._running:
+                    return
+                now = time.monotonic()
+                ordered = self._ordered(now)
+                head = ordered[0] if ordered else None
+                threads_used = sum(e.threads for e in self._running.values())
+                memory_used = sum(e.memory_mb for e in self._running.values())
+                if head is None or not self._fits(head, threads_used, memory_used, len(self._running)):
+                    # Woken by submit/finish; the timeout lets aging reorder the queue
+                    self._cond.wait(1.0)
+                    continue
+                self._pending.remove(head)
+                head.started = now
+                # Keyed by submission, so jobs sharing a client id do not collide
+                self._running[head.seq] = head
+                if self._busy_since is None:
+                    self._busy_since = now
+            threading.Thread(target=self._execute, args=(head,), name=f"job-{head.id}", daemon=True).start()
+            self._changed()
+
+    def _execute(self, entry):
+        try:
+            success = self.run(entry)
+        except Exception as e:
+            print(f"ERROR: Job {entry.id} failed: {e}")
+            success = False
+
+        now = time.monotonic()
+        run_s = now - entry.started
+        with self._cond:
+            del self._running[entry.seq]
+            self._stats["completed" if success else "failed"] += 1
+            self._stats["wait_s"] += entry.started - entry.submitted
+            self._stats["run_s"] += run_s
+            if success:
+                self._stats["frames"] += entry.frames
+                if entry.frames:
+                    observed = run_s / entry.frames
+                    previous = self.cost.get(entry.kind, observed)
+                    self.cost[entry.kind] = previous + COST_SMOOTHING * (observed - previous)
+                    for queued in self._pending:
+                        if queued.kind == entry.kind:
+                            queued.est_seconds = queued.frames * self.cost[entry.kind]
+            if not self._running:
+                self._stats["busy_s"] += now - self._busy_since
+                self._busy_since = None
+            self._cond.notify_all()
+        self._changed()
+
+    def close(self):
+        """Stop accepting jobs and wait for the queued and running ones to finish"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._dispatcher.join()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Temporal mask reuse for the segmentation backends
+The expensive model only runs on keyframes; masks for the frames in between are
+propagated from the previous frame with dense optical flow
+"""
+
+import cv2
+import numpy as np
+
+class TemporalMaskPropagator:
+    """Pick keyframes with a cheap frame-difference metric and propagate masks between them
+
+    Usage for each batch of consecutive frames:
+        plan = propagator.plan(frames)              # True where the model must run
+        key_masks = model([f for f, k in zip(frames, plan) if k])
+        masks = propagator.resolve(plan, key_masks)  # one mask per frame
+
+    A frame becomes a keyframe when its mean absolute grey-level difference
+    from the last keyframe exceeds threshold (0-1), or after max_interval
+    propagated frames, whichever comes first.
+    """
+
+    def __init__(self, threshold=0.02, max_interval=15, use_flow=True, analysis_width=160, channel_order="rgb"):
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.use_flow = use_flow
+        self.analysis_width = analysis_width
+        self._gray_code = cv2.COLOR_RGB2GRAY if channel_order == "rgb" else cv2.COLOR_BGR2GRAY
+        self.frames = 0
+        self.keyframes = 0
+        self._grid = None
+        self.reset()
+
+    def reset(self):
+        """Forget the previous frames so the next frame becomes a keyframe"""
+        self._key_small = None
+        self._since_key = 0
+        self._prev_small = None
+        self._prev_mask = None
+        self._pending = []
+
+    @property
+    def skip_ratio(self):
+        """Fraction of frames whose mask was propagated instead of inferred"""
+        if not self.frames:
+            return 0.0
+        return 1.0 - self.keyframes / self.frames
+
+    def _analysis_frame(self, frame):
+        """Small greyscale copy of a frame used for differencing and flow"""
+        h, w = frame.shape[:2]
+        scale = min(1.0, self.analysis_width / w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, self._gray_code)
+
+    def plan(self, frames):
+        """Return, for each consecutive frame, whether it needs a model pass"""
+        plan = []
+        self._pending = []
+        for frame in frames:
+            small = self._analysis_frame(frame)
+            is_key = (
+                self._key_small is None
+                or self._key_small.shape != small.shape
+                or self._since_key >= self.max_interval
+                or cv2.absdiff(small, self._key_small).mean() / 255.0 > self.threshold
+            )
+            if is_key:
+                self._key_small = small
+                self._since_key = 0
+                self.keyframes += 1
+            else:
+                self._since_key += 1
+            self.frames += 1
+            plan.append(is_key)
+            self._pending.append(small)
+        return plan
+
+    def _warp(self, mask, prev_small, small):
+        """Warp the previous frame's mask onto the current frame"""
+        # Backward flow: for every current pixel, where it came from in the previous frame
+        flow = cv2.calcOpticalFlowFarneback(small, prev_small, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+
+        h, w = mask.shape
+        sh, sw = small.shape
+        flow = cv2.resize(flow, (w, h), interpolation=cv2.INTER_LINEAR)
+        flow[:, :, 0] *= w / sw
+        flow[:, :, 1] *= h / sh
+
+        # Absolute sampling coordinates for cv2.remap
+        if self._grid is None or self._grid.shape[:2] != (h, w):
+            grid_x, grid_y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+            self._grid = np.dstack([grid_x, grid_y])
+        flow += self._grid
+        return cv2.remap(mask, flow, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    def resolve(self, plan, key_masks):
+        """Combine the keyframe masks with propagated masks for the planned frames"""
+        key_masks = iter(key_masks)
+        masks = []
+        for is_key, small in zip(plan, self._pending):
+            if is_key or self._prev_mask is None:
+                mask = next(key_masks)
+            elif self.use_flow:
+                mask = self._warp(self._prev_mask, self._prev_small, small)
+            else:
+                mask = self._prev_mask
+            self._prev_mask = mask
+            self._prev_small = small
+            masks.append(mask)
+        self._pending = []
+        return masks
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+FFmpeg based video I/O shared by the background removers
+Frames are piped straight into an ffmpeg process so nothing is buffered in RAM
+"""
+
+import os
+import re
+import subprocess
+import tempfile
+
+import numpy as np
+
+def get_ffmpeg_exe():
+    """Locate the ffmpeg binary (bundled with moviepy through imageio-ffmpeg)"""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
+
+def popen_flags():
+    """Keep ffmpeg from opening a console window on Windows"""
+    return 0x08000000 if os.name == "nt" else 0
+
+# Encoder presets per output format. pix_fmt is used for opaque frames and
+# alpha_pix_fmt for frames that keep their alpha channel (None: no alpha).
+OUTPUT_FORMATS = {
+    "mp4": {"codec": "libx264", "pix_fmt": "yuv420p", "alpha_pix_fmt": None,
+            "audio_codec": "aac", "args": []},
+    "webm": {"codec": "libvpx-vp9", "pix_fmt": "yuv420p", "alpha_pix_fmt": "yuva420p",
+             "audio_codec": "libopus", "args": ["-row-mt", "1", "-auto-alt-ref", "0"]},
+    "mov": {"codec": "prores_ks", "pix_fmt": "yuv444p10le", "alpha_pix_fmt": "yuva444p10le",
+            "audio_codec": "pcm_s16le", "args": ["-profile:v", "4444", "-vendor", "apl0"]},
+    "png": {"codec": "png", "pix_fmt": "rgb24", "alpha_pix_fmt": "rgba",
+            "audio_codec": None, "args": []},
+}
+
+# Audio codecs each container takes as they are: such source tracks are
+# stream-copied into the output instead of being decoded and re-encoded
+AUDIO_COPY_CODECS = {
+    "mp4": {"aac", "mp3", "alac", "ac3", "eac3", "opus", "flac"},
+    "webm": {"opus", "vorbis"},
+    "mov": {"aac", "mp3", "alac", "ac3", "pcm_s16le", "pcm_s24le", "pcm_f32le", "pcm_s16be"},
+}
+
+# x264-style speed presets, fastest first; other encoders get the nearest equivalent
+ENCODER_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+
+# (deadline, cpu-used) of libvpx for each preset
+VPX_SPEEDS = {
+    "ultrafast": ("realtime", 8), "superfast": ("realtime", 7), "veryfast": ("good", 5),
+    "faster": ("good", 4), "fast": ("good", 3), "medium": ("good", 2),
+    "slow": ("good", 1), "slower": ("good", 0), "veryslow": ("best", 0),
+}
+
+def output_format_for(path):
+    """Guess the output format from the file extension (.webm, .mov, .png or a directory)"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".webm":
+        return "webm"
+    if ext == ".mov":
+        return "mov"
+    if ext == ".png" or not ext or "%" in path:
+        return "png"
+    return "mp4"
+
+def supports_alpha(output_format):
+    return OUTPUT_FORMATS[output_format]["alpha_pix_fmt"] is not None
+
+def image_sequence_pattern(path):
+    """Numbered file pattern for a PNG sequence given a directory, a pattern or a .png path"""
+    if "%" in path:
+        pattern = path
+    elif os.path.splitext(path)[1].lower() == ".png":
+        pattern = os.path.splitext(path)[0] + "_%06d.png"
+    else:
+        pattern = os.path.join(path, "frame_%06d.png")
+    directory = os.path.dirname(pattern)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return pattern
+
+def probe_audio_codec(path):
+    """Codec name of the first audio stream of a file (e.g. "aac"), or None"""
+    result = subprocess.run(
+        [get_ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, creationflags=popen_flags()
+    )
+    match = re.search(r"Stream #\S+.*?: Audio: (\w+)", result.stderr.decode(errors="replace"))
+    return match.group(1) if match else None
+
+def audio_codec_for(audio_source, output_format):
+    """"copy" when the source audio fits the container as it is, else the format's audio encoder"""
+    codec = OUTPUT_FORMATS[output_format]["audio_codec"]
+    if codec and probe_audio_codec(audio_source) in AUDIO_COPY_CODECS.get(output_format, ()):
+        return "copy"
+    return codec
+
+def encoder_args(codec, preset=None, crf=None):
+    """Speed preset and constant-quality options spelled the way the encoder expects"""
+    args = []
+    if codec in ("libvpx-vp9", "libvpx"):
+        if preset:
+            deadline, cpu_used = VPX_SPEEDS[preset]
+            args += ["-deadline", deadline, "-cpu-used", str(cpu_used)]
+        if crf is not None:
+            # Constant quality needs the bitrate target switched off
+            args += ["-crf", str(crf), "-b:v", "0"]
+    elif codec.startswith("prores"):
+        # ProRes quality is set by its profile
+        pass
+    else:
+        if preset:
+            args += ["-preset", preset]
+        if crf is not None:
+            args += ["-crf", str(crf)]
+    return args
+
+def add_encoder_arguments(parser):
+    """Encoder options shared by the command line tools (see encoder_options)"""
+    parser.add_argument('--codec', help='Video encoder (default: the output format\'s, e.g. libx264 for mp4)')
+    parser.add_argument('--preset', choices=ENCODER_PRESETS, help='Encoder speed preset (faster: bigger files)')
+    parser.add_argument('--crf', type=float, help='Constant quality (x264/x265: 0-51, VP9: 0-63; lower is better)')
+    parser.add_argument('--encoder-threads', type=int, help='Encoder threads (default: chosen by ffmpeg)')
+    parser.add_argument('--pix-fmt', help='Output pixel format (default: the output format\'s)')
+
+def encoder_options(args):
+    """Dict of the encoder options given on the command line, for the encoder= argument"""
+    options = {
+        "codec": args.codec,
+        "preset": args.preset,
+        "crf": args.crf,
+        "threads": args.encoder_threads,
+        "pix_fmt": args.pix_fmt,
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+def probe_video(path):
+    """Read size, fps, duration and audio presence from the container header"""
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+    
+    infos = ffmpeg_parse_infos(path)
+    if not infos.get("video_found"):
+        raise IOError(f"No video stream found in {path}")
+    
+    width, height = infos["video_size"]
+    if infos.get("video_rotation", 0) in (90, 270):
+        width, height = height, width
+    
+    return {
+        "width": int(width),
+        "height": int(height),
+        "fps": float(infos["video_fps"]),
+        "duration": float(infos.get("video_duration") or infos.get("duration") or 0),
+        "estimated_frames": int(infos.get("video_nframes") or 0),
+        "has_audio": bool(infos.get("audio_found")),
+    }
+
+class FFmpegVideoReader:
+    """Decode frames sequentially through an ffmpeg rawvideo pipe
+    
+    Every decoded frame is delivered exactly once, in order, without seeking
+    or resampling timestamps. Frames are read into reused NumPy buffers, so
+    callers must copy a frame if they need it after requesting the next one.
+    """
+
+    def __init__(self, path, pix_fmt="rgb24"):
+        self.path = path
+        self.pix_fmt = pix_fmt
+        self.channels = {"rgb24": 3, "bgr24": 3, "gray": 1}[pix_fmt]
+        
+        info = probe_video(path)
+        self.width = info["width"]
+        self.height = info["height"]
+        self.fps = info["fps"]
+        self.duration = info["duration"]
+        self.estimated_frames = info["estimated_frames"]
+        self.has_audio = info["has_audio"]
+        
+        # Exact number of frames delivered so far
+        self.frame_count = 0
+        self.proc = None
+
+    @property
+    def frame_shape(self):
+        if self.channels == 1:
+            return (self.height, self.width)
+        return (self.height, self.width, self.channels)
+
+    def _start(self):
+        cmd = [
+            get_ffmpeg_exe(), "-loglevel", "error", "-nostdin",
+            "-i", self.path,
+            "-map", "0:v:0",
+            "-vsync", "0",
+            "-f", "rawvideo",
+            "-pix_fmt", self.pix_fmt,
+            "-",
+        ]
+        self.proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            bufsize=self.width * self.height * self.channels * 2,
+            creationflags=popen_flags()
+        )
+
+    def _read_into(self, buffer):
+        """Fill buffer with the next frame, returning False at end of stream"""
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < len(view):
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                if filled:
+                    print(f"Warning: discarding truncated frame at end of {self.path}")
+                return False
+            filled += n
+        self.frame_count += 1
+        return True
+
+    def iter_frames(self):
+        """Yield frames one at a time from a single reused buffer"""
+        buffer = np.empty(self.frame_shape, dtype=np.uint8)
+        for batch in self.iter_batches(1, out=buffer[np.newaxis]):
+            yield batch[0]
+
+    def iter_batches(self, batch_size, out=None, pool=None):
+        """Yield arrays of up to batch_size consecutive frames
+        
+        The same (batch_size, H, W, C) buffer is refilled for every batch; the
+        last batch may be shorter. With a BufferPool (see pipeline.py) each
+        batch is read into a buffer taken from the pool instead, and the
+        consumer releases it when done.
+        """
+        if out is None and pool is None:
+            out = np.empty((batch_size,) + self.frame_shape, dtype=np.uint8)
+        self._start()
+        try:
+            while True:
+                if pool is not None:
+                    out = pool.acquire()
+                count = 0
+                while count < batch_size and self._read_into(out[count]):
+                    count += 1
+                if count:
+                    yield out[:count]
+                if count < batch_size:
+                    break
+        finally:
+            self.close()
+
+    def close(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class FFmpegVideoWriter:
+    """Encode raw frames by streaming them into an ffmpeg process"""
+
+    def __init__(self, output_path, width, height, fps, codec="libx264", bitrate=None,
+                 audio_source=None, audio_codec="aac", audio_duration=None, threads=None,
+                 input_pix_fmt="rgb24", pix_fmt="yuv420p", extra_args=None):
+        """audio_codec "copy" muxes the source's audio track without re-encoding it
+        
+        The video always keeps every frame written; with audio_duration only
+        that many seconds of the source's audio are read, so the audio does
+        not run on past the video.
+        """
+        self.output_path = output_path
+        self.width = width
+        self.height = height
+        self.frame_count = 0
+
+        cmd = [
+            get_ffmpeg_exe(), "-y", "-loglevel", "error", "-nostats",
+            "-f", "rawvideo",
+            "-vcodec", "rawvideo",
+            "-s", f"{width}x{height}",
+            "-pix_fmt", input_pix_fmt,
+            "-r", f"{fps}",
+            "-i", "-",
+        ]
+
+        # Take the audio track straight from the source file; no -shortest, which drops
+        # the last video frames whenever the audio ends slightly before them
+        if audio_source and audio_codec:
+            if audio_duration:
+                cmd += ["-t", f"{audio_duration}"]
+            cmd += ["-i", audio_source, "-map", "0:v:0", "-map", "1:a:0?", "-c:a", audio_codec]
+
+        cmd += ["-c:v", codec]
+        if bitrate:
+            cmd += ["-b:v", bitrate]
+        if threads:
+            cmd += ["-threads", str(threads)]
+        if pix_fmt:
+            cmd += ["-pix_fmt", pix_fmt]
+        if extra_args:
+            cmd += list(extra_args)
+        if pix_fmt and pix_fmt.startswith(("yuv420", "yuva420")) and (width % 2 or height % 2):
+            # 4:2:0 chroma subsampling needs even dimensions
+            cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+        cmd.append(output_path)
+
+        self._log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._log,
+            creationflags=popen_flags()
+        )
+
+    def _error_output(self):
+        self._log.seek(0)
+        return self._log.read().decode(errors="replace").strip()
+
+    def write(self, frame):
+        """Write one HxWxC uint8 frame"""
+        try:
+            self.proc.stdin.write(memoryview(frame).cast("B") if frame.flags["C_CONTIGUOUS"] else frame.tobytes())
+        except (BrokenPipeError, OSError):
+            self.proc.wait()
+            raise IOError(f"ffmpeg encoder failed: {self._error_output()}")
+        self.frame_count += 1
+
+    def close(self):
+        """Flush the encoder and wait for ffmpeg to finish"""
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        code = self.proc.wait()
+        self.proc = None
+        error_output = self._error_output()
+        self._log.close()
+        if code != 0:
+            raise IOError(f"ffmpeg encoder exited with code {code}: {error_output}")
+
+    def abort(self):
+        """Stop the encoder without finalising the output"""
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+            self._log.close()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def open_video_writer(output_path, width, height, fps, output_format=None, alpha=False, bitrate=None,
+                      audio_source=None, audio_duration=None, threads=None, channel_order="rgb", codec=None,
+                      preset=None, crf=None, pix_fmt=None):
+    """FFmpegVideoWriter set up for one of OUTPUT_FORMATS
+    
+    With alpha=True (and a format that supports it) frames are written as
+    HxWx4 with the alpha channel last; otherwise as HxWx3. PNG sequences
+    are written to a numbered pattern and carry no audio.
+    
+    codec, preset (one of ENCODER_PRESETS), crf, threads and pix_fmt
+    override the format's encoder settings; crf replaces bitrate. The audio
+    of audio_source (if it has any) is stream-copied when the container
+    accepts its codec and re-encoded otherwise, and cut to audio_duration
+    seconds (the source video's duration) when given.
+    """
+    output_format = output_format or output_format_for(output_path)
+    spec = OUTPUT_FORMATS[output_format]
+    alpha = alpha and supports_alpha(output_format)
+    
+    if output_format == "png":
+        output_path = image_sequence_pattern(output_path)
+        bitrate = None
+        audio_source = None
+    elif output_format == "mov":
+        # ProRes is constant quality per profile
+        bitrate = None
+    if crf is not None:
+        bitrate = None
+    
+    # The format's extra arguments belong to its own encoder
+    extra_args = list(spec["args"]) if not codec or codec == spec["codec"] else []
+    codec = codec or spec["codec"]
+    extra_args += encoder_args(codec, preset, crf)
+    
+    input_pix_fmt = channel_order + ("a" if alpha else "24")
+    return FFmpegVideoWriter(
+        output_path, width, height, fps,
+        codec=codec,
+        bitrate=bitrate,
+        audio_source=audio_source,
+        audio_codec=audio_codec_for(audio_source, output_format) if audio_source else None,
+        audio_duration=audio_duration,
+        threads=threads,
+        input_pix_fmt=input_pix_fmt,
+        pix_fmt=pix_fmt or (spec["alpha_pix_fmt"] if alpha else spec["pix_fmt"]),
+        extra_args=extra_args
+    )
+
+def open_matte_writer(output_path, width, height, fps, threads=None):
+    """Writer for a mask-only stream of HxW uint8 alpha frames
+    
+    The matte is stored losslessly (grey H.264 at QP 0, or grey PNGs for a
+    sequence) so downstream compositing can reuse it exactly.
+    """
+    if output_format_for(output_path) == "png":
+        return FFmpegVideoWriter(
+            image_sequence_pattern(output_path), width, height, fps,
+            codec="png", threads=threads, input_pix_fmt="gray", pix_fmt="gray"
+        )
+    if output_format_for(output_path) == "webm":
+        raise ValueError("Matte output must be .mp4, .mkv, .mov or a PNG sequence")
+    return FFmpegVideoWriter(
+        output_path, width, height, fps,
+        codec="libx264", threads=threads, input_pix_fmt="gray", pix_fmt="gray",
+        extra_args=["-qp", "0"]
+    )